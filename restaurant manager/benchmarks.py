@@ -0,0 +1,440 @@
+import argparse
+import csv
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, date
+from typing import Dict, List
+
+from inventory.analytics import WasteAnalytics
+from inventory.core import Inventory
+from inventory.importer import import_file
+from inventory.models import InventoryItem, WasteItem
+from inventory.snapshot import SNAPSHOT_FILE
+from inventory.pin import calibrate, pin_parameters, time_derive
+from inventory.storage import SecureStorage, INVENTORY_FIELDS, INVENTORY_FILE, WASTE_FILE, verify_secure_csv
+from inventory.waste_store import WasteStore
+
+WASTE_FIELDS = ['item', 'quantity_wasted', 'date', 'reason', 'notes', 'batch_id']
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Run in a fresh interpreter so module imports are part of the measurement.
+# Prints a JSON object of seconds since the script started.
+STARTUP_SCRIPT = '''
+import json, time
+started = time.perf_counter()
+import tkinter as tk
+import restaurantmana
+timings = {'import': time.perf_counter() - started}
+try:
+    root = tk.Tk()
+except tk.TclError:
+    # No display: time the two loading stages on their own instead.
+    inventory = restaurantmana.Inventory()
+    inventory.load_items()
+    timings['items loaded'] = time.perf_counter() - started
+    inventory.load_history()
+    timings['history loaded'] = time.perf_counter() - started
+    inventory.close()
+else:
+    manager = restaurantmana.InventoryManager(root)
+    root.update()
+    timings['window interactive'] = time.perf_counter() - started
+    while str(manager.notebook.tab(manager.waste_frame, 'state')) != 'normal':
+        root.update()
+        time.sleep(0.005)
+    timings['history loaded'] = time.perf_counter() - started
+    manager.on_closing()
+print(json.dumps(timings))
+'''
+
+
+def make_waste_rows(count: int) -> List[Dict]:
+    reasons = ["Expired", "Damaged", "Overstocked", "Other"]
+    return [{
+        'item': f"Item {i % 5000}",
+        'quantity_wasted': str(i % 40 + 1),
+        'date': f"{i % 12 + 1:02d}/{i % 28 + 1:02d}/2025",
+        'reason': reasons[i % 4],
+        'notes': "" if i % 3 else "left out overnight",
+        'batch_id': ""
+    } for i in range(count)]
+
+
+def save_legacy_csv(storage: SecureStorage, filename: str, data: List[Dict], fieldnames: List[str]):
+    # The original one-token-per-cell writer, kept here only for comparison.
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for row in data:
+            writer.writerow({k: storage.encrypt_data(str(v)) for k, v in row.items()})
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_storage(sizes: List[int], skip_legacy_above: int):
+    storage = SecureStorage()
+    print(f"{'rows':>10} {'format':>8} {'save s':>9} {'load s':>9} {'size MB':>9}")
+    for size in sizes:
+        rows = make_waste_rows(size)
+        formats = [("chunked", storage.save_secure_csv)]
+        if size <= skip_legacy_above:
+            formats.insert(0, ("per-cell", save_legacy_csv))
+        for label, save in formats:
+            filename = f"bench_{label}_{size}.csv"
+            if save is save_legacy_csv:
+                save_time, _ = timed(save, storage, filename, rows, WASTE_FIELDS)
+            else:
+                save_time, _ = timed(save, filename, rows, WASTE_FIELDS)
+            load_time, loaded = timed(storage.load_secure_csv, filename, WASTE_FIELDS)
+            assert loaded == rows, f"{label} round trip mismatch at {size} rows"
+            size_mb = os.path.getsize(filename) / 1e6
+            print(f"{size:>10} {label:>8} {save_time:>9.3f} {load_time:>9.3f} {size_mb:>9.2f}")
+            os.remove(filename)
+
+
+def bench_parallel(sizes: List[int], worker_counts: List[int]):
+    serial = SecureStorage(workers=1)
+    print(f"{'rows':>10} {'workers':>8} {'save s':>9} {'load s':>9} {'speedup':>8}")
+    for size in sizes:
+        rows = make_waste_rows(size)
+        baseline = None
+        for workers in worker_counts:
+            storage = SecureStorage(workers=workers)
+            if workers > 1:
+                # Start the pool outside the timings; it is reused for the
+                # life of the app.
+                storage._get_pool().submit(len, "").result()
+            filename = f"bench_parallel_{size}_{workers}.csv"
+            save_time, _ = timed(storage.save_secure_csv, filename, rows, WASTE_FIELDS)
+            load_time, loaded = timed(storage.load_secure_csv, filename, WASTE_FIELDS)
+            assert loaded == rows, f"{workers} workers round trip mismatch at {size} rows"
+            assert serial.load_secure_csv(filename, WASTE_FIELDS) == rows, "parallel file differs when read serially"
+            baseline = baseline or save_time + load_time
+            speedup = baseline / (save_time + load_time)
+            print(f"{size:>10} {workers:>8} {save_time:>9.3f} {load_time:>9.3f} {speedup:>7.2f}x")
+            storage.close()
+            os.remove(filename)
+
+
+def measured(build):
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+
+def bench_waste_memory(count: int):
+    storage = SecureStorage()
+    rows = make_waste_rows(count)
+    for i, row in enumerate(rows):
+        row['record_id'] = str(i + 1)
+    fields = list(rows[0])
+    # Parse inside each measurement so every record gets its own strings,
+    # as it does when the history is loaded from disk.
+    text = storage._serialize_rows(rows, fields)
+
+    def parsed_rows():
+        return (dict(zip(fields, values)) for values in csv.reader(text.splitlines()))
+
+    def as_objects():
+        # The old layout: one WasteItem per record, keyed by record id.
+        return {item.record_id: item for item in map(WasteItem.from_csv_row, parsed_rows())}
+
+    def as_columns():
+        store = WasteStore()
+        for row in parsed_rows():
+            store.add(WasteItem.from_csv_row(row), "Produce")
+        return store
+
+    object_bytes, _ = measured(as_objects)
+    column_bytes, store = measured(as_columns)
+    print(f"{count} waste records: objects {object_bytes / count:.0f} B/record, "
+          f"columns {column_bytes / count:.0f} B/record ({object_bytes / column_bytes:.1f}x smaller)")
+
+
+def bench_analytics(count: int):
+    records = [WasteItem.from_csv_row(row) for row in make_waste_rows(count)]
+    store = WasteStore()
+    for record_id, record in enumerate(records, start=1):
+        record.record_id = record_id
+        store.add(record, "Produce")
+    analytics = WasteAnalytics(store)
+
+    def python_loops():
+        # One defaultdict pass per report over the record objects.
+        for dimension in ('reason', 'item'):
+            totals = defaultdict(int)
+            for record in records:
+                totals[getattr(record, dimension)] += record.quantity_wasted
+        weeks = defaultdict(int)
+        for record in records:
+            if record.date_ordinal is not None:
+                weeks[record.date_ordinal - (record.date_ordinal - 1) % 7] += record.quantity_wasted
+
+    def vectorized(**filters):
+        for dimension in ('reason', 'item', 'week'):
+            analytics.totals(dimension, **filters)
+
+    loop_time, _ = timed(python_loops)
+    # A filter that keeps every record forces the numpy passes; without one
+    # the store's running totals answer, after being built once.
+    numpy_time, _ = timed(lambda: vectorized(reason=["Expired", "Damaged", "Overstocked", "Other"]))
+    build_time, _ = timed(lambda: store.totals)
+    running_time, _ = timed(vectorized)
+    print(f"reason + item + week totals over {count} records: Python loops {loop_time * 1000:.0f} ms, "
+          f"numpy {numpy_time * 1000:.0f} ms ({loop_time / numpy_time:.0f}x faster), "
+          f"running totals {running_time * 1000:.1f} ms after a {build_time * 1000:.0f} ms build")
+
+
+def bench_search(count: int):
+    inventory = Inventory()
+    inventory.import_items([InventoryItem(f"{name} {i}", 1, f"{i % 12 + 1:02d}/{i % 28 + 1:02d}/2026", "Produce")
+                            for i, name in enumerate(['Apple', 'Tomato', 'Chicken Breast', 'Milk'] * (count // 4))])
+    index_time, _ = timed(inventory.index_names)
+    print(f"index {count} item names: {index_time:.2f} s")
+    for text in ("t", "tom", "tomato 1", "breast 99"):
+        search_time, matches = timed(inventory.search_items, text, "Produce")
+        print(f"  search {text!r}: {len(matches)} matches in {search_time * 1000:.1f} ms")
+    inventory.close()
+
+
+def bench_pin(target_ms: int):
+    # What one login costs the user against what one guess costs an attacker:
+    # a 4-digit PIN has 10,000 candidates.
+    import hashlib
+    sha_time, _ = timed(lambda: [hashlib.sha256(f"{pin:04d}".encode()).digest() for pin in range(10_000)])
+    print(f"unsalted SHA-256: all 10,000 PINs in {sha_time * 1000:.1f} ms")
+    scheme, cost = pin_parameters()
+    seconds = time_derive(scheme, cost)
+    print(f"{scheme} {cost}: {seconds * 1000:.0f} ms per verify, all PINs in {seconds * 10_000 / 60:.0f} min")
+    cost = calibrate(target_ms / 1000, scheme)
+    seconds = time_derive(scheme, cost, repeat=1)
+    print(f"calibrated for {target_ms} ms: {scheme} {cost}, {seconds * 1000:.0f} ms per verify, "
+          f"all PINs in {seconds * 10_000 / 60:.0f} min")
+
+
+def bench_snapshot(count: int):
+    # Cold start with count waste records: parsing the encrypted CSVs against
+    # restoring the binary snapshot written on close.
+    storage = SecureStorage()
+    items = [InventoryItem(f"Item {i}", i % 50 + 1, f"{i % 12 + 1:02d}/15/2026", "Produce") for i in range(5000)]
+    storage.save_secure_csv(INVENTORY_FILE, [item.to_csv_row() for item in items], INVENTORY_FIELDS)
+    rows = make_waste_rows(count)
+    for record_id, row in enumerate(rows, start=1):
+        row['record_id'] = str(record_id)
+    storage.save_secure_csv(WASTE_FILE, rows, WASTE_FIELDS + ['record_id'])
+    del rows
+
+    csv_size = sum(os.path.getsize(name) for name in (INVENTORY_FILE, WASTE_FILE))
+    inventory = Inventory(storage)
+    csv_time, _ = timed(inventory.load)
+    write_time, _ = timed(inventory.save_snapshot)
+    expected = (inventory.next_record_id, len(inventory.waste_records), inventory.analytics.total())
+    inventory = Inventory(storage)
+    snapshot_time, _ = timed(inventory.load)
+    assert (inventory.next_record_id, len(inventory.waste_records), inventory.analytics.total()) == expected
+    print(f"load {count} waste records: CSV {csv_time:.2f} s ({csv_size / 1e6:.1f} MB), "
+          f"snapshot {snapshot_time:.2f} s ({os.path.getsize(SNAPSHOT_FILE) / 1e6:.1f} MB, "
+          f"written in {write_time:.2f} s)")
+    storage.close()
+
+
+def bench_rekey(count: int):
+    # Moving count waste records to a new key: time, and peak memory against
+    # the size of the file, which the job streams a chunk at a time.
+    from inventory.rekey import RekeyJob
+    from inventory.storage import CsvRepository
+
+    storage = SecureStorage()
+    rows = make_waste_rows(count)
+    for record_id, row in enumerate(rows, start=1):
+        row['record_id'] = str(record_id)
+    storage.save_secure_csv(WASTE_FILE, rows, WASTE_FIELDS + ['record_id'])
+    del rows
+
+    size = os.path.getsize(WASTE_FILE)
+    storage.rotate_key()
+    job = RekeyJob(storage, CsvRepository(storage))
+    tracemalloc.start()
+    seconds, _ = timed(job.run)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert sum(1 for _ in storage.iter_secure_csv(WASTE_FILE, WASTE_FIELDS + ['record_id'])) == count
+    print(f"rekey {count} waste records ({size / 1e6:.1f} MB): {seconds:.2f} s "
+          f"({size / 1e6 / seconds:.1f} MB/s), peak memory {peak / 1e6:.1f} MB")
+    storage.close()
+
+
+def bench_integrity(count: int):
+    # The keyless checksum pass over count waste records against decrypting
+    # and parsing them, and the cost of writing with fsync and atomic replace.
+    storage = SecureStorage()
+    rows = make_waste_rows(count)
+    save_time, _ = timed(storage.save_secure_csv, WASTE_FILE, rows, WASTE_FIELDS)
+    del rows
+    size = os.path.getsize(WASTE_FILE)
+    verify_time, problems = timed(verify_secure_csv, WASTE_FILE)
+    assert not problems
+    load_time, loaded = timed(lambda: sum(1 for _ in storage.iter_secure_csv(WASTE_FILE, WASTE_FIELDS)))
+    assert loaded == count
+    print(f"integrity of {count} waste records ({size / 1e6:.1f} MB): save {save_time:.2f} s, "
+          f"verify {verify_time:.3f} s ({size / 1e6 / verify_time:.0f} MB/s), full load {load_time:.2f} s")
+    storage.close()
+
+
+def bench_logging(count: int):
+    # Time the caller spends per log call: a plain file handler, which
+    # writes on the calling thread, against the queue pipeline, which only
+    # enqueues. The queued total also includes draining the queue at the end.
+    import logging
+    from logging.handlers import QueueListener, RotatingFileHandler
+    from inventory.logs import JsonFormatter, JsonQueueHandler, LOG_BACKUPS, LOG_MAX_BYTES
+
+    def log_calls(logger):
+        for i in range(count):
+            logger.info(f"update_item_list took {i % 50 / 10} ms", extra={'span': 'update_item_list', 'rows': i})
+
+    logger = logging.getLogger('bench.direct')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler('direct.log')
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger.addHandler(handler)
+    direct_time, _ = timed(log_calls, logger)
+    handler.close()
+
+    logger = logging.getLogger('bench.queued')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    records = queue.SimpleQueue()
+    logger.addHandler(JsonQueueHandler(records))
+    file_handler = RotatingFileHandler('queued.log', maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    file_handler.setFormatter(JsonFormatter())
+    listener = QueueListener(records, file_handler)
+    listener.start()
+    queued_time, _ = timed(log_calls, logger)
+    drained_time, _ = timed(listener.stop)
+    file_handler.close()
+    print(f"{count} log calls: direct file {direct_time / count * 1e6:.1f} us each, "
+          f"queued {queued_time / count * 1e6:.1f} us each on the caller "
+          f"(+{drained_time:.2f} s to drain the queue at exit)")
+
+
+def bench_startup(count: int):
+    # Data with count waste records and a tenth as many items.
+    inventory = Inventory()
+    inventory.import_items([InventoryItem(f"Item {i}", i % 50 + 1, f"{i % 12 + 1:02d}/{i % 28 + 1:02d}/2026", "Produce")
+                            for i in range(count // 10)])
+    inventory.import_waste([WasteItem.from_csv_row(row) for row in make_waste_rows(count)])
+    inventory.save(compact=True)
+    inventory.close()
+
+    env = dict(os.environ, PYTHONPATH=APP_DIR)
+    result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"startup benchmark failed:\n{result.stderr}")
+        return
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    steps = ", ".join(f"{step} {seconds:.2f} s" for step, seconds in timings.items())
+    print(f"startup with {count // 10} items and {count} waste records: {steps}")
+
+
+def string_date_key(item_date: str) -> datetime:
+    # How sorting and tagging parsed expiration dates before they were cached.
+    return datetime.strptime(item_date, "%m/%d/%Y") if len(item_date.split('/')) == 3 else datetime.strptime(item_date, "%m/%d")
+
+
+def bench_dates(count: int):
+    items = [InventoryItem(f"Item {i}", i % 50, f"{i % 12 + 1:02d}/{i % 28 + 1:02d}/{2024 + i % 3}", "Produce")
+             for i in range(count)]
+    dates = [item.expiration_date for item in items]
+
+    def sort_and_tag_strings():
+        sorted(dates, key=string_date_key)
+        now = datetime.now()
+        for item_date in dates:
+            expiration = string_date_key(item_date)
+            expiration < now or (expiration - now).days <= 7
+
+    def sort_and_tag_ordinals():
+        sorted(items, key=lambda item: item.expiration_ordinal)
+        today = date.today().toordinal()
+        for item in items:
+            item.expiration_ordinal <= today or item.expiration_ordinal <= today + 8
+
+    string_time, _ = timed(sort_and_tag_strings)
+    ordinal_time, _ = timed(sort_and_tag_ordinals)
+    print(f"sort + tag {count} items: strptime {string_time * 1000:.1f} ms, cached ordinals {ordinal_time * 1000:.1f} ms")
+
+
+def bench_import(count: int):
+    filename = "delivery.csv"
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'quantity', 'expiration_date', 'category'])
+        for i in range(count):
+            writer.writerow([f"Item {i}", i % 50 + 1, f"{i % 12 + 1}/{i % 28 + 1}/{2025 + i % 2}", "Produce"])
+
+    inventory = Inventory()
+    import_time, report = timed(import_file, inventory, filename)
+    save_time, _ = timed(inventory.save, True)
+    print(f"import {count} rows: parse + merge {import_time:.2f} s, save {save_time:.2f} s ({report.summary()})")
+    inventory.close()
+
+
+BENCHMARKS = {
+    'storage': lambda args: bench_storage(args.sizes, args.skip_legacy_above),
+    'dates': lambda args: bench_dates(args.items),
+    'import': lambda args: bench_import(args.items),
+    'parallel': lambda args: bench_parallel(args.sizes, args.workers),
+    'memory': lambda args: bench_waste_memory(args.items),
+    'analytics': lambda args: bench_analytics(args.items),
+    'startup': lambda args: bench_startup(args.items),
+    'search': lambda args: bench_search(args.items),
+    'pin': lambda args: bench_pin(args.target_ms),
+    'snapshot': lambda args: bench_snapshot(args.items),
+    'rekey': lambda args: bench_rekey(args.items),
+    'integrity': lambda args: bench_integrity(args.items),
+    'logging': lambda args: bench_logging(args.items),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inventory storage benchmarks")
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=f"any of {', '.join(sorted(BENCHMARKS))} (default: storage)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--skip-legacy-above', type=int, default=100_000,
+                        help="don't time the per-cell format above this many rows")
+    parser.add_argument('--items', type=int, default=100_000)
+    parser.add_argument('--target-ms', type=int, default=250, help="login delay the pin benchmark calibrates for")
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}),
+                        help="process pool sizes for the parallel benchmark")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+
+    # Work in a scratch directory so the benchmark never touches real data or keys.
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        for name in args.benchmarks or ['storage']:
+            BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+# Headless core of the restaurant inventory app: models, storage and the
+# Inventory state, usable without Tk. Submodules are imported on first use so
+# importing the package stays cheap.
+
+_EXPORTS = {
+    'Inventory': 'core',
+    'normalize_date': 'core',
+    'InventoryItem': 'models',
+    'WasteItem': 'models',
+    'WasteBatch': 'models',
+    'SecureStorage': 'storage',
+    'create_repository': 'storage',
+    'WasteAnalytics': 'analytics',
+}
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        import importlib
+        return getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
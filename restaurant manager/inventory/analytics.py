@@ -0,0 +1,304 @@
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .waste_store import WasteStore, WasteTotals, NO_BATCH, month_number
+
+# date.toordinal() of 1970-01-01, where numpy's datetime64 counts from.
+EPOCH_ORDINAL = 719163
+# Dates without a year fall in 1900; a range starting after this never
+# takes them in.
+NO_YEAR_END = date(1900, 12, 31).toordinal()
+
+DIMENSIONS = ('reason', 'item', 'category')
+PERIODS = ('day', 'week', 'month')
+
+# Store column and string table for each dimension.
+_DIMENSION_COLUMNS = {
+    'item': ('items', 'item_names'),
+    'reason': ('reasons', 'reason_names'),
+    'category': ('categories', 'category_names'),
+}
+
+def period_numbers(ordinals: np.ndarray, period: str) -> np.ndarray:
+    # Consecutive periods get consecutive numbers: days are ordinals, weeks
+    # count Mondays from 01/01/0001 and months count from January 1970.
+    if period == 'day':
+        return ordinals.astype(np.int64)
+    elif period == 'week':
+        return (ordinals.astype(np.int64) - 1) // 7
+    elif period == 'month':
+        return (ordinals.astype(np.int64) - EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    raise ValueError(f"Unknown period {period!r}, expected one of {PERIODS}")
+
+def period_starts(numbers: np.ndarray, period: str) -> np.ndarray:
+    # Ordinal of the first day of each numbered period.
+    numbers = np.asarray(numbers, dtype=np.int64)
+    if period == 'day':
+        return numbers
+    elif period == 'week':
+        return numbers * 7 + 1
+    return numbers.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+
+def period_bounds(period: str, ordinal: int) -> Tuple[int, int]:
+    # First and last day of the period containing ordinal.
+    number = period_numbers(np.array([ordinal]), period)
+    first, following = period_starts(np.array([number[0], number[0] + 1]), period)
+    return int(first), int(following) - 1
+
+def rolling_average(values: np.ndarray, window: int) -> np.ndarray:
+    # Mean of each value and the window - 1 before it; the first few average
+    # over however many values exist so far.
+    values = np.asarray(values, dtype=np.float64)
+    cumulative = np.concatenate(([0.0], np.cumsum(values)))
+    ends = np.arange(1, len(values) + 1)
+    starts = np.maximum(ends - window, 0)
+    return (cumulative[ends] - cumulative[starts]) / (ends - starts)
+
+class WasteAnalytics:
+    # Waste reports computed over the WasteStore columns in one pass of numpy
+    # work each, instead of a Python loop per record.
+    #
+    # The columns are read through np.frombuffer, which pins the arrays: the
+    # store can't grow while a view exists. Views therefore never leave
+    # _select, which hands back copies of just the selected rows.
+    #
+    # Every query takes optional start and end ordinals (inclusive) and
+    # item/reason/category filters, each either one value or a collection of
+    # accepted values. Records whose date didn't parse only appear when no
+    # date range is given.
+    #
+    # With an archive (anything with archived_waste(), load_waste_partitions()
+    # and category_of(), such as Inventory) queries also cover months still on
+    # disk: unfiltered ones from the manifest totals, the rest by loading the
+    # months they reach into the store first.
+    #
+    # Unfiltered queries over all time, whole months or any range of days
+    # (the chart's defaults and the summary) are answered from the store's
+    # running totals (see WasteTotals) without touching the rows; the numpy
+    # passes are left to filtered queries and ranges that cut a month.
+
+    def __init__(self, store: WasteStore, archive=None):
+        self.store = store
+        self.archive = archive
+
+    def _archived(self, start: Optional[int], end: Optional[int], usable) -> List[Dict]:
+        # Manifest summaries of the archived months overlapping start..end for
+        # which usable(first, last) is true; the others get loaded.
+        if self.archive is None:
+            return []
+        summaries, load = [], []
+        for key, first, last, summary in self.archive.archived_waste(start, end):
+            if usable(first, last):
+                summaries.append(summary)
+            else:
+                load.append(key)
+        self.archive.load_waste_partitions(load)
+        return summaries
+
+    @staticmethod
+    def _summary_days(summaries: List[Dict], start: Optional[int], end: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+        # (ordinals, totals) of the summarized days within start..end.
+        days = [(int(day), total) for summary in summaries for day, total in summary['days'].items()]
+        dates = np.array([day for day, _ in days], dtype=np.int64)
+        totals = np.array([total for _, total in days], dtype=np.int64)
+        mask = np.ones(len(days), dtype=bool)
+        if start is not None:
+            mask &= dates >= start
+        if end is not None:
+            mask &= dates <= end
+        return dates[mask], totals[mask]
+
+    def _summary_totals(self, summary: Dict, by: str) -> Dict[str, int]:
+        if by == 'reason':
+            return summary['reasons']
+        elif by == 'item':
+            return summary['items']
+        categories = {}
+        for item, total in summary['items'].items():
+            category = self.archive.category_of(item)
+            categories[category] = categories.get(category, 0) + total
+        return categories
+
+    def _running(self, filters: Dict) -> Optional[WasteTotals]:
+        # The store's running totals, or None when filters rule them out.
+        if any(value is not None for value in filters.values()):
+            return None
+        return self.store.totals
+
+    @staticmethod
+    def _running_days(totals: WasteTotals, start: Optional[int], end: Optional[int]) -> Dict[str, np.ndarray]:
+        # What _select gives for dated rows, one entry per day instead of per
+        # record.
+        days = [(day, total) for day, total in totals.days.items()
+                if (start is None or day >= start) and (end is None or day <= end)]
+        return {'dates': np.array([day for day, _ in days], dtype=np.int64),
+                'quantities': np.array([total for _, total in days], dtype=np.int64)}
+
+    @staticmethod
+    def _whole_months(totals: WasteTotals, start: Optional[int],
+                      end: Optional[int]) -> Optional[Tuple[int, Optional[int]]]:
+        # (first, last) month numbers, last None for open, when start..end
+        # holds every loaded dated record of each month it touches, so month
+        # totals answer for it exactly; None otherwise.
+        if start is None or start <= NO_YEAR_END or (end is not None and end < start):
+            return None
+        first_day, _ = period_bounds('month', start)
+        if any(day in totals.days for day in range(first_day, start)):
+            return None
+        if end is not None:
+            _, last_day = period_bounds('month', end)
+            if any(day in totals.days for day in range(end + 1, last_day + 1)):
+                return None
+        return month_number(start), None if end is None else month_number(end)
+
+    def _select(self, columns, start: Optional[int], end: Optional[int], dated: bool,
+                filters: Dict) -> Dict[str, np.ndarray]:
+        # Copies of the requested columns ('quantities', 'dates', 'record_ids',
+        # 'batch_ids' or a dimension) for the live rows that pass the filters.
+        store = self.store
+        mask = np.frombuffer(store.alive, dtype=np.uint8).astype(bool)
+        dates = np.frombuffer(store.dates, dtype=np.int32)
+        if dated:
+            # Dates without a year sit in 1900 and can't be placed on a timeline.
+            mask &= np.frombuffer(store.has_year, dtype=np.uint8).view(bool)
+        if start is not None:
+            mask &= dates >= start
+        if end is not None:
+            mask &= dates <= end
+        if start is not None or end is not None:
+            mask &= dates != 0
+        for dimension, value in filters.items():
+            if value is None:
+                continue
+            column, table = _DIMENSION_COLUMNS[dimension]
+            codes = getattr(store, table).codes
+            values = np.frombuffer(getattr(store, column), dtype=np.int32)
+            if isinstance(value, str):
+                mask &= values == codes.get(value, -1)
+            else:
+                mask &= np.isin(values, [codes[name] for name in value if name in codes])
+
+        selected = {}
+        for name in columns:
+            if name == 'quantities':
+                selected[name] = np.frombuffer(store.quantities, dtype=np.int32)[mask].astype(np.int64)
+            elif name == 'dates':
+                selected[name] = dates[mask]
+            elif name in ('record_ids', 'batch_ids'):
+                selected[name] = np.frombuffer(getattr(store, name), dtype=np.int32)[mask]
+            else:
+                selected[name] = np.frombuffer(getattr(store, _DIMENSION_COLUMNS[name][0]), dtype=np.int32)[mask]
+        return selected
+
+    def record_ids(self, batch_id: Optional[int] = None, start: Optional[int] = None, end: Optional[int] = None,
+                   **filters) -> List[int]:
+        # Ids of the matching records in one batch, or with None the
+        # individually logged ones, in record id order. A date range loads
+        # the archived months it covers; without one only loaded records
+        # are searched.
+        if start is not None or end is not None:
+            self._archived(start, end, lambda first, last: False)
+        selected = self._select(('record_ids', 'batch_ids'), start, end, False, filters)
+        in_batch = selected['batch_ids'] == (NO_BATCH if batch_id is None else batch_id)
+        return selected['record_ids'][in_batch].tolist()
+
+    def total(self, start: Optional[int] = None, end: Optional[int] = None, **filters) -> int:
+        unfiltered = all(value is None for value in filters.values())
+        archived = self._archived(start, end, lambda first, last: unfiltered)
+        running = self._running(filters)
+        if running is not None and start is None and end is None:
+            total = sum(running.by['reason'].values())
+        elif running is not None and start is not None and start > NO_YEAR_END:
+            total = int(self._running_days(running, start, end)['quantities'].sum())
+        else:
+            total = int(self._select(('quantities',), start, end, False, filters)['quantities'].sum())
+        return total + int(self._summary_days(archived, start, end)[1].sum())
+
+    def totals(self, by: str, start: Optional[int] = None, end: Optional[int] = None, **filters) -> Dict:
+        # Dimensions come back largest first; periods come back in date order,
+        # keyed by the ordinal of their first day, leaving out empty ones.
+        if by in PERIODS:
+            starts, sums = self.trend(by, start, end, **filters)
+            return {int(first): int(total) for first, total in zip(starts, sums) if total}
+
+        # Month totals only cover whole months: one cut by the range is loaded.
+        unfiltered = all(value is None for value in filters.values())
+        archived = self._archived(start, end, lambda first, last: unfiltered and (start is None or start <= first)
+                                  and (end is None or last <= end))
+        column, table = _DIMENSION_COLUMNS[by]
+        names = getattr(self.store, table).values
+        running, sums = self._running(filters), None
+        if running is not None and start is None and end is None:
+            sums = running.by[by]
+        elif running is not None and self._whole_months(running, start, end) is not None:
+            first, last = self._whole_months(running, start, end)
+            sums = {}
+            for month, codes in running.months[by].items():
+                if first <= month and (last is None or month <= last):
+                    for code, total in codes.items():
+                        sums[code] = sums.get(code, 0) + total
+        if sums is not None:
+            # Same order as the numpy path: largest first, ties by code.
+            totals = {names[code]: total for code, total in sorted(sums.items(), key=lambda pair: (-pair[1], pair[0]))
+                      if total}
+        else:
+            selected = self._select(('quantities', by), start, end, False, filters)
+            sums = np.bincount(selected[by], weights=selected['quantities'], minlength=len(names))
+            order = np.argsort(-sums, kind='stable')
+            totals = {names[code]: int(sums[code]) for code in order if sums[code]}
+        if archived:
+            for summary in archived:
+                for name, total in self._summary_totals(summary, by).items():
+                    totals[name] = totals.get(name, 0) + total
+            totals = dict(sorted(totals.items(), key=lambda pair: -pair[1]))
+        return totals
+
+    def top(self, by: str, count: int, start: Optional[int] = None, end: Optional[int] = None,
+            **filters) -> List[Tuple[str, int]]:
+        return list(self.totals(by, start, end, **filters).items())[:count]
+
+    def trend(self, period: str, start: Optional[int] = None, end: Optional[int] = None,
+              **filters) -> Tuple[np.ndarray, np.ndarray]:
+        # Totals for every period from start to end, empty ones included, as
+        # (first-day ordinals, totals). Without bounds the series spans the
+        # dated records.
+        unfiltered = all(value is None for value in filters.values())
+        archived = self._archived(start, end, lambda first, last: unfiltered)
+        running = self._running(filters)
+        if running is not None:
+            selected = self._running_days(running, start, end)
+        else:
+            selected = self._select(('quantities', 'dates'), start, end, True, filters)
+        if archived:
+            dates, totals = self._summary_days(archived, start, end)
+            selected = {'dates': np.concatenate((selected['dates'], dates)),
+                        'quantities': np.concatenate((selected['quantities'], totals))}
+        numbers = period_numbers(selected['dates'], period)
+        if start is not None:
+            first = int(period_numbers(np.array([start]), period)[0])
+        elif len(numbers):
+            first = int(numbers.min())
+        else:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        if end is not None:
+            last = int(period_numbers(np.array([end]), period)[0])
+        else:
+            last = int(numbers.max()) if len(numbers) else first
+        if last < first:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        sums = np.bincount(numbers - first, weights=selected['quantities'], minlength=last - first + 1)
+        return period_starts(np.arange(first, last + 1), period), sums.astype(np.int64)
+
+    def compare(self, period: str, today: Optional[int] = None, **filters) -> Tuple[int, int]:
+        # This period so far against the same number of days at the start of
+        # the previous one, so a half-finished month isn't held against a
+        # whole one.
+        today = today if today is not None else date.today().toordinal()
+        first, _ = period_bounds(period, today)
+        previous_first, previous_last = period_bounds(period, first - 1)
+        previous_end = min(previous_first + (today - first), previous_last)
+        return (self.total(first, today, **filters),
+                self.total(previous_first, previous_end, **filters))
@@ -0,0 +1,362 @@
+import argparse
+import os
+import sys
+
+# Only argparse is imported up front; each command pulls in the storage and
+# crypto modules itself so --help and bad arguments return immediately.
+
+TABLES = ('inventory', 'waste', 'batches')
+
+def configure_logging():
+    from .logs import configure_logging
+    configure_logging()
+
+def open_storage():
+    from .storage import SecureStorage
+    try:
+        return SecureStorage()
+    except (KeyError, ValueError) as e:
+        # --on-error can't help with a damaged key file.
+        sys.exit(f"error: the encryption key file could not be read ({type(e).__name__}: {e})")
+
+def open_inventory():
+    from cryptography.fernet import InvalidToken
+    from .core import Inventory
+    from .storage import SecureCsvError
+    configure_logging()
+    inventory = Inventory(open_storage())
+    try:
+        inventory.load()
+    except (SecureCsvError, InvalidToken) as e:
+        inventory.close()
+        sys.exit(f"error: {str(e) or 'data could not be decrypted with the key file'}; "
+                 "rerun with --on-error skip or --on-error quarantine to load the readable data")
+    for error in inventory.load_errors:
+        print(f"warning: left out {error}", file=sys.stderr)
+    return inventory
+
+def open_indexed_repository():
+    # The SQLite backend answers exact-match queries from its indexes
+    # without loading anything; None for the CSV backend, or a database the
+    # CSV data has yet to be moved into, which need open_inventory().
+    from .storage import SqliteRepository, create_repository
+    storage = open_storage()
+    repository = create_repository(storage)
+    if isinstance(repository, SqliteRepository) and not repository.is_empty():
+        configure_logging()
+        return repository
+    repository.close()
+    storage.close()
+    return None
+
+def query_rows(repository, query):
+    # Rows from a repository query, closing the repository either way.
+    from cryptography.fernet import InvalidToken
+    try:
+        return query()
+    except InvalidToken:
+        sys.exit(f"error: {repository.filename} holds rows that could not be decrypted with the key file")
+    finally:
+        repository.close()
+        repository.storage.close()
+
+def write_rows(rows, fieldnames, output):
+    import csv
+    writer = csv.DictWriter(output, fieldnames=fieldnames, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+
+def cmd_import(args):
+    from .importer import import_file
+
+    inventory = open_inventory()
+    report = import_file(inventory, args.file, args.table, dry_run=args.dry_run)
+    for line, message in report.errors:
+        print(f"{args.file}:{line}: {message}", file=sys.stderr)
+    if not args.dry_run:
+        inventory.save(compact=True)
+    inventory.close()
+    print(report.summary() + (" (dry run, nothing saved)" if args.dry_run else ""))
+    if args.strict and report.errors:
+        sys.exit(1)
+
+def cmd_export(args):
+    from .storage import INVENTORY_FIELDS, WASTE_FIELDS, BATCH_FIELDS
+
+    inventory = open_inventory()
+    if args.table == 'waste':
+        inventory.ensure_waste_loaded()
+    inventory_rows, waste_rows, batch_rows = inventory.snapshot_rows()
+    inventory.close()
+    rows, fieldnames = {
+        'inventory': (inventory_rows, INVENTORY_FIELDS),
+        'waste': (waste_rows, WASTE_FIELDS),
+        'batches': (batch_rows, BATCH_FIELDS),
+    }[args.table]
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            write_rows(rows, fieldnames, f)
+    else:
+        write_rows(rows, fieldnames, sys.stdout)
+
+def cmd_items(args):
+    from datetime import date
+    from .models import InventoryItem
+    from .storage import INVENTORY_FIELDS
+
+    repository = open_indexed_repository()
+    if repository is not None:
+        if args.expiring_within is not None:
+            today = date.today()
+            rows = query_rows(repository, lambda: repository.items_expiring_between(
+                today, date.fromordinal(today.toordinal() + args.expiring_within)))
+            # Ties in the same order as the expiration index.
+            rows.sort(key=lambda row: InventoryItem.from_csv_row(row).expiration_key)
+            rows = [row for row in rows
+                    if (args.name is None or row['name'] == args.name)
+                    and (args.category is None or row['category'] == args.category)]
+        else:
+            rows = query_rows(repository, lambda: repository.find_items(args.name, args.category))
+        write_rows(rows, INVENTORY_FIELDS, sys.stdout)
+        return
+
+    inventory = open_inventory()
+    if args.expiring_within is not None:
+        today = date.today().toordinal()
+        items = inventory.items_expiring_between(today, today + args.expiring_within)
+    else:
+        items = inventory.items
+    rows = [item.to_csv_row() for item in items
+            if (args.name is None or item.name == args.name)
+            and (args.category is None or item.category == args.category)]
+    inventory.close()
+    write_rows(rows, INVENTORY_FIELDS, sys.stdout)
+
+def date_bounds(args):
+    from .models import parse_date
+
+    bounds = []
+    for value in (args.start, args.end):
+        parsed = parse_date(value) if value else None
+        if value and not parsed:
+            sys.exit(f"invalid date {value!r}, use MM/DD or MM/DD/YYYY")
+        bounds.append(parsed[0] if parsed else None)
+    return bounds
+
+def waste_filters(args):
+    return {'item': args.item, 'reason': args.reason, 'category': args.category}
+
+def cmd_waste(args):
+    from .storage import WASTE_FIELDS
+
+    from datetime import date
+
+    start, end = date_bounds(args)
+    # Categories come from the inventory items, so only a full load has them.
+    repository = open_indexed_repository() if args.category is None else None
+    if repository is not None:
+        rows = query_rows(repository, lambda: repository.find_waste(
+            args.item, args.reason, start=date.fromordinal(start) if start is not None else None,
+            end=date.fromordinal(end) if end is not None else None))
+        write_rows(rows, WASTE_FIELDS, sys.stdout)
+        return
+
+    inventory = open_inventory()
+    inventory.ensure_waste_loaded(start, end)
+    rows = [record.to_csv_row() for record in inventory.waste_records.values()
+            if (args.item is None or record.item == args.item)
+            and (args.reason is None or record.reason == args.reason)
+            and (args.category is None or record.category == args.category)
+            and (start is None or (record.date_ordinal is not None and record.date_ordinal >= start))
+            and (end is None or (record.date_ordinal is not None and record.date_ordinal <= end))]
+    inventory.close()
+    write_rows(rows, WASTE_FIELDS, sys.stdout)
+
+def period_label(ordinal: int, period: str) -> str:
+    from datetime import date
+    first = date.fromordinal(ordinal)
+    return first.strftime("%Y-%m") if period == 'month' else first.strftime("%m/%d/%Y")
+
+def cmd_report(args):
+    start, end = date_bounds(args)
+    inventory = open_inventory()
+    totals = inventory.analytics.totals(args.by, start, end, **waste_filters(args))
+    inventory.close()
+    # Periods are already in date order and everything else largest first.
+    keys = list(totals)[:args.top] if args.top else list(totals)
+    for key in keys:
+        label = period_label(key, args.by) if args.by in ('day', 'week', 'month') else key
+        print(f"{label:<30} {totals[key]:>10}")
+    print(f"{'Total':<30} {sum(totals.values()):>10}")
+
+def cmd_trend(args):
+    from .analytics import rolling_average
+
+    start, end = date_bounds(args)
+    inventory = open_inventory()
+    starts, sums = inventory.analytics.trend(args.every, start, end, **waste_filters(args))
+    inventory.close()
+    averages = rolling_average(sums, args.window)
+    print(f"{args.every.capitalize():<12} {'Wasted':>10} {f'Avg ({args.window})':>12}")
+    for first, total, average in zip(starts, sums, averages):
+        print(f"{period_label(int(first), args.every):<12} {int(total):>10} {average:>12.1f}")
+
+def cmd_summary(args):
+    from datetime import date
+    from .analytics import period_bounds
+
+    today = date.today().toordinal()
+    inventory = open_inventory()
+    analytics = inventory.analytics
+    month_start, _ = period_bounds('month', today)
+    top_items = analytics.top('item', args.top, month_start, today)
+    comparisons = [(period, *analytics.compare(period, today)) for period in ('week', 'month')]
+    inventory.close()
+
+    print("Top wasted items this month:")
+    for item, total in top_items:
+        print(f"  {item:<28} {total:>10}")
+    if not top_items:
+        print("  (none)")
+    for period, current, previous in comparisons:
+        change = f"{(current - previous) / previous:+.0%}" if previous else "n/a"
+        print(f"This {period} so far: {current} (same days last {period}: {previous}, {change})")
+
+def add_waste_filters(command):
+    command.add_argument('--item')
+    command.add_argument('--reason')
+    command.add_argument('--category')
+    command.add_argument('--from', dest='start', metavar='DATE')
+    command.add_argument('--to', dest='end', metavar='DATE')
+
+def cmd_calibrate_pin(args):
+    from dotenv import load_dotenv, set_key
+    from .pin import calibrate, pin_parameters
+
+    load_dotenv()
+    scheme, current = pin_parameters()
+    print(f"current {scheme} cost: {', '.join(map(str, current))}")
+    cost = calibrate(args.target_ms / 1000, scheme,
+                     lambda cost, seconds: print(f"  {', '.join(map(str, cost))}: {seconds * 1000:.0f} ms"))
+    print(f"closest to {args.target_ms} ms: {', '.join(map(str, cost))}")
+    if args.save:
+        names = ("PIN_SCRYPT_N", "PIN_SCRYPT_R", "PIN_SCRYPT_P") if scheme == 'scrypt' else ("PIN_PBKDF2_ITERATIONS",)
+        for name, value in zip(names, cost):
+            set_key(".env", name, str(value))
+        print("saved to .env; the PIN is rehashed with it on the next login")
+
+def cmd_rotate_key(args):
+    from .rekey import RekeyJob, rekey_pending
+    from .storage import create_repository
+
+    configure_logging()
+    storage = open_storage()
+    repository = create_repository(storage)
+    if rekey_pending():
+        print(f"resuming re-encryption with key version {storage.key_version}")
+    else:
+        print(f"new key version {storage.rotate_key()}")
+
+    def report(done, total, filename):
+        print(f"\r{done * 100 // max(total, 1):3d}% {filename:<40}", end='', flush=True)
+
+    job = RekeyJob(storage, repository, report)
+    try:
+        finished = job.run()
+    except KeyboardInterrupt:
+        # The last checkpoint is at most a few hundred chunks back.
+        sys.exit("\nstopped; run rotate-key again to carry on")
+    finally:
+        repository.close()
+        storage.close()
+    print(f"\nall data is now under key version {storage.key_version}")
+    if job.unreadable:
+        print(f"warning: {job.unreadable} unreadable tokens were left as they were", file=sys.stderr)
+    if args.retire and (job.unreadable or not finished) and not args.force:
+        # Whatever is still under an old key would be lost with it.
+        sys.exit("old keys kept: some data is not under the new key; fix it and run rotate-key again, "
+                 "or add --force to retire them anyway")
+    if args.retire:
+        retired = storage.retire_keys()
+        print(f"removed key versions {', '.join(map(str, retired)) or 'none'} from the key file")
+
+def cmd_check(args):
+    from .storage import check_stored_data
+
+    # Only checksums are compared, straight on the files: no key is read or
+    # created and nothing is written, not even the log.
+    problems = check_stored_data()
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(f"{len(problems)} problems found")
+    print("no problems found")
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="inventory", description="Restaurant inventory from the command line")
+    parser.add_argument('--data-dir', default=".",
+                        help="directory holding the data files and .env (default: current directory)")
+    parser.add_argument('--on-error', choices=('fail', 'skip', 'quarantine'),
+                        help="what to do with unreadable stored data (default: INVENTORY_LOAD_ERRORS or fail)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('import', help="add rows from a plain CSV, JSON or JSON Lines file")
+    command.add_argument('table', choices=('inventory', 'waste'))
+    command.add_argument('file')
+    command.add_argument('--dry-run', action='store_true', help="only validate the file")
+    command.add_argument('--strict', action='store_true', help="exit with status 1 if any row was rejected")
+    command.set_defaults(func=cmd_import)
+
+    command = commands.add_parser('export', help="write a table as plain CSV")
+    command.add_argument('table', choices=TABLES)
+    command.add_argument('-o', '--output', help="file to write (default: stdout)")
+    command.set_defaults(func=cmd_export)
+
+    command = commands.add_parser('items', help="list inventory items")
+    command.add_argument('--name')
+    command.add_argument('--category')
+    command.add_argument('--expiring-within', type=int, metavar='DAYS')
+    command.set_defaults(func=cmd_items)
+
+    command = commands.add_parser('waste', help="list waste records")
+    add_waste_filters(command)
+    command.set_defaults(func=cmd_waste)
+
+    command = commands.add_parser('report', help="total waste by one dimension")
+    command.add_argument('--by', default='reason', choices=('reason', 'item', 'category', 'day', 'week', 'month'))
+    command.add_argument('--top', type=int, metavar='N', help="only the first N rows")
+    add_waste_filters(command)
+    command.set_defaults(func=cmd_report)
+
+    command = commands.add_parser('trend', help="waste per day, week or month with a rolling average")
+    command.add_argument('--every', default='week', choices=('day', 'week', 'month'))
+    command.add_argument('--window', type=int, default=4, help="periods in the rolling average (default: 4)")
+    add_waste_filters(command)
+    command.set_defaults(func=cmd_trend)
+
+    command = commands.add_parser('summary', help="top items this month and waste against last period")
+    command.add_argument('--top', type=int, default=5, metavar='N')
+    command.set_defaults(func=cmd_summary)
+
+    command = commands.add_parser('calibrate-pin', help="pick the PIN hashing cost for a login delay on this machine")
+    command.add_argument('--target-ms', type=int, default=250, help="verify time to aim for (default: 250)")
+    command.add_argument('--save', action='store_true', help="write the chosen cost to .env")
+    command.set_defaults(func=cmd_calibrate_pin)
+
+    command = commands.add_parser('rotate-key', help="switch to a new encryption key and re-encrypt the data with it")
+    command.add_argument('--retire', action='store_true',
+                         help="afterwards remove the old keys; backups made with them can no longer be read")
+    command.add_argument('--force', action='store_true',
+                         help="with --retire, remove the old keys even if some tokens could not be re-encrypted")
+    command.set_defaults(func=cmd_rotate_key)
+
+    command = commands.add_parser('check', help="verify the checksums of the stored data without decrypting it")
+    command.set_defaults(func=cmd_check)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    os.chdir(args.data_dir)
+    if args.on_error:
+        os.environ['INVENTORY_LOAD_ERRORS'] = args.on_error
+    args.func(args)
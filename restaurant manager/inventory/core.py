@@ -0,0 +1,483 @@
+import logging
+from array import array
+from collections import defaultdict
+from typing import Iterable, List, Dict, Optional, Tuple
+
+from .models import InventoryItem, WasteItem, WasteBatch, ExpirationIndex, parse_date, format_date
+from .search import NameIndex, ItemColumns
+from .snapshot import read_snapshot, write_snapshot
+from .waste_store import WasteStore, WasteSelection, StringTable
+from .storage import (SecureStorage, InventoryRepository, CsvRepository, SqliteRepository, create_repository,
+                      load_error_policy, waste_partition, partition_bounds, waste_window, UNDATED_PARTITION)
+
+def normalize_date(date_str: str) -> Optional[str]:
+    # MM/DD or MM/DD/YYYY with zero padding, or None if the date is invalid.
+    parsed = parse_date(date_str)
+    return format_date(*parsed) if parsed else None
+
+class RowSnapshot:
+    # What snapshot_rows() would return, captured without building a row:
+    # items and batches are never changed in place, so copying the lists is
+    # enough, and the waste columns are dumped as bytes. rows() builds the
+    # dicts later, on whichever thread calls it.
+
+    def __init__(self, inventory: 'Inventory'):
+        self.items = list(inventory.items)
+        self.waste = inventory.waste_records.dump()
+        self.batches = list(inventory.waste_batches.values())
+        # Months loaded later have no rows here; the compaction must leave
+        # their files alone.
+        self.loaded_partitions = inventory.repository.loaded_partition_keys()
+
+    def rows(self) -> Tuple[List[Dict], List[Dict], List[Dict]]:
+        waste_records = WasteStore.restore(*self.waste)
+        return (
+            [item.to_csv_row() for item in self.items],
+            [record.to_csv_row() for record in waste_records.values()],
+            [batch.to_csv_row() for batch in self.batches]
+        )
+
+class Inventory:
+    # Items, waste records and batches held in memory, independent of any UI.
+    # Every edit goes through record_change, which applies it here and queues
+    # it for the repository; save() or take_pending() hands the queue over.
+
+    def __init__(self, storage: Optional[SecureStorage] = None, repository: Optional[InventoryRepository] = None):
+        self.storage = storage or SecureStorage()
+        self.repository = repository or create_repository(self.storage)
+        self.pending_ops = []
+        self.load_errors = []
+        self.load_source = self.repository
+        # (meta, blobs) of the binary snapshot being loaded, if any, from
+        # load_items() until load_history() has used it.
+        self.snapshot = None
+        self.clear()
+
+    def clear(self):
+        self.items = []
+        self.item_columns = ItemColumns()
+        self.expiration_index = ExpirationIndex()
+        self.item_order = "Expiration"
+        self.waste_records = WasteStore()
+        self.next_record_id = 1
+        self.item_categories = {}
+        self.waste_batches = {}
+        self.next_batch_id = 0
+        # Name search over item names and waste item names, brought up to
+        # date from their string tables by index_names() or on each search.
+        self.item_name_index = NameIndex()
+        self.waste_name_index = NameIndex()
+
+    def add_item(self, item: InventoryItem, replace_index: Optional[int] = None):
+        if replace_index is not None:
+            self.record_change('inventory', 'delete', index=replace_index)
+
+        if self.item_order == "Expiration":
+            # The list already matches the index, so the new item's rank
+            # is exactly where a re-sort would put it.
+            self.record_change('inventory', 'insert', index=self.expiration_index.rank(item), record=item)
+        else:
+            self.record_change('inventory', 'insert', index=len(self.items), record=item)
+            self.record_change('inventory', 'sort', key='Expiration')
+
+    def import_items(self, items: List[InventoryItem]):
+        # A single merge change instead of one insert per item.
+        self._record_merge('inventory', items)
+
+    def delete_item(self, index: int):
+        self.record_change('inventory', 'delete', index=index)
+
+    def sort_items(self, key: str):
+        self.record_change('inventory', 'sort', key=key)
+
+    def items_expiring_between(self, first_ordinal: int, last_ordinal: int) -> List[InventoryItem]:
+        return list(self.expiration_index.irange(first_ordinal, last_ordinal))
+
+    @property
+    def analytics(self):
+        # numpy is only imported once a report is asked for. Reports reach
+        # archived months through archived_waste() and load_waste_partitions().
+        from .analytics import WasteAnalytics
+        return WasteAnalytics(self.waste_records, self)
+
+    def archived_waste(self, start: Optional[int] = None, end: Optional[int] = None) -> List[Tuple[str, int, int, Dict]]:
+        # (key, first day, last day, summary) for each month of waste still on
+        # disk that overlaps start..end (ordinals, None for open). Archived
+        # months come from the repository the waste was loaded from.
+        archived = []
+        for key, summary in self.load_source.archived_partitions().items():
+            first, last = partition_bounds(key)
+            if (start is None or last >= start) and (end is None or first <= end):
+                archived.append((key, first, last, summary))
+        return archived
+
+    def ensure_waste_loaded(self, start: Optional[int] = None, end: Optional[int] = None):
+        self.load_waste_partitions([key for key, _, _, _ in self.archived_waste(start, end)])
+
+    def load_waste_partitions(self, keys: Iterable[str]):
+        for key in keys:
+            records = [WasteItem.from_csv_row(row) for row in self.load_source.load_partition(key)]
+            self.waste_records.add_many((record, self.category_of(record.item)) for record in records)
+            self.next_record_id = max([self.next_record_id] + [record.record_id + 1 for record in records])
+
+    def _load_partitions_for(self, dates: Iterable[str]):
+        # Records can only be added to or removed from a month that is in
+        # memory, or its segment would be rewritten without the rest.
+        archived = self.load_source.archived_partitions()
+        self.load_waste_partitions(sorted({waste_partition(text) for text in dates} & set(archived)))
+
+    def index_names(self):
+        # Indexing 100k distinct names takes a couple of seconds, so the GUI
+        # does it on the loader thread rather than on the first keystroke.
+        self.item_name_index.sync(self.item_columns.names.values)
+        self.waste_name_index.sync(self.waste_records.item_names.values)
+
+    def search_items(self, text: str = "", category: Optional[str] = None,
+                     items: Optional[List[InventoryItem]] = None) -> List[InventoryItem]:
+        # Items whose name contains text, ignoring case, and that are in
+        # category if one is given, in list order. items narrows the search to
+        # a subset such as the expiring ones.
+        names = None
+        if text.strip():
+            self.item_name_index.sync(self.item_columns.names.values)
+            names = self.item_name_index.match(text)
+        if names is None and category is None:
+            return self.items if items is None else items
+        if items is not None:
+            return [item for item in items
+                    if (names is None or item.name in names) and (category is None or item.category == category)]
+        return [self.items[position] for position in self.item_columns.positions(names, category)]
+
+    def search_waste(self, text: str = "", reason: Optional[str] = None,
+                     category: Optional[str] = None) -> WasteSelection:
+        # The individually logged records matching like search_items, with
+        # reason and category compared exactly.
+        if not text.strip() and reason is None and category is None:
+            return self.individual_waste()
+        filters = {'reason': reason, 'category': category}
+        if text.strip():
+            self.waste_name_index.sync(self.waste_records.item_names.values)
+            filters['item'] = self.waste_name_index.match(text)
+        return WasteSelection(self.waste_records, self.analytics.record_ids(None, **filters))
+
+    def individual_waste(self) -> WasteSelection:
+        return self.waste_records.in_batch(None)
+
+    def add_waste(self, waste_item: WasteItem):
+        self._load_partitions_for([waste_item.date])
+        waste_item.record_id = self.allocate_record_id()
+        self.record_change('waste', 'insert', record=waste_item)
+
+    def import_waste(self, records: List[WasteItem]):
+        self._load_partitions_for(record.date for record in records)
+        for record in records:
+            record.record_id = self.allocate_record_id()
+        self._record_merge('waste', records)
+
+    def delete_waste(self, record_id: int):
+        self.record_change('waste', 'delete', record_id=record_id)
+
+    def add_batch(self, batch_date: str, items: List[WasteItem], notes: str) -> WasteBatch:
+        self._load_partitions_for([batch_date])
+        batch_id = self.next_batch_id
+        self.next_batch_id += 1
+        batch = WasteBatch(batch_date, list(items), sum(item.quantity_wasted for item in items), notes, batch_id)
+
+        # Individual entries that are now covered by the batch get replaced by it.
+        individual_by_key = defaultdict(list)
+        for waste_item in self.waste_records.in_batch(None):
+            individual_by_key[(waste_item.item, waste_item.quantity_wasted, waste_item.date_ordinal)].append(waste_item)
+
+        for batch_item in items:
+            batch_item.date = batch_date
+            batch_item.batch_id = batch_id
+            batch_item.record_id = self.allocate_record_id()
+            for waste_item in individual_by_key.pop((batch_item.item, batch_item.quantity_wasted, batch_item.date_ordinal), []):
+                self.record_change('waste', 'delete', record_id=waste_item.record_id)
+            self.record_change('waste', 'insert', record=batch_item)
+
+        self.record_change('batches', 'insert', record=batch)
+        return batch
+
+    def delete_batch(self, batch_id: int):
+        if batch_id not in self.waste_batches:
+            raise KeyError(f"No batch with id {batch_id}")
+        self._load_partitions_for([self.waste_batches[batch_id].batch_date])
+        for record_id in list(self.waste_records.in_batch(batch_id).record_ids):
+            self.record_change('waste', 'delete', record_id=record_id)
+        self.record_change('batches', 'delete', batch_id=batch_id)
+
+    def record_change(self, table: str, op: str, record=None, **fields):
+        change = dict(fields, table=table, op=op)
+        if record is not None:
+            change['row'] = record.to_csv_row()
+        self.apply_change(change, record)
+        self.pending_ops.append(change)
+
+    def _record_merge(self, table: str, records: List):
+        if not records:
+            return
+        change = {'table': table, 'op': 'merge', 'rows': [record.to_csv_row() for record in records]}
+        self.apply_change(change, records)
+        self.pending_ops.append(change)
+
+    def apply_change(self, change: Dict, record=None):
+        if record is None and change['op'] == 'insert':
+            record = self._record_from_row(change['table'], change['row'])
+        elif record is None and change['op'] == 'merge':
+            record = [self._record_from_row(change['table'], row) for row in change['rows']]
+
+        if change['table'] == 'waste':
+            self._apply_waste_change(change, record)
+            return
+        elif change['table'] == 'batches':
+            self._apply_batch_change(change, record)
+            return
+
+        records = self.items
+
+        if change['op'] == 'insert':
+            records.insert(change['index'], record)
+            self.item_columns.insert(change['index'], record)
+            self.expiration_index.add(record)
+            self.item_categories[record.name] = record.category
+        elif change['op'] == 'delete':
+            self.expiration_index.remove(records[change['index']])
+            del records[change['index']]
+            self.item_columns.delete(change['index'])
+        elif change['op'] == 'merge':
+            # Merged items always leave the list in expiration order, the same
+            # place add_item would have put each of them.
+            for item in record:
+                self.expiration_index.add(item)
+                self.item_categories[item.name] = item.category
+            records[:] = list(self.expiration_index)
+            self.item_columns.reset(records)
+            self.item_order = "Expiration"
+        elif change['op'] == 'sort':
+            if change['key'] == "Name":
+                records.sort(key=lambda x: x.name)
+            elif change['key'] == "Expiration":
+                records[:] = list(self.expiration_index)
+            self.item_columns.reset(records)
+            self.item_order = change['key']
+
+    def _apply_waste_change(self, change: Dict, record=None):
+        if change['op'] == 'merge':
+            for item in record:
+                self._apply_waste_change({'op': 'insert'}, item)
+        elif change['op'] == 'insert':
+            self.waste_records.add(record, self.category_of(record.item))
+            self.next_record_id = max(self.next_record_id, record.record_id + 1)
+        elif change['op'] == 'delete':
+            self.waste_records.remove(change['record_id'])
+
+    def category_of(self, item_name: str) -> str:
+        return self.item_categories.get(item_name, "Uncategorized")
+
+    def _apply_batch_change(self, change: Dict, record=None):
+        if change['op'] == 'insert':
+            record.items = self.waste_records.in_batch(record.batch_id)
+            self.waste_batches[record.batch_id] = record
+            self.next_batch_id = max(self.next_batch_id, record.batch_id + 1)
+        elif change['op'] == 'delete':
+            # The batch's own entries were already removed by waste changes.
+            del self.waste_batches[change['batch_id']]
+            self.waste_records.drop_batch(change['batch_id'])
+
+    def allocate_record_id(self) -> int:
+        record_id = self.next_record_id
+        self.next_record_id += 1
+        return record_id
+
+    def _record_from_row(self, table: str, row: Dict):
+        if table == 'inventory':
+            return InventoryItem.from_csv_row(row)
+        elif table == 'waste':
+            return WasteItem.from_csv_row(row)
+        return WasteBatch.from_csv_row(row, [])
+
+    def take_pending(self) -> List[Dict]:
+        changes, self.pending_ops = self.pending_ops, []
+        return changes
+
+    def save(self, compact=False):
+        changes = self.take_pending()
+        if changes:
+            self.repository.apply(changes)
+        if compact or self.repository.needs_compaction():
+            self.repository.compact(*self.snapshot_rows(), self.repository.loaded_partition_keys())
+        logging.info("Data saved successfully")
+
+    def snapshot_rows(self) -> Tuple[List[Dict], List[Dict], List[Dict]]:
+        return (
+            [item.to_csv_row() for item in self.items],
+            [item.to_csv_row() for item in self.waste_records.values()],
+            [batch.to_csv_row() for batch in self.waste_batches.values()]
+        )
+
+    def capture_snapshot(self) -> RowSnapshot:
+        return RowSnapshot(self)
+
+    def load(self):
+        self.load_items()
+        self.load_history()
+
+    def load_items(self):
+        # First half of load(): the inventory list, which is all the item tab
+        # needs. load_history() must follow before anything is edited or saved.
+        if isinstance(self.repository, SqliteRepository) and self.repository.is_empty():
+            # First run on the database: bring over the existing CSV data.
+            self.load_source = CsvRepository(self.storage, load_error_policy())
+        else:
+            self.load_source = self.repository
+
+        inventory_data, changes = self.load_source.load_items()
+        self.clear()
+        self.snapshot = None
+        if self.load_source is self.repository:
+            fingerprint = self.repository.snapshot_fingerprint()
+            if fingerprint is not None:
+                self.snapshot = read_snapshot(self.storage, fingerprint)
+        if self.snapshot is not None:
+            # The repository's rows are lazy, so leaving them unread costs
+            # nothing; only its journal changes are still needed.
+            inventory_data = self.snapshot[0]['items']
+            logging.info("Loading from snapshot")
+        self.items = [InventoryItem.from_csv_row(row) for row in inventory_data]
+        self.item_columns.reset(self.items)
+        self.expiration_index = ExpirationIndex(self.items)
+        self.item_order = "Expiration" if list(self.expiration_index) == self.items else "Name"
+        self.item_categories = {item.name: item.category for item in self.items}
+        for change in changes:
+            self.apply_change(change)
+
+    def load_history(self):
+        # Second half: waste records and batches. It leaves the items alone,
+        # so the item list can be shown (though not edited) while this runs
+        # on another thread.
+        source = self.load_source
+        waste_data, batch_data, changes = source.load_history()
+        if self.snapshot is not None:
+            meta, blobs = self.snapshot
+            self.snapshot = None
+            self.restore_waste(meta['waste'], blobs)
+            self.next_record_id = meta['next_record_id']
+            loaded = meta['loaded_partitions']
+            source.loaded_partitions = None if loaded is None else set(loaded)
+            waste_data, batch_data = (), meta['batches']
+
+        # Rows go straight into the column store; only rows saved before
+        # record ids existed are held back, to be numbered after the highest
+        # id in file order so every load of the same snapshot agrees.
+        without_ids = []
+        for row in waste_data:
+            item = WasteItem.from_csv_row(row)
+            if item.record_id is None:
+                without_ids.append(item)
+                continue
+            self.waste_records.add(item, self.category_of(item.item))
+            self.next_record_id = max(self.next_record_id, item.record_id + 1)
+        for summary in source.archived_partitions().values():
+            self.next_record_id = max(self.next_record_id, summary['last_record_id'] + 1)
+        for item in without_ids:
+            item.record_id = self.allocate_record_id()
+            self.waste_records.add(item, self.category_of(item.item))
+
+        for position, row in enumerate(batch_data):
+            batch = WasteBatch.from_csv_row(row, [])
+            if batch.batch_id is None:
+                # Older files numbered batches by position.
+                batch.batch_id = position
+            batch.items = self.waste_records.in_batch(batch.batch_id)
+            self.waste_batches[batch.batch_id] = batch
+        self.next_batch_id = max(self.waste_batches, default=-1) + 1
+
+        for change in changes:
+            change = self._replayable(change)
+            if change is not None:
+                self.apply_change(change)
+
+        logging.info(f"Data loaded successfully ({len(changes)} waste and batch journal entries replayed)")
+
+        if source is not self.repository:
+            self.ensure_waste_loaded()
+            self.repository.import_rows(*self.snapshot_rows())
+        self.load_errors = list(source.load_errors)
+        if self.load_errors and source is self.repository:
+            # Rewrite the snapshots without the dropped rows so the files and
+            # the journal agree with what is in memory again.
+            self.save(compact=True)
+
+    def _replayable(self, change: Dict) -> Optional[Dict]:
+        # Loads the archived months a journal change touches. A crash part
+        # way through a compaction can leave waste changes both in a segment
+        # and in the journal; those are dropped rather than applied twice.
+        if change['table'] != 'waste':
+            return change
+        store = self.waste_records
+        if change['op'] == 'delete':
+            if change['record_id'] not in store:
+                self.ensure_waste_loaded()
+            return change if change['record_id'] in store else None
+        rows = [change['row']] if change['op'] == 'insert' else change['rows']
+        self._load_partitions_for(row['date'] for row in rows)
+        rows = [row for row in rows if not row.get('record_id') or int(row['record_id']) not in store]
+        if not rows:
+            return None
+        return change if change['op'] == 'insert' else dict(change, rows=rows)
+
+    def restore_waste(self, meta: Dict, blobs: Dict):
+        self.waste_records = WasteStore.restore(meta, blobs)
+        # Loading from CSV files each record's category from the items as
+        # they are now, so do the same here rather than keep the stored one.
+        store = self.waste_records
+        store.category_names = categories = StringTable()
+        lookup = [categories.encode(self.category_of(name)) for name in store.item_names.values]
+        store.categories = array('i', map(lookup.__getitem__, store.items))
+        store._totals = None
+
+    def check_integrity(self) -> List:
+        # Checksum problems in the stored files (see check_integrity on the
+        # repository), logged and returned. Runs without the key, so a damaged
+        # file shows up before anything tries to decrypt it.
+        try:
+            problems = self.repository.check_integrity()
+        except Exception as e:
+            logging.error(f"Integrity check failed: {str(e)}")
+            return []
+        for problem in problems:
+            logging.warning(f"Integrity check: {problem}")
+        logging.info(f"Integrity check found {len(problems)} problems")
+        return problems
+
+    def save_snapshot(self):
+        # Only valid right after a compaction with nothing pending, when the
+        # repository holds exactly what is in memory. A snapshot only speeds
+        # up the next start, so failing to write one isn't an error.
+        fingerprint = self.repository.snapshot_fingerprint()
+        if fingerprint is None or self.pending_ops:
+            return
+        try:
+            # Archived months read during this session are left out again,
+            # so the next start holds the same months a CSV load would.
+            loaded, min_date = self.repository.loaded_partitions, None
+            if loaded is not None:
+                window = waste_window()
+                loaded = sorted(key for key in loaded if key == UNDATED_PARTITION or key >= window)
+                min_date = partition_bounds(window)[0]
+            waste_meta, blobs = self.waste_records.dump(min_date)
+            meta = {
+                'items': [item.to_csv_row() for item in self.items],
+                'batches': [batch.to_csv_row() for batch in self.waste_batches.values()],
+                'waste': waste_meta,
+                'next_record_id': self.next_record_id,
+                'loaded_partitions': loaded,
+            }
+            write_snapshot(self.storage, fingerprint, meta, blobs)
+        except Exception as e:
+            logging.error(f"Error writing snapshot: {str(e)}")
+
+    def close(self):
+        self.repository.close()
+        self.storage.close()
@@ -0,0 +1,122 @@
+import csv
+import json
+import os
+from typing import Dict, Iterator, List, Tuple
+
+from .core import Inventory, normalize_date
+from .models import InventoryItem, WasteItem
+
+# Header spellings seen on supplier delivery sheets, mapped to our fields.
+# Headers are compared lower-cased with spaces and dashes turned into '_'.
+FIELD_ALIASES = {
+    'item_name': 'name',
+    'product': 'name',
+    'qty': 'quantity',
+    'expiration': 'expiration_date',
+    'expires': 'expiration_date',
+    'best_before': 'expiration_date',
+    'waste_date': 'date',
+}
+
+class ImportReport:
+    def __init__(self, path: str):
+        self.path = path
+        self.imported = 0
+        self.errors: List[Tuple[int, str]] = []
+
+    def summary(self) -> str:
+        return f"Imported {self.imported} rows from {os.path.basename(self.path)}, {len(self.errors)} rejected"
+
+def read_rows(path: str) -> Iterator[Tuple[int, Dict]]:
+    # Yields (line, row). CSV and JSON Lines are read one row at a time; a
+    # .json file holds a single array of objects and is parsed in one go.
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.jsonl', '.ndjson'):
+        with open(path) as f:
+            for line, text in enumerate(f, start=1):
+                if text.strip():
+                    try:
+                        yield line, json.loads(text)
+                    except ValueError as e:
+                        yield line, e
+    elif extension == '.json':
+        with open(path) as f:
+            rows = json.load(f)
+        if not isinstance(rows, list):
+            raise ValueError(f"{path} must contain a JSON array of objects")
+        # Positions are 1-based entry numbers rather than file lines.
+        yield from enumerate(rows, start=1)
+    else:
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            yield from enumerate(csv.DictReader(f), start=2)
+
+def _normalize_keys(row) -> Dict:
+    if isinstance(row, Exception):
+        raise ValueError(f"unreadable row: {row}")
+    if not isinstance(row, dict):
+        raise ValueError("expected an object with named fields")
+    normalized = {}
+    for key, value in row.items():
+        if key is None:
+            # csv.DictReader puts surplus cells under None.
+            continue
+        key = key.strip().lower().replace(' ', '_').replace('-', '_')
+        normalized[FIELD_ALIASES.get(key, key)] = "" if value is None else str(value).strip()
+    return normalized
+
+def _required(row: Dict, field: str) -> str:
+    value = row.get(field, "")
+    if not value:
+        raise ValueError(f"missing {field}")
+    return value
+
+def _quantity(row: Dict, field: str) -> int:
+    value = _required(row, field)
+    try:
+        quantity = int(value)
+    except ValueError:
+        raise ValueError(f"{field} must be a whole number, got {value!r}")
+    if quantity <= 0:
+        raise ValueError(f"{field} must be positive, got {quantity}")
+    return quantity
+
+def _date(row: Dict, field: str) -> str:
+    value = _required(row, field)
+    formatted = normalize_date(value)
+    if not formatted:
+        raise ValueError(f"invalid {field} {value!r}, use MM/DD or MM/DD/YYYY")
+    return formatted
+
+def parse_item_row(row) -> InventoryItem:
+    row = _normalize_keys(row)
+    return InventoryItem(_required(row, 'name'), _quantity(row, 'quantity'),
+                         _date(row, 'expiration_date'), _required(row, 'category'))
+
+def parse_waste_row(row) -> WasteItem:
+    row = _normalize_keys(row)
+    # Waste sheets often reuse the inventory column names.
+    row.setdefault('item', row.get('name', ""))
+    row.setdefault('quantity_wasted', row.get('quantity', ""))
+    return WasteItem(_required(row, 'item'), _quantity(row, 'quantity_wasted'), _date(row, 'date'),
+                     _required(row, 'reason'), row.get('notes', ""))
+
+def import_file(inventory: Inventory, path: str, table: str = 'inventory', dry_run: bool = False) -> ImportReport:
+    # Validates every row first and then adds all the good ones as a single
+    # change, so a delivery sheet costs one sort and one save however long
+    # it is. Rejected rows are listed in the report with their line numbers.
+    parse = parse_item_row if table == 'inventory' else parse_waste_row
+    report = ImportReport(path)
+    records = []
+    for line, row in read_rows(path):
+        try:
+            records.append(parse(row))
+        except ValueError as e:
+            report.errors.append((line, str(e)))
+
+    if not dry_run:
+        if table == 'inventory':
+            inventory.import_items(records)
+        else:
+            inventory.import_waste(records)
+    report.imported = len(records)
+    return report
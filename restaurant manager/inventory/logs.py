@@ -0,0 +1,89 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Iterator, Optional
+
+# Logging goes through a queue: callers on the UI thread only enqueue the
+# record, and one listener thread formats it and writes the file. Each line
+# of the log is a JSON object, so it can be filtered with any JSON tool:
+#
+#   {"time": "2026-10-17T09:30:12.345", "level": "INFO", "thread": "MainThread",
+#    "message": "update_item_list took 3.2 ms", "span": "update_item_list",
+#    "ms": 3.2, "rows": 1200}
+#
+# Spans (see span()) add "span", "ms" and whatever counts they recorded.
+
+LOG_FILE = 'inventory_system.log'
+# The log is rotated at this size, keeping this many old files as .1, .2, ...
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+
+# Attributes every LogRecord has; anything else came in through extra=.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener: Optional[QueueListener] = None
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+class JsonQueueHandler(QueueHandler):
+    # The stock prepare() formats the record with a plain Formatter, which
+    # folds the traceback into the message, and then drops exc_info, so
+    # JsonFormatter never saw it. Only the message is merged here; the
+    # traceback is formatted on the listener thread.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def configure_logging(filename: str = LOG_FILE, level: int = logging.INFO) -> QueueListener:
+    # Sends the root logger through the queue to a rotating JSON file. Only
+    # the first call does anything; the listener is stopped at exit, after
+    # writing whatever is still queued.
+    global _listener
+    if _listener is not None:
+        return _listener
+    file_handler = RotatingFileHandler(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    file_handler.setFormatter(JsonFormatter())
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(JsonQueueHandler(records))
+    _listener = QueueListener(records, file_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+@contextmanager
+def span(name: str, **fields) -> Iterator[Dict]:
+    # Logs how long the block took, with fields and anything the block adds
+    # to the dict it is given, such as a row count. Logged even if the block
+    # raises, with the exception type as 'error'.
+    started = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as e:
+        fields['error'] = type(e).__name__
+        raise
+    finally:
+        ms = round((time.perf_counter() - started) * 1000, 1)
+        logging.info(f"{name} took {ms} ms", extra=dict(fields, span=name, ms=ms))
@@ -0,0 +1,205 @@
+from datetime import date
+import bisect
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+@lru_cache(maxsize=4096)
+def parse_date(date_str: str) -> Optional[Tuple[int, bool]]:
+    # Returns (ordinal, has_year) for MM/DD/YYYY or MM/DD, or None if invalid.
+    # Like strptime, month and day take one or two digits and the year
+    # exactly four, so 01/05/24 is rejected rather than read as year 24.
+    # Dates without a year fall in 1900, the same as strptime would give.
+    parts = date_str.split('/')
+    if len(parts) not in (2, 3) or not all(part.isascii() and part.isdigit() for part in parts):
+        return None
+    if len(parts[0]) > 2 or len(parts[1]) > 2 or (len(parts) == 3 and len(parts[2]) != 4):
+        return None
+    try:
+        year = int(parts[2]) if len(parts) == 3 else 1900
+        return date(year, int(parts[0]), int(parts[1])).toordinal(), len(parts) == 3
+    except ValueError:
+        return None
+
+def format_date(ordinal: int, has_year: bool) -> str:
+    return date.fromordinal(ordinal).strftime("%m/%d/%Y" if has_year else "%m/%d")
+
+def _date_ordinal(date_str: str) -> Optional[int]:
+    parsed = parse_date(date_str)
+    return parsed[0] if parsed else None
+
+class InventoryItem:
+    def __init__(self, name: str, quantity: int, expiration_date: str, category: str):
+        self.name = name
+        self.quantity = quantity
+        self.expiration_date = expiration_date
+        self.category = category
+
+    @property
+    def expiration_date(self) -> str:
+        if self.expiration_ordinal is None:
+            return self._expiration_text
+        return format_date(self.expiration_ordinal, self.expiration_has_year)
+
+    @expiration_date.setter
+    def expiration_date(self, value: str):
+        parsed = parse_date(value)
+        self.expiration_ordinal, self.expiration_has_year = parsed if parsed else (None, False)
+        self._expiration_text = None if parsed else value
+
+    @property
+    def expiration_key(self) -> Tuple:
+        # Total order used for "sort by expiration"; the remaining fields only
+        # break ties, so rows that compare equal are interchangeable.
+        return (self.expiration_ordinal or 0, self.name, self.category, self.quantity)
+
+    @classmethod
+    def from_csv_row(cls, row: Dict) -> 'InventoryItem':
+        return cls(row['name'], int(row['quantity']), row['expiration_date'], row['category'])
+
+    def to_csv_row(self) -> Dict:
+        return {
+            'name': self.name,
+            'quantity': str(self.quantity),
+            'expiration_date': self.expiration_date,
+            'category': self.category
+        }
+
+class WasteBatch:
+    def __init__(self, batch_date, items, total_waste, notes, batch_id=None):
+        self.batch_date = batch_date
+        self.items = items
+        self.total_waste = total_waste
+        self.notes = notes
+        self.batch_id = batch_id
+
+    @classmethod
+    def from_csv_row(cls, row, items):
+        batch_id = int(row['batch_id']) if row.get('batch_id') else None
+        return cls(row['batch_date'], items, int(row['total_waste']), row['notes'], batch_id)
+
+    def to_csv_row(self):
+        return {
+            'batch_date': self.batch_date,
+            'total_waste': str(self.total_waste),
+            'notes': self.notes,
+            'batch_id': str(self.batch_id) if self.batch_id is not None else ''
+        }
+
+class WasteItem:
+    def __init__(self, item, quantity_wasted, date, reason, notes, batch_id=None, record_id=None):
+        self.item = item
+        self.quantity_wasted = quantity_wasted
+        self.date = date
+        self.reason = reason
+        self.notes = notes
+        self.batch_id = batch_id
+        self.record_id = record_id
+
+    @property
+    def date(self) -> str:
+        if self.date_ordinal is None:
+            return self._date_text
+        return format_date(self.date_ordinal, self.date_has_year)
+
+    @date.setter
+    def date(self, value: str):
+        # Batch entries can be created before the batch date is filled in, so
+        # unparseable text is kept as-is rather than rejected.
+        parsed = parse_date(value)
+        self.date_ordinal, self.date_has_year = parsed if parsed else (None, False)
+        self._date_text = None if parsed else value
+
+    @classmethod
+    def from_csv_row(cls, row):
+        batch_id = int(row['batch_id']) if row['batch_id'] else None
+        record_id = int(row['record_id']) if row.get('record_id') else None
+        return cls(
+            row['item'],
+            int(row['quantity_wasted']),
+            row['date'],
+            row['reason'],
+            row['notes'],
+            batch_id,
+            record_id
+        )
+
+    def to_csv_row(self):
+        return {
+            'item': self.item,
+            'quantity_wasted': str(self.quantity_wasted),
+            'date': self.date,
+            'reason': self.reason,
+            'notes': self.notes,
+            'batch_id': str(self.batch_id) if self.batch_id is not None else '',
+            'record_id': str(self.record_id) if self.record_id is not None else ''
+        }
+
+class ExpirationIndex:
+    # Inventory items ordered by expiration_key, kept in short sorted buckets
+    # so inserts, removals and range lookups only bisect and shift one bucket.
+
+    BUCKET_SIZE = 512
+
+    def __init__(self, items=()):
+        entries = sorted(self._entry(item) for item in items)
+        self.buckets = [entries[i:i + self.BUCKET_SIZE] for i in range(0, len(entries), self.BUCKET_SIZE)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.length = len(entries)
+
+    def _entry(self, item: InventoryItem) -> Tuple:
+        # id() only separates identical rows; it is never compared beyond that.
+        return (item.expiration_key, id(item), item)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            for entry in bucket:
+                yield entry[2]
+
+    def add(self, item: InventoryItem):
+        entry = self._entry(item)
+        if not self.buckets:
+            self.buckets.append([entry])
+            self.maxes.append(entry)
+        else:
+            pos = min(bisect.bisect_left(self.maxes, entry), len(self.buckets) - 1)
+            bucket = self.buckets[pos]
+            bisect.insort(bucket, entry)
+            self.maxes[pos] = bucket[-1]
+            if len(bucket) > 2 * self.BUCKET_SIZE:
+                self.buckets[pos:pos + 1] = [bucket[:self.BUCKET_SIZE], bucket[self.BUCKET_SIZE:]]
+                self.maxes[pos:pos + 1] = [bucket[self.BUCKET_SIZE - 1], bucket[-1]]
+        self.length += 1
+
+    def remove(self, item: InventoryItem):
+        entry = self._entry(item)
+        pos = bisect.bisect_left(self.maxes, entry)
+        bucket = self.buckets[pos]
+        del bucket[bisect.bisect_left(bucket, entry)]
+        if bucket:
+            self.maxes[pos] = bucket[-1]
+        else:
+            del self.buckets[pos]
+            del self.maxes[pos]
+        self.length -= 1
+
+    def rank(self, item: InventoryItem) -> int:
+        # Number of indexed items that sort before item.
+        entry = self._entry(item)
+        pos = bisect.bisect_left(self.maxes, entry)
+        before = sum(len(bucket) for bucket in self.buckets[:pos])
+        if pos < len(self.buckets):
+            before += bisect.bisect_left(self.buckets[pos], entry)
+        return before
+
+    def irange(self, first_ordinal: int, last_ordinal: int):
+        # Items expiring on any day from first_ordinal to last_ordinal inclusive.
+        low = ((first_ordinal,),)
+        pos = bisect.bisect_left(self.maxes, low)
+        for bucket in self.buckets[pos:]:
+            for entry in bucket[bisect.bisect_left(bucket, low):]:
+                if entry[0][0] > last_ordinal:
+                    return
+                yield entry[2]
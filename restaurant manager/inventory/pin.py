@@ -0,0 +1,132 @@
+import hashlib
+import hmac
+import logging
+import os
+import time
+from typing import Tuple
+
+# PIN hashes are stored as '$'-separated fields: the scheme, its cost
+# parameters, then the hex salt and hex digest, for example
+# scrypt$16384$8$1$<salt>$<digest>. A bare 64-character hex string is the
+# unsalted SHA-256 of earlier versions; it is still accepted so existing PINs
+# keep working, and replaced on the next successful login.
+
+SALT_BYTES = 16
+DIGEST_BYTES = 32
+
+# Around 50 ms and 16 MB per verify on a typical laptop. calibrate() finds
+# the cost for a given latency on this machine.
+DEFAULT_SCRYPT_COST = (2 ** 14, 8, 1)
+DEFAULT_PBKDF2_COST = (600_000,)
+
+# scrypt comes from OpenSSL and is missing from some Python builds; PBKDF2
+# is always there.
+HAS_SCRYPT = hasattr(hashlib, 'scrypt')
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logging.warning(f"Invalid {name} '{value}', using {default}")
+        return default
+
+def pin_parameters() -> Tuple[str, Tuple[int, ...]]:
+    # Scheme and cost for new hashes: PIN_SCRYPT_N, PIN_SCRYPT_R and
+    # PIN_SCRYPT_P, or PIN_PBKDF2_ITERATIONS where scrypt isn't available.
+    if not HAS_SCRYPT:
+        return 'pbkdf2_sha256', (max(1, _env_int("PIN_PBKDF2_ITERATIONS", DEFAULT_PBKDF2_COST[0])),)
+    n = _env_int("PIN_SCRYPT_N", DEFAULT_SCRYPT_COST[0])
+    if n < 2 or n & (n - 1):
+        logging.warning(f"PIN_SCRYPT_N must be a power of two above 1, using {DEFAULT_SCRYPT_COST[0]}")
+        n = DEFAULT_SCRYPT_COST[0]
+    return 'scrypt', (n, max(1, _env_int("PIN_SCRYPT_R", DEFAULT_SCRYPT_COST[1])),
+                      max(1, _env_int("PIN_SCRYPT_P", DEFAULT_SCRYPT_COST[2])))
+
+def derive(pin: str, salt: bytes, scheme: str, cost: Tuple[int, ...]) -> bytes:
+    if scheme == 'scrypt':
+        n, r, p = cost
+        # OpenSSL refuses anything over 32 MB unless told otherwise; scrypt
+        # needs 128 * n * r bytes plus 128 * r * p for the parallel lanes.
+        maxmem = 128 * r * (n + p) + (1 << 20)
+        return hashlib.scrypt(pin.encode(), salt=salt, n=n, r=r, p=p, maxmem=maxmem, dklen=DIGEST_BYTES)
+    elif scheme == 'pbkdf2_sha256':
+        return hashlib.pbkdf2_hmac('sha256', pin.encode(), salt, cost[0], dklen=DIGEST_BYTES)
+    raise ValueError(f"Unknown PIN hash scheme {scheme!r}")
+
+def hash_pin(pin: str, scheme: str = None, cost: Tuple[int, ...] = None) -> str:
+    if scheme is None:
+        scheme, cost = pin_parameters()
+    salt = os.urandom(SALT_BYTES)
+    fields = [scheme, *map(str, cost), salt.hex(), derive(pin, salt, scheme, cost).hex()]
+    return '$'.join(fields)
+
+def parse_pin_hash(stored: str) -> Tuple[str, Tuple[int, ...], bytes, bytes]:
+    # (scheme, cost, salt, digest); raises ValueError for anything else.
+    if len(stored) == 64 and '$' not in stored:
+        return 'sha256', (), b'', bytes.fromhex(stored)
+    scheme, *cost, salt, digest = stored.split('$')
+    return scheme, tuple(int(value) for value in cost), bytes.fromhex(salt), bytes.fromhex(digest)
+
+def verify_pin_hash(pin: str, stored: str) -> bool:
+    try:
+        scheme, cost, salt, digest = parse_pin_hash(stored)
+        if scheme == 'sha256':
+            candidate = hashlib.sha256(pin.encode()).digest()
+        else:
+            candidate = derive(pin, salt, scheme, cost)
+    except ValueError as e:
+        logging.error(f"Stored PIN hash is unreadable: {e}")
+        return False
+    return hmac.compare_digest(candidate, digest)
+
+def needs_rehash(stored: str) -> bool:
+    # True when stored wasn't made with the current scheme and cost, so the
+    # PIN should be hashed again while it is known after a good login.
+    try:
+        scheme, cost, _, _ = parse_pin_hash(stored)
+    except ValueError:
+        return False
+    return (scheme, cost) != pin_parameters()
+
+def time_derive(scheme: str, cost: Tuple[int, ...], repeat: int = 3) -> float:
+    # Best of repeat runs, in seconds.
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        derive("0000", b'\0' * SALT_BYTES, scheme, cost)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def calibrate(target_seconds: float, scheme: str = None, report=None) -> Tuple[int, ...]:
+    # The cost whose verify time on this machine is closest to target_seconds.
+    # scrypt doubles n (memory and time together) with r and p fixed at the
+    # configured values; PBKDF2 scales its iteration count. report, if given,
+    # is called with each (cost, seconds) tried.
+    scheme = scheme or pin_parameters()[0]
+    if scheme == 'pbkdf2_sha256':
+        probe = (100_000,)
+        seconds = time_derive(scheme, probe)
+        if report:
+            report(probe, seconds)
+        return (max(1, round(probe[0] * target_seconds / seconds)),)
+
+    _, r, p = pin_parameters()[1] if HAS_SCRYPT else DEFAULT_SCRYPT_COST
+    best, best_error = None, float('inf')
+    n, seconds = 2 ** 10, 0.0
+    # 2 ** 20 with r = 8 is already 1 GB per verify.
+    while n <= 2 ** 20:
+        cost = (n, r, p)
+        # Slow settings are timed once; noise matters less at that scale.
+        seconds = time_derive(scheme, cost, repeat=3 if seconds < 0.1 else 1)
+        if report:
+            report(cost, seconds)
+        error = abs(seconds - target_seconds)
+        if error < best_error:
+            best, best_error = cost, error
+        if seconds >= target_seconds:
+            break
+        n *= 2
+    return best
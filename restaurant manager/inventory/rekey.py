@@ -0,0 +1,313 @@
+import json
+import logging
+import os
+import threading
+from contextlib import nullcontext
+from typing import Callable, Dict, List, Optional
+
+from .snapshot import SNAPSHOT_FILE, rekey_snapshot
+from .storage import (SECURE_CSV_MAGIC, SECURE_CSV_V2_MAGIC, SECURE_CSV_END, atomic_write, frame_token,
+                      quarantine_files, replace_file, unframe_token)
+
+# Moves everything stored under older keys onto the current one after
+# SecureStorage.rotate_key(). Until the job is done the files hold a mix of
+# old and new tokens, which reads accept as long as the old keys are in the
+# keyring, so the app keeps working while it runs.
+#
+# Files are rewritten one line at a time (a chunk of rows, a journal entry)
+# into <file>.rekey, which then replaces the original, so memory stays at one
+# chunk however big the file. SQLite rows go a few hundred per transaction.
+# Progress is checkpointed to REKEY_STATE_FILE, so a job that is stopped or
+# killed resumes from its last checkpoint, even halfway through a file. A
+# file the app replaces or appends to while it is being rewritten is done
+# again from the start.
+
+REKEY_STATE_FILE = '.rekey_state'
+# Lines or SQLite rows between checkpoints.
+REKEY_CHECKPOINT_LINES = 200
+REKEY_SQLITE_ROWS = 500
+# After this many attempts that lost a race with the app, a file is rewritten
+# holding the storage write lock throughout.
+REKEY_ATTEMPTS = 3
+
+def rekey_pending() -> bool:
+    # True when a job was started and hasn't finished.
+    return os.path.exists(REKEY_STATE_FILE)
+
+def _stat(filename: str) -> List[int]:
+    # Changes whenever the file is replaced or written to.
+    stat = os.stat(filename)
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+class RekeyJob:
+    def __init__(self, storage, repository, progress: Optional[Callable[[int, int, str], None]] = None):
+        # progress, if given, is called as progress(done, total, filename)
+        # with done and total in bytes of ciphertext, from the job's thread.
+        self.storage = storage
+        self.repository = repository
+        self.progress = progress
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.finished = False
+        self.error = None
+        # Tokens no key could decrypt; they are left as they were.
+        self.unreadable = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run_in_background, name="rekey", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Asks the job to checkpoint where it is, and waits for it.
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def _run_in_background(self):
+        try:
+            self.run()
+        except Exception as e:
+            self.error = e
+            logging.error(f"Re-encryption stopped: {type(e).__name__}: {e}")
+
+    def run(self) -> bool:
+        # True once everything is under the current key, False if stopped
+        # first.
+        state = self._read_state()
+        if state is None or state['version'] != self.storage.key_version:
+            state = {'version': self.storage.key_version, 'done': [], 'current': None, 'replaced': []}
+            self._save_state(state)
+
+        steps = [(filename, kind) for filename, kind in self.repository.encrypted_files()]
+        steps += [(filename, 'quarantine') for filename in quarantine_files()]
+        sizes = {filename: os.path.getsize(filename) for filename, _ in steps}
+        tables = self.repository.encrypted_tables()
+        steps += [(table, 'table') for table in tables]
+        sizes.update(tables)
+        # Last, so it can follow what happened to the data files.
+        if os.path.exists(SNAPSHOT_FILE):
+            steps.append((SNAPSHOT_FILE, 'snapshot'))
+            sizes[SNAPSHOT_FILE] = os.path.getsize(SNAPSHOT_FILE)
+
+        steps = [(name, kind) for name, kind in steps if f"{kind}:{name}" not in state['done']]
+        self.total = sum(sizes[name] for name, _ in steps)
+        self.done = 0
+        logging.info(f"Re-encrypting {len(steps)} files and tables ({self.total} bytes) "
+                     f"with key version {state['version']}")
+        for name, kind in steps:
+            if not self._rekey(name, kind, state):
+                logging.info(f"Re-encryption paused in {name}")
+                return False
+            self.done += sizes[name]
+            state['done'].append(f"{kind}:{name}")
+            state['current'] = None
+            self._save_state(state)
+            self._report(name)
+
+        os.remove(REKEY_STATE_FILE)
+        self.finished = True
+        logging.info(f"All data re-encrypted with key version {state['version']}"
+                     + (f", {self.unreadable} unreadable tokens left as they were" if self.unreadable else ""))
+        return True
+
+    def _report(self, name: str, extra: int = 0):
+        if self.progress:
+            self.progress(min(self.done + extra, self.total), self.total, name)
+
+    def _read_state(self) -> Optional[Dict]:
+        try:
+            with open(REKEY_STATE_FILE) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logging.warning(f"Ignoring unreadable {REKEY_STATE_FILE}, starting the re-encryption over")
+            return None
+
+    def _save_state(self, state: Dict):
+        with atomic_write(REKEY_STATE_FILE) as f:
+            json.dump(state, f)
+
+    def _rekey(self, name: str, kind: str, state: Dict) -> bool:
+        if kind == 'table':
+            return self._rekey_table(name, state)
+        elif kind == 'snapshot':
+            rekey_snapshot(self.storage, lambda entry: self._translate(entry, state))
+            return True
+        elif kind in ('token', 'quarantine'):
+            # Small enough to do in one go.
+            with self.storage.write_lock:
+                self._rewrite_whole(name, kind, state)
+            return True
+
+        for attempt in range(1, REKEY_ATTEMPTS + 1):
+            with self.storage.write_lock if attempt == REKEY_ATTEMPTS else nullcontext():
+                result = self._rekey_lines(name, kind, state)
+            if result is not None:
+                return result
+            logging.info(f"{name} changed while being re-encrypted, starting it again")
+            state['current'] = None
+        raise RuntimeError(f"{name} kept changing while being re-encrypted")
+
+    def _rotate(self, token: bytes) -> bytes:
+        from cryptography.fernet import InvalidToken
+        try:
+            return self.storage.rotate_token(token)
+        except InvalidToken:
+            self.unreadable += 1
+            return token
+
+    def _rotate_framed(self, line: str) -> str:
+        # A damaged chunk line. The checksum may be what was damaged, so the
+        # token is still tried; if no key reads it the line stays as it was.
+        token, _ = unframe_token(line)
+        unreadable = self.unreadable
+        rotated = self._rotate(token.encode()).decode()
+        return line if self.unreadable > unreadable else frame_token(rotated)
+
+    def _rekey_line(self, line: bytes, legacy: bool) -> bytes:
+        body = line.rstrip(b'\r\n')
+        if not body or body.startswith(SECURE_CSV_END.encode() + b' '):
+            return line
+        if legacy:
+            # One token per cell; tokens never contain commas or quotes.
+            rotated = b','.join(self._rotate(cell) if cell else cell for cell in body.split(b','))
+        elif b' ' in body:
+            token, intact = unframe_token(body.decode())
+            if not intact:
+                # Damaged already; leave it for the load to report.
+                self.unreadable += 1
+                return line
+            rotated = frame_token(self._rotate(token.encode()).decode()).encode()
+        else:
+            rotated = self._rotate(body)
+        return rotated + line[len(body):]
+
+    def _rekey_lines(self, filename: str, kind: str, state: Dict) -> Optional[bool]:
+        # Streams filename into its .rekey copy and swaps it in. False when
+        # stopped (with a checkpoint to resume from), None when the app
+        # changed the file meanwhile.
+        try:
+            stat = _stat(filename)
+        except FileNotFoundError:
+            return True
+        step = f"{kind}:{filename}"
+        temp_file = f"{filename}.rekey"
+        current = state['current']
+        read = written = 0
+        if current and current['step'] == step and current['stat'] == stat \
+                and os.path.exists(temp_file) and os.path.getsize(temp_file) >= current['written']:
+            read, written = current['read'], current['written']
+
+        with open(filename, 'rb') as source, open(temp_file, 'r+b' if written else 'wb') as target:
+            # Secure CSVs start with a plain header line; without the magic
+            # it is the header row of the old per-cell layout.
+            first = source.readline()
+            legacy = kind == 'csv' and not first.startswith((SECURE_CSV_MAGIC.encode(), SECURE_CSV_V2_MAGIC.encode()))
+            if kind == 'journal':
+                source.seek(0)
+            elif not written:
+                target.write(first)
+            if written:
+                source.seek(read)
+                target.seek(written)
+                target.truncate()
+
+            lines = 0
+            for line in iter(source.readline, b''):
+                target.write(self._rekey_line(line, legacy))
+                lines += 1
+                if lines % REKEY_CHECKPOINT_LINES == 0:
+                    target.flush()
+                    os.fsync(target.fileno())
+                    state['current'] = {'step': step, 'stat': stat, 'read': source.tell(), 'written': target.tell()}
+                    self._save_state(state)
+                    self._report(filename, source.tell())
+                    if self.stop_event.is_set():
+                        return False
+            target.flush()
+            os.fsync(target.fileno())
+
+        with self.storage.write_lock:
+            try:
+                unchanged = _stat(filename) == stat
+            except FileNotFoundError:
+                # Compaction removed it; nothing left to move.
+                os.remove(temp_file)
+                return True
+            if not unchanged:
+                os.remove(temp_file)
+                return None
+            self._replace(temp_file, filename, state)
+        return True
+
+    def _rewrite_whole(self, filename: str, kind: str, state: Dict):
+        try:
+            with open(filename, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return
+        if kind == 'token':
+            token, intact = unframe_token(content.decode().strip())
+            if not intact:
+                self.unreadable += 1
+                return
+            content = frame_token(self._rotate(token.encode()).decode()).encode() + b'\n'
+        else:
+            # Quarantined entries keep their data encrypted: a chunk token,
+            # framed if it failed its checksum, or for the old per-cell layout
+            # a JSON object of cell tokens. Truncation entries have none.
+            lines = []
+            for line in content.splitlines():
+                entry = json.loads(line)
+                if entry['data'].startswith('{'):
+                    cells = json.loads(entry['data'])
+                    entry['data'] = json.dumps({field: self._rotate(token.encode()).decode()
+                                                for field, token in cells.items()})
+                elif ' ' in entry['data']:
+                    entry['data'] = self._rotate_framed(entry['data'])
+                elif entry['data']:
+                    entry['data'] = self._rotate(entry['data'].encode()).decode()
+                lines.append(json.dumps(entry).encode())
+            content = b''.join(line + b'\n' for line in lines)
+        temp_file = f"{filename}.rekey"
+        with open(temp_file, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        self._replace(temp_file, filename, state)
+
+    def _replace(self, temp_file: str, filename: str, state: Dict):
+        # Called with the write lock held. Remembers how the file's snapshot
+        # fingerprint entry changed, for _translate.
+        before = os.stat(filename)
+        replace_file(temp_file, filename)
+        after = os.stat(filename)
+        state['replaced'].append([[before.st_size, before.st_mtime_ns], [after.st_size, after.st_mtime_ns]])
+        self._save_state(state)
+
+    def _translate(self, entry, state: Dict):
+        for before, after in state['replaced']:
+            if entry == before:
+                entry = after
+        return entry
+
+    def _rekey_table(self, table: str, state: Dict) -> bool:
+        step = f"table:{table}"
+        current = state['current']
+        after_id = current['after'] if current and current['step'] == step else 0
+        progress = 0
+        while True:
+            result = self.repository.rekey_rows(table, after_id, REKEY_SQLITE_ROWS)
+            if result is None:
+                return True
+            after_id, size = result
+            progress += size
+            state['current'] = {'step': step, 'after': after_id}
+            self._save_state(state)
+            self._report(table, progress)
+            if self.stop_event.is_set():
+                return False
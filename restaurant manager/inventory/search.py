@@ -0,0 +1,113 @@
+import bisect
+import threading
+from array import array
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Set
+
+from .waste_store import StringTable
+
+def trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class NameIndex:
+    # Finds the names containing a piece of text, ignoring case. Only distinct
+    # names are indexed, so the index stays small however many records share
+    # a name; callers map the matching names back to their records.
+    #
+    # Queries of three or more characters intersect trigram posting sets and
+    # then confirm the substring. Shorter ones would match nearly every
+    # trigram, so they look up word prefixes in a sorted word list instead;
+    # the list is re-sorted on the first short query after new words arrive.
+    #
+    # sync and match hold a lock, so the index can be built on a background
+    # thread while searches keep coming from the UI.
+
+    def __init__(self):
+        self.names: Set[str] = set()
+        self.trigrams: Dict[str, Set[str]] = defaultdict(set)
+        self.words: List[str] = []
+        self.words_sorted = True
+        self.word_names: Dict[str, Set[str]] = defaultdict(set)
+        self.synced = 0
+        self.lock = threading.Lock()
+
+    def add(self, name: str):
+        if name in self.names:
+            return
+        self.names.add(name)
+        folded = name.casefold()
+        for trigram in trigrams(folded):
+            self.trigrams[trigram].add(name)
+        for word in set(folded.split()):
+            if word not in self.word_names:
+                self.words.append(word)
+                self.words_sorted = False
+            self.word_names[word].add(name)
+
+    def sync(self, names: Sequence[str]):
+        # Indexes what was appended to names since the last sync; for sources
+        # that only ever grow, like a StringTable.
+        with self.lock:
+            for name in names[self.synced:]:
+                self.add(name)
+            self.synced = len(names)
+
+    def match(self, text: str) -> Set[str]:
+        with self.lock:
+            return self._match(text.strip().casefold())
+
+    def _match(self, text: str) -> Set[str]:
+        if not text:
+            return set(self.names)
+
+        if len(text) < 3:
+            if not self.words_sorted:
+                self.words.sort()
+                self.words_sorted = True
+            matches = set()
+            position = bisect.bisect_left(self.words, text)
+            while position < len(self.words) and self.words[position].startswith(text):
+                matches |= self.word_names[self.words[position]]
+                position += 1
+            return matches
+
+        postings = sorted((self.trigrams.get(trigram, set()) for trigram in trigrams(text)), key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        return {name for name in candidates if text in name.casefold()}
+
+class ItemColumns:
+    # The name and category of every inventory item, dictionary-encoded and
+    # kept in list order alongside Inventory.items. Filtering then takes one
+    # numpy pass over two int arrays instead of a visit to every item object.
+
+    def __init__(self, items: Iterable = ()):
+        self.names = StringTable()
+        self.categories = StringTable()
+        self.reset(items)
+
+    def reset(self, items: Iterable):
+        self.name_codes = array('i')
+        self.category_codes = array('i')
+        for item in items:
+            self.name_codes.append(self.names.encode(item.name))
+            self.category_codes.append(self.categories.encode(item.category))
+
+    def insert(self, index: int, item):
+        self.name_codes.insert(index, self.names.encode(item.name))
+        self.category_codes.insert(index, self.categories.encode(item.category))
+
+    def delete(self, index: int):
+        del self.name_codes[index]
+        del self.category_codes[index]
+
+    def positions(self, names: Optional[Set[str]] = None, category: Optional[str] = None) -> List[int]:
+        # List positions of the items with one of names (None for any name)
+        # and in category (None for any category).
+        import numpy as np
+        mask = np.ones(len(self.name_codes), dtype=bool)
+        if names is not None:
+            codes = [self.names.codes[name] for name in names if name in self.names.codes]
+            mask &= np.isin(np.frombuffer(self.name_codes, dtype=np.int32), codes)
+        if category is not None:
+            mask &= np.frombuffer(self.category_codes, dtype=np.int32) == self.categories.codes.get(category, -1)
+        return np.flatnonzero(mask).tolist()
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import struct
+import sys
+import zlib
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from .storage import atomic_write, block_checksum
+
+# The whole in-memory state in one encrypted file, written on clean shutdown
+# so the next start can skip parsing every CSV row. Layout:
+#
+#   INVSNAP <header JSON>\n
+#   <Fernet token of the zlib-compressed payload>
+#
+# The header is plaintext and only says which version and machine layout
+# wrote the file, which repository state it was taken from and the CRC-32 of
+# the token. The payload is
+# an 8-byte length, a JSON section, then the raw blobs the JSON lists by name
+# and length. Any mismatch or damage just means loading from the CSVs.
+
+SNAPSHOT_FILE = 'inventory.snapshot'
+SNAPSHOT_MAGIC = b'INVSNAP'
+SNAPSHOT_VERSION = 2
+# Fast levels compress these columns almost as well as the slow ones.
+SNAPSHOT_COMPRESSION = 1
+
+def _layout() -> Dict:
+    return {'byteorder': sys.byteorder, 'int_size': array('i').itemsize}
+
+def write_snapshot(storage, fingerprint: List, meta: Dict, blobs: Dict[str, bytes], filename: str = SNAPSHOT_FILE):
+    names = list(blobs)
+    section = json.dumps(dict(meta, blobs=[[name, len(blobs[name])] for name in names])).encode()
+    payload = b''.join([struct.pack('<Q', len(section)), section] + [blobs[name] for name in names])
+    compressed = zlib.compress(payload, SNAPSHOT_COMPRESSION)
+    header = dict(_layout(), version=SNAPSHOT_VERSION, fingerprint=fingerprint)
+    with storage.write_lock:
+        token = storage.encrypt_bytes(compressed)
+        _write(filename, header, token)
+    logging.info(f"Wrote snapshot {filename} ({len(token)} bytes)")
+
+def _write(filename: str, header: Dict, token: bytes):
+    header['checksum'] = block_checksum(token)
+    with atomic_write(filename, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + b' ' + json.dumps(header).encode() + b'\n')
+        f.write(token)
+
+def rekey_snapshot(storage, translate, filename: str = SNAPSHOT_FILE) -> bool:
+    # Re-encrypts the snapshot under the current key. translate maps each
+    # fingerprint entry to what it became when the rekey job rewrote that
+    # data file, so a snapshot that matched the files still does. False if
+    # there was nothing readable to rekey.
+    with storage.write_lock:
+        try:
+            with open(filename, 'rb') as f:
+                header = f.readline()
+                if not header.startswith(SNAPSHOT_MAGIC + b' '):
+                    return False
+                header = json.loads(header[len(SNAPSHOT_MAGIC) + 1:])
+                header['fingerprint'] = [translate(entry) for entry in header['fingerprint']]
+                token = storage.rotate_token(f.read())
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            # It would be ignored at the next start anyway.
+            logging.warning(f"Removing unreadable snapshot {filename}: {type(e).__name__}: {e}")
+            os.remove(filename)
+            return False
+        _write(filename, header, token)
+    return True
+
+def read_snapshot(storage, fingerprint: List, filename: str = SNAPSHOT_FILE) -> Optional[Tuple[Dict, Dict[str, bytes]]]:
+    # (meta, blobs) as passed to write_snapshot, or None when there is no
+    # snapshot for exactly this repository state.
+    try:
+        with open(filename, 'rb') as f:
+            header = f.readline()
+            if not header.startswith(SNAPSHOT_MAGIC + b' '):
+                logging.warning(f"{filename} is not a snapshot, ignoring it")
+                return None
+            header = json.loads(header[len(SNAPSHOT_MAGIC) + 1:])
+            if header.get('version') != SNAPSHOT_VERSION or any(header.get(key) != value
+                                                                 for key, value in _layout().items()):
+                logging.info(f"{filename} was written by another version or machine, loading from CSV")
+                return None
+            if header.get('fingerprint') != fingerprint:
+                logging.info(f"{filename} is older than the data files, loading from CSV")
+                return None
+            token = f.read()
+            if header.get('checksum') != block_checksum(token):
+                logging.warning(f"{filename} is damaged (checksum mismatch), loading from CSV")
+                return None
+            payload = zlib.decompress(storage.decrypt_bytes(token))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable snapshot {filename}: {type(e).__name__}: {e}")
+        return None
+
+    length, = struct.unpack_from('<Q', payload)
+    meta = json.loads(payload[8:8 + length])
+    blobs = {}
+    position = 8 + length
+    view = memoryview(payload)
+    for name, size in meta.pop('blobs'):
+        blobs[name] = view[position:position + size]
+        position += size
+    return meta, blobs
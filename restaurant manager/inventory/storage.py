@@ -0,0 +1,1359 @@
+import csv
+import os
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, date
+from typing import Iterable, Iterator, List, Dict, Optional, Set, Tuple
+
+from .logs import span
+from .models import InventoryItem, _date_ordinal, parse_date
+
+# Files starting with this line hold whole chunks of rows in one Fernet token
+# each; anything else is read as the old one-token-per-cell layout. Each
+# chunk line starts with a CRC-32 of its token, and an END line after the
+# last gives the chunk count and a CRC-32 of the header line, so damage and
+# truncation can be found without the key. Version 2 files have neither and
+# are rewritten as version 3 on their next save.
+SECURE_CSV_MAGIC = 'SECURECSV/3'
+SECURE_CSV_V2_MAGIC = 'SECURECSV/2'
+SECURE_CSV_END = 'END'
+SECURE_CSV_CHUNK_ROWS = 1000
+# With a process pool, chunks are handed out this many per worker at a time
+# so memory stays bounded on large files.
+CRYPTO_WINDOW_CHUNKS = 4
+
+JOURNAL_FILE = 'inventory.journal'
+JOURNAL_COMPACT_OPS = 1000
+
+INVENTORY_FIELDS = ['name', 'quantity', 'expiration_date', 'category']
+WASTE_FIELDS = ['item', 'quantity_wasted', 'date', 'reason', 'notes', 'batch_id', 'record_id']
+BATCH_FIELDS = ['batch_date', 'total_waste', 'notes', 'batch_id']
+
+INVENTORY_FILE = 'inventory.csv'
+WASTE_FILE = 'waste.csv'
+BATCH_FILE = 'waste_batches.csv'
+SQLITE_FILE = 'inventory.db'
+
+# The CSV backend keeps waste records in one file per month of waste date,
+# plus a manifest with each month's totals. Records without a full date go
+# in the undated partition.
+WASTE_DIR = 'waste'
+WASTE_MANIFEST = os.path.join(WASTE_DIR, 'manifest')
+UNDATED_PARTITION = 'undated'
+# Months of waste, counting the current one, read at start; older months are
+# only read when a query reaches back into them.
+DEFAULT_WASTE_MONTHS = 3
+
+# What iter_secure_csv does with a chunk or row it can't decrypt or parse:
+# raise, log and drop it, or log it and move its encrypted text into
+# <file>.quarantine for later recovery.
+LOAD_ERROR_POLICIES = ('fail', 'skip', 'quarantine')
+
+class SecureCsvError(Exception):
+    def __init__(self, filename: str, line: int, reason: str):
+        super().__init__(f"{filename} line {line}: {reason}")
+        self.filename = filename
+        self.line = line
+        self.reason = reason
+
+# Pool workers build their own cipher once, from the keys passed at start-up.
+_worker_cipher = None
+
+def _init_crypto_worker(keys: List[bytes]):
+    global _worker_cipher
+    from cryptography.fernet import Fernet, MultiFernet
+    _worker_cipher = MultiFernet([Fernet(key) for key in keys])
+
+def _encrypt_chunk(text: str) -> str:
+    return _worker_cipher.encrypt(text.encode()).decode()
+
+def _decrypt_chunk(token: str) -> Tuple[Optional[str], Optional[str]]:
+    # Failures come back as values so one bad chunk doesn't abort the map.
+    try:
+        return _worker_cipher.decrypt(token.encode()).decode(), None
+    except Exception as e:
+        return None, type(e).__name__
+
+def block_checksum(data) -> str:
+    # CRC-32 of a token or header line, as 8 hex digits. It only catches
+    # accidental damage; Fernet's HMAC still guards against tampering.
+    if isinstance(data, str):
+        data = data.encode()
+    return f"{zlib.crc32(data):08x}"
+
+def frame_token(token: str) -> str:
+    return f"{block_checksum(token)} {token}"
+
+def unframe_token(line: str) -> Tuple[str, bool]:
+    # (token, checksum matched) for a framed line. A bare token, as written
+    # before checksums, counts as matching.
+    checksum, separator, token = line.partition(' ')
+    if not separator:
+        return line, True
+    return token, checksum == block_checksum(token)
+
+def fsync_directory(path: str):
+    # Makes a rename or removal in path's directory survive a crash. Windows
+    # can't open directories, and needs no such step.
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def replace_file(temp_file: str, filename: str):
+    # temp_file must already be flushed and fsynced. os.replace is atomic,
+    # so a crash leaves either the old file or the new one, never neither.
+    os.chmod(temp_file, 0o600)
+    os.replace(temp_file, filename)
+    fsync_directory(filename)
+
+@contextmanager
+def atomic_write(filename: str, mode: str = 'w'):
+    # Yields a file to write filename's new contents to; filename is only
+    # replaced, durably, once the block finishes without an exception.
+    temp_file = f"{filename}.tmp"
+    try:
+        fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, mode, **({} if 'b' in mode else {'newline': ''})) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        replace_file(temp_file, filename)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+def parse_secure_header(filename: str, header: str) -> Dict:
+    # Version 3 headers are checked against the CRC in the END line.
+    end = read_end_line(filename) if header.startswith(SECURE_CSV_MAGIC) else None
+    if end is not None and end[1] != block_checksum(header):
+        raise SecureCsvError(filename, 1, "header is damaged (checksum mismatch)")
+    try:
+        parsed = json.loads(header[len(SECURE_CSV_MAGIC):])
+        parsed['fields']
+    except (ValueError, KeyError) as e:
+        # Without the header nothing after it can be interpreted.
+        raise SecureCsvError(filename, 1, f"unreadable header: {e}")
+    return parsed
+
+def read_end_line(filename: str) -> Optional[Tuple[int, str]]:
+    # (chunk count, header CRC) from the END line, read from the tail of
+    # the file; None when the file doesn't end with one.
+    with open(filename, 'rb') as f:
+        f.seek(max(0, os.path.getsize(filename) - 128))
+        lines = f.read().splitlines()
+    fields = lines[-1].decode(errors='replace').split() if lines else []
+    if len(fields) != 3 or fields[0] != SECURE_CSV_END or not fields[1].isdigit():
+        return None
+    return int(fields[1]), fields[2]
+
+def verify_secure_csv(filename: str) -> List[SecureCsvError]:
+    # Checks every chunk against its CRC and the file against its END line
+    # without decrypting anything, so it takes time in proportion to the
+    # file size and no key. Older layouts have nothing to check.
+    problems = []
+    with open(filename, 'rb') as f:
+        header = f.readline().decode(errors='replace')
+        if not header.startswith(SECURE_CSV_MAGIC):
+            return problems
+        end = read_end_line(filename)
+        try:
+            parse_secure_header(filename, header)
+        except SecureCsvError as e:
+            problems.append(e)
+        chunks = 0
+        number = 1
+        for number, line in enumerate(f, start=2):
+            line = line.strip()
+            if not line or line.startswith(SECURE_CSV_END.encode() + b' '):
+                continue
+            chunks += 1
+            checksum, _, token = line.partition(b' ')
+            if checksum.decode(errors='replace') != block_checksum(token):
+                problems.append(SecureCsvError(filename, number, "chunk is damaged (checksum mismatch)"))
+    if end is None:
+        problems.append(SecureCsvError(filename, number + 1, f"file is truncated: no END line after {chunks} chunks"))
+    elif end[0] != chunks:
+        problems.append(SecureCsvError(filename, number, f"END line counts {end[0]} chunks but {chunks} were found"))
+    return problems
+
+def verify_journal(filename: str) -> List[SecureCsvError]:
+    # Checksums of every journal entry, without decrypting; see
+    # verify_secure_csv.
+    problems = []
+    if not os.path.exists(filename):
+        return problems
+    with open(filename, 'rb') as f:
+        lines = f.read().split(b'\n')
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        token, intact = unframe_token(line.strip().decode(errors='replace'))
+        if number == len(lines):
+            # No newline after it: cut off by a crash, and ignored.
+            problems.append(SecureCsvError(filename, number, "last entry is incomplete"))
+        elif not intact:
+            problems.append(SecureCsvError(filename, number,
+                                           "entry is damaged (checksum mismatch); replay stops before it"))
+    return problems
+
+def verify_token_file(filename: str) -> List[SecureCsvError]:
+    # A file holding one framed token, such as the waste manifest.
+    with open(filename, 'r') as f:
+        _, intact = unframe_token(f.read().strip())
+    return [] if intact else [SecureCsvError(filename, 1, "damaged (checksum mismatch)")]
+
+def csv_data_files(journal_file: str = JOURNAL_FILE) -> List[Tuple[str, str]]:
+    # (filename, kind) of the CSV backend's files that exist; see
+    # InventoryRepository.encrypted_files for the kinds.
+    files = [(filename, 'csv') for filename in (INVENTORY_FILE, WASTE_FILE, BATCH_FILE)]
+    if os.path.isdir(WASTE_DIR):
+        files += [(os.path.join(WASTE_DIR, name), 'csv') for name in sorted(os.listdir(WASTE_DIR))
+                  if name.endswith('.csv')]
+    files += [(WASTE_MANIFEST, 'token'), (journal_file, 'journal')]
+    return [(filename, kind) for filename, kind in files if os.path.exists(filename)]
+
+def quarantine_files() -> List[str]:
+    # <file>.quarantine files that exist, including those whose CSV has
+    # since been compacted away or moved to SQLite.
+    files = [f"{filename}.quarantine" for filename in (INVENTORY_FILE, WASTE_FILE, BATCH_FILE)]
+    if os.path.isdir(WASTE_DIR):
+        files += [os.path.join(WASTE_DIR, name) for name in sorted(os.listdir(WASTE_DIR))
+                  if name.endswith('.quarantine')]
+    return [filename for filename in files if os.path.exists(filename)]
+
+def check_files(files: List[Tuple[str, str]]) -> List[SecureCsvError]:
+    problems = []
+    for filename, kind in files:
+        if kind == 'csv':
+            problems += verify_secure_csv(filename)
+        elif kind == 'journal':
+            problems += verify_journal(filename)
+        else:
+            problems += verify_token_file(filename)
+    return problems
+
+def sqlite_quick_check(conn: sqlite3.Connection, filename: str) -> List[SecureCsvError]:
+    # SQLite checks its own pages; quick_check skips the slower index
+    # cross-checks of integrity_check.
+    results = [row[0] for row in conn.execute("PRAGMA quick_check")]
+    if results == ['ok']:
+        return []
+    return [SecureCsvError(filename, 0, result) for result in results]
+
+def check_stored_data() -> List[SecureCsvError]:
+    # check_integrity() for the configured backend, straight on the files:
+    # no key is read or created and nothing is opened for writing, so it is
+    # safe to run on a directory that holds no data yet.
+    from dotenv import load_dotenv
+    load_dotenv()
+    if os.getenv("INVENTORY_BACKEND", "csv").lower() == "sqlite":
+        filename = os.getenv("INVENTORY_DB", SQLITE_FILE)
+        if not os.path.exists(filename):
+            return []
+        conn = sqlite3.connect(f"file:{filename}?mode=ro", uri=True)
+        try:
+            return sqlite_quick_check(conn, filename)
+        finally:
+            conn.close()
+    return check_files(csv_data_files())
+
+def waste_partition(date_text: str) -> str:
+    parsed = parse_date(date_text)
+    if not parsed or not parsed[1]:
+        return UNDATED_PARTITION
+    day = date.fromordinal(parsed[0])
+    return f"{day.year:04d}-{day.month:02d}"
+
+def partition_bounds(key: str) -> Tuple[int, int]:
+    # First and last day of a month partition, as ordinals.
+    year, month = map(int, key.split('-'))
+    following = date(year + month // 12, month % 12 + 1, 1)
+    return date(year, month, 1).toordinal(), following.toordinal() - 1
+
+def summarize_waste(rows: List[Dict]) -> Dict:
+    # Totals kept in the manifest for each partition, enough to chart and
+    # total unfiltered waste by reason, item or date without the records,
+    # plus the highest record id so new records never reuse an archived one.
+    reasons, items, days = defaultdict(int), defaultdict(int), defaultdict(int)
+    quantity = last_record_id = 0
+    for row in rows:
+        if row.get('record_id'):
+            last_record_id = max(last_record_id, int(row['record_id']))
+        wasted = int(row['quantity_wasted'])
+        quantity += wasted
+        reasons[row['reason']] += wasted
+        items[row['item']] += wasted
+        ordinal = _date_ordinal(row['date'])
+        if ordinal is not None:
+            days[ordinal] += wasted
+    return {'records': len(rows), 'quantity': quantity, 'reasons': reasons, 'items': items,
+            'last_record_id': last_record_id, 'days': {str(ordinal): wasted for ordinal, wasted in days.items()}}
+
+def waste_window() -> str:
+    # Key of the earliest month load_history() reads.
+    today = date.today()
+    months = today.year * 12 + today.month - waste_months()
+    return f"{months // 12:04d}-{months % 12 + 1:02d}"
+
+def waste_months() -> int:
+    try:
+        return max(1, int(os.getenv("INVENTORY_WASTE_MONTHS", str(DEFAULT_WASTE_MONTHS))))
+    except ValueError:
+        logging.warning(f"INVENTORY_WASTE_MONTHS must be a number, using {DEFAULT_WASTE_MONTHS}")
+        return DEFAULT_WASTE_MONTHS
+
+class SecureStorage:
+    # The key file is a keyring, one "<version> <key>" line per Fernet key,
+    # plus an "index <key>" line for the HMAC key behind blind indexes and
+    # row digests. New data is encrypted with the highest version; reads
+    # accept any key in the ring, so after rotate_key() old files stay
+    # readable while rekey.py moves them over. A file holding just one bare
+    # key is the single-key layout of earlier versions: that key is version
+    # 1 and the index key.
+
+    def __init__(self, workers: Optional[int] = None):
+        self.key_file = '.encryption_key'
+        # Held while encrypting and replacing or appending to a data file, so
+        # a key rotation never lands in the middle of a write and the rekey
+        # job never replaces a file the app is writing.
+        self.write_lock = threading.RLock()
+        self.keys, self.index_key = self._get_or_create_keys()
+        self._use_keys()
+        # More than one worker spreads chunk encryption and decryption over a
+        # process pool, started on first use.
+        self.workers = workers if workers is not None else crypto_workers()
+        self._pool = None
+
+    def _use_keys(self):
+        # cryptography is slow to import, so only pay for it once data is
+        # actually needed.
+        from cryptography.fernet import Fernet, MultiFernet
+        self.key_version = max(self.keys)
+        self.encryption_key = self.keys[self.key_version]
+        # MultiFernet encrypts with the first key and decrypts with any.
+        self.cipher_suite = MultiFernet([Fernet(self.keys[version]) for version in sorted(self.keys, reverse=True)])
+        
+    def _get_pool(self):
+        if self._pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # spawn rather than fork: the app has other threads running.
+            keys = [self.keys[version] for version in sorted(self.keys, reverse=True)]
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_crypto_worker, initargs=(keys,))
+        return self._pool
+        
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+            
+    def _windows(self, values: Iterable) -> Iterator[List]:
+        values = iter(values)
+        while True:
+            window = list(itertools.islice(values, self.workers * CRYPTO_WINDOW_CHUNKS))
+            if not window:
+                return
+            yield window
+            
+    def _encrypt_texts(self, texts: Iterable[str]) -> Iterator[str]:
+        if self.workers <= 1:
+            yield from (self.encrypt_data(text) for text in texts)
+            return
+        for window in self._windows(texts):
+            yield from self._get_pool().map(_encrypt_chunk, window)
+            
+    def _chunk_lines(self, f, first_line: int, framed: bool, seen: Dict) -> Iterator[Tuple[int, str, Optional[str]]]:
+        # Yields (line number, token, damage) for each chunk line, damage
+        # being the reason a framed line failed its checksum. The END line is
+        # left out; seen counts the chunk lines and tracks the last line.
+        for number, line in enumerate(f, start=first_line):
+            line = line.strip()
+            seen['last_line'] = number
+            if not line or (framed and line.startswith(SECURE_CSV_END + ' ')):
+                continue
+            seen['chunks'] += 1
+            if not framed:
+                yield number, line, None
+                continue
+            token, intact = unframe_token(line)
+            yield number, token if intact else line, None if intact else "chunk is damaged (checksum mismatch)"
+
+    def _decrypt_lines(self, lines: Iterator[Tuple[int, str, Optional[str]]]) -> Iterator[Tuple[int, str, Optional[str], Optional[str]]]:
+        # Yields (line number, token, text, reason) for each chunk line from
+        # _chunk_lines; text is None, with the reason, when the chunk is
+        # damaged or could not be decrypted.
+        if self.workers <= 1:
+            for number, token, damage in lines:
+                if damage:
+                    yield number, token, None, damage
+                    continue
+                try:
+                    yield number, token, self.decrypt_data(token), None
+                except Exception as e:
+                    yield number, token, None, f"chunk could not be decrypted ({type(e).__name__})"
+            return
+        for window in self._windows(lines):
+            intact = [token for _, token, damage in window if not damage]
+            results = iter(self._get_pool().map(_decrypt_chunk, intact))
+            for number, token, damage in window:
+                if damage:
+                    yield number, token, None, damage
+                    continue
+                text, error = next(results)
+                yield number, token, text, None if text is not None else f"chunk could not be decrypted ({error})"
+        
+    def _get_or_create_keys(self) -> Tuple[Dict[int, bytes], bytes]:
+        if os.path.exists(self.key_file):
+            with open(self.key_file, 'rb') as f:
+                lines = f.read().split()
+            if len(lines) == 1:
+                return {1: lines[0]}, lines[0]
+            entries = dict(zip(lines[::2], lines[1::2]))
+            index_key = entries.pop(b'index')
+            return {int(version): key for version, key in entries.items()}, index_key
+        else:
+            from cryptography.fernet import Fernet
+            key = Fernet.generate_key()
+            with open(self.key_file, 'wb') as f:
+                f.write(key)
+            os.chmod(self.key_file, 0o600) 
+            return {1: key}, key
+
+    def _write_keys(self, keys: Dict[int, bytes]):
+        lines = [b'index ' + self.index_key] + [b'%d %s' % (version, keys[version]) for version in sorted(keys)]
+        with atomic_write(self.key_file, 'wb') as f:
+            f.write(b'\n'.join(lines) + b'\n')
+
+    def rotate_key(self) -> int:
+        # Adds a new key, used for everything encrypted from now on, and
+        # returns its version. Existing data needs a RekeyJob to move over.
+        from cryptography.fernet import Fernet
+        with self.write_lock:
+            keys = dict(self.keys)
+            keys[self.key_version + 1] = Fernet.generate_key()
+            self._write_keys(keys)
+            self.keys = keys
+            self._use_keys()
+            # Pool workers still hold the old keys.
+            self.close()
+        logging.info(f"Rotated the encryption key to version {self.key_version}")
+        return self.key_version
+
+    def retire_keys(self) -> List[int]:
+        # Drops every key but the current one; only safe once a RekeyJob has
+        # finished, since anything still under an old key becomes unreadable.
+        with self.write_lock:
+            retired = sorted(version for version in self.keys if version != self.key_version)
+            self._write_keys({self.key_version: self.encryption_key})
+            self.keys = {self.key_version: self.encryption_key}
+            self._use_keys()
+            self.close()
+        logging.info(f"Retired encryption key versions {retired}")
+        return retired
+
+    def rotate_token(self, token: bytes) -> bytes:
+        # The same plaintext under the current key; raises InvalidToken if no
+        # key in the ring can read it.
+        return self.cipher_suite.rotate(token)
+            
+    def encrypt_data(self, data: str) -> str:
+        return self.cipher_suite.encrypt(data.encode()).decode()
+        
+    def decrypt_data(self, encrypted_data: str) -> str:
+        return self.cipher_suite.decrypt(encrypted_data.encode()).decode()
+
+    def encrypt_bytes(self, data: bytes) -> bytes:
+        return self.cipher_suite.encrypt(data)
+
+    def decrypt_bytes(self, token: bytes) -> bytes:
+        return self.cipher_suite.decrypt(token)
+        
+    def digest_rows(self, rows: List[Dict], fieldnames: List[str]) -> str:
+        # Keyed, so equal digests in a file don't reveal equal contents.
+        text = self._serialize_rows(rows, fieldnames)
+        return hmac.new(self.index_key, b'rows:' + text.encode(), hashlib.sha256).hexdigest()
+
+    def blind_index(self, value: str) -> bytes:
+        # Deterministic keyed hash so encrypted columns can still be looked up
+        # by exact value without storing the plaintext.
+        # The index key is never rotated, since every stored index would
+        # have to be recomputed with it.
+        return hmac.new(self.index_key, b'index:' + value.encode(), hashlib.sha256).digest()
+        
+    def save_secure_csv(self, filename: str, data: List[Dict], fieldnames: List[str], meta: Optional[Dict] = None):
+        try:
+            header = f"{SECURE_CSV_MAGIC} {json.dumps(dict(meta or {}, fields=fieldnames))}\n"
+            with span('save_secure_csv', file=filename, rows=len(data)) as timing, \
+                    self.write_lock, atomic_write(filename) as f:
+                f.write(header)
+                texts = (self._serialize_rows(data[start:start + SECURE_CSV_CHUNK_ROWS], fieldnames)
+                         for start in range(0, len(data), SECURE_CSV_CHUNK_ROWS))
+                chunks = 0
+                for token in self._encrypt_texts(texts):
+                    f.write(frame_token(token) + "\n")
+                    chunks += 1
+                f.write(f"{SECURE_CSV_END} {chunks} {block_checksum(header)}\n")
+                timing['chunks'] = chunks
+            
+            logging.info(f"Successfully saved secure data to {filename}")
+        except Exception as e:
+            logging.error(f"Error saving secure data: {str(e)}")
+            raise
+            
+    def load_secure_csv(self, filename: str, fieldnames: List[str], on_error: str = 'fail',
+                        errors: Optional[List[SecureCsvError]] = None) -> List[Dict]:
+        return list(self.iter_secure_csv(filename, fieldnames, on_error, errors))
+        
+    def iter_secure_csv(self, filename: str, fieldnames: List[str], on_error: str = 'fail',
+                        errors: Optional[List[SecureCsvError]] = None) -> Iterator[Dict]:
+        # Decrypts one chunk at a time, so memory stays at a chunk of rows no
+        # matter how big the file is. Unreadable chunks or rows are handled
+        # per on_error and, unless it is 'fail', appended to errors.
+        if on_error not in LOAD_ERROR_POLICIES:
+            raise ValueError(f"on_error must be one of {', '.join(LOAD_ERROR_POLICIES)}")
+        if not os.path.exists(filename):
+            return
+            
+        with open(filename, 'r', newline='') as f:
+            header = f.readline()
+            framed = header.startswith(SECURE_CSV_MAGIC)
+            if not framed and not header.startswith(SECURE_CSV_V2_MAGIC):
+                # Per-cell file from before the chunked format; it is
+                # rewritten in the new layout on the next save.
+                f.seek(0)
+                yield from self._iter_legacy_rows(f, filename, on_error, errors)
+                return
+                
+            fields = parse_secure_header(filename, header)['fields']
+            end = read_end_line(filename) if framed else None
+            seen = {'chunks': 0, 'last_line': 1}
+            for line_number, line, text, error in self._decrypt_lines(self._chunk_lines(f, 2, framed, seen)):
+                if text is None:
+                    self._load_error(filename, line_number, error, line, on_error, errors)
+                    continue
+                for row_number, values in enumerate(csv.reader(io.StringIO(text, newline='')), start=1):
+                    if len(values) != len(fields):
+                        self._load_error(filename, line_number,
+                                         f"row {row_number} of chunk has {len(values)} fields, expected {len(fields)}",
+                                         self.encrypt_data(json.dumps(values)), on_error, errors)
+                        continue
+                    yield dict(zip(fields, values))
+            if framed and end is None:
+                self._load_error(filename, seen['last_line'] + 1,
+                                 f"file is truncated: no END line after {seen['chunks']} chunks", '', on_error, errors)
+            elif framed and end[0] != seen['chunks']:
+                self._load_error(filename, seen['last_line'],
+                                 f"END line counts {end[0]} chunks but {seen['chunks']} were found", '', on_error, errors)
+
+    def _load_error(self, filename: str, line: int, reason: str, token: str, on_error: str,
+                    errors: Optional[List[SecureCsvError]]):
+        error = SecureCsvError(filename, line, reason)
+        if on_error == 'fail':
+            raise error
+        if on_error == 'quarantine':
+            # The quarantined data stays encrypted.
+            quarantine_file = f"{filename}.quarantine"
+            with self.write_lock:
+                is_new = not os.path.exists(quarantine_file)
+                with open(quarantine_file, 'a') as q:
+                    q.write(json.dumps({'line': line, 'error': reason, 'data': token}) + "\n")
+                if is_new:
+                    os.chmod(quarantine_file, 0o600)
+        logging.warning(f"{'Quarantined' if on_error == 'quarantine' else 'Skipped'} {error}")
+        if errors is not None:
+            errors.append(error)
+            
+    def read_secure_meta(self, filename: str) -> Dict:
+        if not os.path.exists(filename):
+            return {}
+            
+        with open(filename, 'r', newline='') as f:
+            header = f.readline()
+        if not header.startswith((SECURE_CSV_MAGIC, SECURE_CSV_V2_MAGIC)):
+            return {}
+        return parse_secure_header(filename, header)
+            
+    def _iter_legacy_rows(self, f, filename: str, on_error: str,
+                          errors: Optional[List[SecureCsvError]]) -> Iterator[Dict]:
+        reader = csv.DictReader(f)
+        for row in reader:
+            try:
+                yield {k: self.decrypt_data(v) for k, v in row.items()}
+            except Exception as e:
+                self._load_error(filename, reader.line_num, f"row could not be decrypted ({type(e).__name__})",
+                                 json.dumps(row), on_error, errors)
+        
+    def _serialize_rows(self, rows: List[Dict], fieldnames: List[str]) -> str:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([str(row.get(field, '')) for field in fieldnames])
+        return buffer.getvalue()
+        
+
+class OperationJournal:
+    # One framed token (see frame_token) per line, each an encrypted change.
+    # Appends are fsynced before they count as saved.
+
+    def __init__(self, storage: SecureStorage, filename: str = JOURNAL_FILE):
+        self.storage = storage
+        self.filename = filename
+        self.last_seq = 0
+        self.op_count = 0
+        self.tail_checked = False
+        
+    def append(self, ops: List[Dict]):
+        with self.storage.write_lock:
+            is_new = not os.path.exists(self.filename)
+            if not is_new and not self.tail_checked:
+                self._drop_torn_tail()
+            self.tail_checked = True
+            start, last_seq = (0 if is_new else os.path.getsize(self.filename)), self.last_seq
+            try:
+                with open(self.filename, 'a') as f:
+                    for op in ops:
+                        self.last_seq += 1
+                        op['seq'] = self.last_seq
+                        f.write(frame_token(self.storage.encrypt_data(json.dumps(op))) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            except BaseException:
+                # Whole entries for the first ops may have reached the file,
+                # and the caller retries all of them; cut back to where this
+                # append began so none is replayed twice.
+                self.last_seq = last_seq
+                try:
+                    if is_new:
+                        os.remove(self.filename)
+                    else:
+                        os.truncate(self.filename, start)
+                except OSError as e:
+                    logging.error(f"Could not undo a failed journal append: {str(e)}")
+                raise
+            if is_new:
+                os.chmod(self.filename, 0o600)
+                fsync_directory(self.filename)
+        self.op_count += len(ops)
+
+    def _drop_torn_tail(self):
+        # A crash mid-append leaves a last line without its newline; new
+        # entries appended to it would be unreadable along with it.
+        with open(self.filename, 'rb+') as f:
+            content = f.read()
+            if content and not content.endswith(b'\n'):
+                f.truncate(content.rfind(b'\n') + 1)
+                logging.warning(f"Dropped an incomplete last entry from {self.filename}")
+        
+    def replay(self):
+        if not os.path.exists(self.filename):
+            return
+            
+        self.op_count = 0
+        with open(self.filename, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                token, intact = unframe_token(line)
+                try:
+                    if not intact:
+                        raise ValueError("checksum mismatch")
+                    op = json.loads(self.storage.decrypt_data(token))
+                except Exception as e:
+                    # A torn write from a crash can only affect the tail.
+                    logging.warning(f"Stopping journal replay at unreadable entry: {str(e) or type(e).__name__}")
+                    break
+                self.op_count += 1
+                self.last_seq = max(self.last_seq, op['seq'])
+                yield op
+
+    def reset(self):
+        with self.storage.write_lock:
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+                fsync_directory(self.filename)
+        self.op_count = 0
+        self.tail_checked = False
+
+
+class InventoryRepository:
+    # Persistence for the three record tables. Changes are the insert/delete/
+    # sort/merge dicts built by Inventory.record_change, addressed by list
+    # position in its in-memory lists.
+
+    # Problems load() worked around under a skip or quarantine policy.
+    load_errors: Tuple = ()
+    # Waste partitions held in memory; None means all of them.
+    loaded_partitions: Optional[Set[str]] = None
+
+    def load(self) -> Tuple[Iterable[Dict], Iterable[Dict], Iterable[Dict], List[Dict]]:
+        # Returns inventory, waste and batch rows plus any changes that still
+        # have to be replayed on top of them. The rows may be lazy iterables.
+        inventory_rows, item_changes = self.load_items()
+        waste_rows, batch_rows, history_changes = self.load_history()
+        return inventory_rows, waste_rows, batch_rows, item_changes + history_changes
+
+    def load_items(self) -> Tuple[Iterable[Dict], List[Dict]]:
+        # The inventory half of load(), so the item list can be shown before
+        # the waste history has been read.
+        raise NotImplementedError
+
+    def load_history(self) -> Tuple[Iterable[Dict], Iterable[Dict], List[Dict]]:
+        # The other half: waste and batch rows and their changes. Only valid
+        # after load_items().
+        raise NotImplementedError
+
+    def is_empty(self) -> bool:
+        raise NotImplementedError
+
+    def apply(self, changes: List[Dict]):
+        raise NotImplementedError
+
+    def needs_compaction(self) -> bool:
+        return False
+
+    def compact(self, inventory_rows: List[Dict], waste_rows: List[Dict], batch_rows: List[Dict],
+                loaded_partitions: Optional[Set[str]]):
+        # loaded_partitions is loaded_partition_keys() as of when the rows
+        # were taken: months loaded since then have no rows among them but
+        # must not be taken for emptied.
+        pass
+
+    def import_rows(self, inventory_rows: List[Dict], waste_rows: List[Dict], batch_rows: List[Dict]):
+        raise NotImplementedError
+
+    def loaded_partition_keys(self) -> Optional[Set[str]]:
+        # A copy of loaded_partitions, safe to hand to another thread.
+        return None if self.loaded_partitions is None else set(self.loaded_partitions)
+
+    def archived_partitions(self) -> Dict[str, Dict]:
+        # Manifest summaries (see summarize_waste) of the waste partitions
+        # that load_history() left on disk, by partition key.
+        return {}
+
+    def load_partition(self, key: str) -> List[Dict]:
+        # Waste rows of one archived partition, which then counts as loaded.
+        raise KeyError(key)
+
+    def snapshot_fingerprint(self) -> Optional[List]:
+        # Identifies the stored state right now, for telling whether a binary
+        # snapshot (see snapshot.py) still matches it. None means this
+        # repository can't be loaded from a snapshot.
+        return None
+
+    def encrypted_files(self) -> List[Tuple[str, str]]:
+        # (filename, kind) of every file holding data under the Fernet key,
+        # for rekey.py: 'csv' for secure CSVs of either layout, 'journal' for
+        # one token per line, 'token' for a file that is one token.
+        return []
+
+    def encrypted_tables(self) -> Dict[str, int]:
+        # Tables of encrypted rows rekey_rows() can move to a new key, with
+        # the bytes of ciphertext in each.
+        return {}
+
+    def rekey_rows(self, table: str, after_id: int, limit: int) -> Optional[Tuple[int, int]]:
+        # Re-encrypts up to limit rows of table after row id after_id under
+        # the current key; (last row id, ciphertext bytes) done, or None
+        # past the end of the table.
+        raise NotImplementedError(f"{type(self).__name__} has no encrypted tables")
+
+    def check_integrity(self) -> List[SecureCsvError]:
+        # Damage found in the stored data without decrypting it, so it runs in
+        # time proportional to the data size. Empty when all is well.
+        return []
+
+    def find_items(self, name: Optional[str] = None, category: Optional[str] = None) -> List[Dict]:
+        raise NotImplementedError(f"{type(self).__name__} does not support queries")
+
+    def items_expiring_between(self, start: datetime, end: datetime) -> List[Dict]:
+        raise NotImplementedError(f"{type(self).__name__} does not support queries")
+
+    def find_waste(self, item: Optional[str] = None, reason: Optional[str] = None,
+                   batch_id: Optional[int] = None, start: Optional[datetime] = None,
+                   end: Optional[datetime] = None) -> List[Dict]:
+        raise NotImplementedError(f"{type(self).__name__} does not support queries")
+
+    def close(self):
+        pass
+
+class CsvRepository(InventoryRepository):
+    def __init__(self, storage: SecureStorage, on_error: str = 'fail'):
+        self.storage = storage
+        self.journal = OperationJournal(storage)
+        self.on_error = on_error
+        self.history_changes = []
+        # {'journal_seq': ..., 'partitions': {key: summary}}, or None while
+        # the waste is still in the single WASTE_FILE of older versions.
+        self.manifest = None
+        # The persistence worker compacts while the Tk thread loads archived
+        # months; this guards loaded_partitions. The manifest is only ever
+        # replaced, never changed in place.
+        self.partitions_lock = threading.Lock()
+
+    def load_items(self):
+        # The rows come back as generators, so the caller builds its records
+        # straight from decrypted chunks without a full list of dicts. The
+        # journal is read once here and split between the two halves.
+        self.load_errors = []
+        inventory_rows = self.storage.iter_secure_csv(INVENTORY_FILE, INVENTORY_FIELDS, self.on_error, self.load_errors)
+        self.manifest = self._read_manifest()
+
+        snapshot_seqs = {
+            'inventory': self.storage.read_secure_meta(INVENTORY_FILE).get('journal_seq', 0),
+            'waste': (self.manifest['journal_seq'] if self.manifest is not None
+                      else self.storage.read_secure_meta(WASTE_FILE).get('journal_seq', 0)),
+            'batches': self.storage.read_secure_meta(BATCH_FILE).get('journal_seq', 0)
+        }
+        self.journal.last_seq = max(snapshot_seqs.values())
+        changes = [change for change in self.journal.replay()
+                   if change['seq'] > snapshot_seqs[change['table']]]
+        self.history_changes = [change for change in changes if change['table'] != 'inventory']
+        return inventory_rows, [change for change in changes if change['table'] == 'inventory']
+
+    def load_history(self):
+        if self.manifest is None:
+            self.loaded_partitions = None
+            waste_rows = self.storage.iter_secure_csv(WASTE_FILE, WASTE_FIELDS, self.on_error, self.load_errors)
+        else:
+            # Recent months, anything dated later and anything the manifest
+            # has no totals for. Each segment is written in record id order,
+            # so merging them keeps the store finding rows by bisection, and
+            # nothing is decrypted unless the rows are consumed, which they
+            # aren't when a binary snapshot stands in for them.
+            window = waste_window()
+            self.loaded_partitions = {key for key, summary in self.manifest['partitions'].items()
+                                      if key == UNDATED_PARTITION or key >= window or not summary}
+            waste_rows = heapq.merge(*(
+                self.storage.iter_secure_csv(self._segment_file(key), WASTE_FIELDS, self.on_error, self.load_errors)
+                for key in sorted(self.loaded_partitions)), key=lambda row: int(row['record_id'] or 0))
+        batch_rows = self.storage.iter_secure_csv(BATCH_FILE, BATCH_FIELDS, self.on_error, self.load_errors)
+        changes, self.history_changes = self.history_changes, []
+        return waste_rows, batch_rows, changes
+
+    def loaded_partition_keys(self):
+        with self.partitions_lock:
+            return super().loaded_partition_keys()
+
+    def archived_partitions(self):
+        manifest = self.manifest
+        with self.partitions_lock:
+            if manifest is None or self.loaded_partitions is None:
+                return {}
+            return {key: summary for key, summary in manifest['partitions'].items()
+                    if key not in self.loaded_partitions}
+
+    def load_partition(self, key):
+        if key not in self.archived_partitions():
+            raise KeyError(key)
+        rows = list(self.storage.iter_secure_csv(self._segment_file(key), WASTE_FIELDS, self.on_error,
+                                                 self.load_errors))
+        with self.partitions_lock:
+            self.loaded_partitions.add(key)
+        logging.info(f"Loaded {len(rows)} archived waste records for {key}")
+        return rows
+
+    def _segment_file(self, key: str) -> str:
+        return os.path.join(WASTE_DIR, f"{key}.csv")
+
+    def _read_manifest(self) -> Optional[Dict]:
+        if not os.path.exists(WASTE_MANIFEST):
+            return None
+        try:
+            with open(WASTE_MANIFEST, 'r') as f:
+                token, intact = unframe_token(f.read().strip())
+            if intact:
+                return json.loads(self.storage.decrypt_data(token))
+            reason = "checksum mismatch"
+        except Exception as e:
+            reason = type(e).__name__
+        error = SecureCsvError(WASTE_MANIFEST, 1, f"manifest could not be read ({reason})")
+        if self.on_error == 'fail':
+            raise error
+        # The segments are still there; list them without totals, which
+        # makes them all load at start, and the next compaction writes a
+        # fresh manifest.
+        logging.warning(f"Rebuilding {error}")
+        self.load_errors.append(error)
+        keys = [name[:-len('.csv')] for name in os.listdir(WASTE_DIR) if name.endswith('.csv')]
+        seqs = [self.storage.read_secure_meta(self._segment_file(key)).get('journal_seq', 0) for key in keys]
+        return {'journal_seq': min(seqs, default=0), 'partitions': {key: {} for key in keys}}
+
+    def _write_manifest(self, manifest: Dict):
+        with self.storage.write_lock, atomic_write(WASTE_MANIFEST) as f:
+            f.write(frame_token(self.storage.encrypt_data(json.dumps(manifest))) + "\n")
+
+    def _save_waste(self, waste_rows: List[Dict], meta: Dict, loaded_partitions: Optional[Set[str]]):
+        # Rewrites the partitions loaded when waste_rows were taken whose rows
+        # changed and updates their manifest totals; the others can't have
+        # changed, since Inventory loads a partition before touching it. Only
+        # a partition loaded then and with no rows left is removed.
+        by_partition = defaultdict(list)
+        for row in waste_rows:
+            by_partition[waste_partition(row['date'])].append(row)
+        # A new manifest, swapped in at the end, as the Tk thread reads it.
+        manifest = dict(self.manifest or {'journal_seq': 0})
+        partitions = manifest['partitions'] = dict(manifest.get('partitions', {}))
+        archived = set() if loaded_partitions is None else set(partitions) - loaded_partitions
+        if archived & set(by_partition):
+            raise RuntimeError(f"Waste partitions {sorted(archived & set(by_partition))} changed without being loaded")
+
+        os.makedirs(WASTE_DIR, mode=0o700, exist_ok=True)
+        written = 0
+        for key in sorted((set(partitions) | set(by_partition)) - archived):
+            rows = by_partition.get(key, [])
+            filename = self._segment_file(key)
+            if not rows:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                partitions.pop(key, None)
+                continue
+            digest = self.storage.digest_rows(rows, WASTE_FIELDS)
+            if partitions.get(key, {}).get('digest') == digest and os.path.exists(filename):
+                continue
+            self.storage.save_secure_csv(filename, rows, WASTE_FIELDS, meta)
+            partitions[key] = dict(summarize_waste(rows), digest=digest)
+            written += 1
+        manifest['journal_seq'] = meta['journal_seq']
+        self._write_manifest(manifest)
+        with self.partitions_lock:
+            self.manifest = manifest
+            if self.loaded_partitions is None:
+                self.loaded_partitions = set(partitions)
+            else:
+                # Months loaded since the rows were taken stay loaded.
+                self.loaded_partitions |= set(by_partition)
+        if os.path.exists(WASTE_FILE):
+            # Everything from the single file of older versions is in the
+            # partitions now.
+            os.remove(WASTE_FILE)
+        logging.info(f"Saved waste: {written} of {len(partitions) - len(archived)} loaded partitions changed")
+
+    def is_empty(self):
+        return not any(os.path.exists(f) for f in (INVENTORY_FILE, WASTE_FILE, WASTE_MANIFEST, BATCH_FILE,
+                                                   self.journal.filename))
+
+    def snapshot_fingerprint(self):
+        # Size and modification time of the snapshot files. Waste segments
+        # only change along with the manifest. The journal is left out: it
+        # is replayed on top of a binary snapshot just as on top of the CSVs.
+        fingerprint = []
+        for filename in (INVENTORY_FILE, WASTE_FILE, WASTE_MANIFEST, BATCH_FILE):
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                fingerprint.append(None)
+            else:
+                fingerprint.append([stat.st_size, stat.st_mtime_ns])
+        return fingerprint
+
+    def encrypted_files(self):
+        return csv_data_files(self.journal.filename)
+
+    def check_integrity(self):
+        return check_files(self.encrypted_files())
+
+    def apply(self, changes):
+        self.journal.append(changes)
+
+    def needs_compaction(self):
+        return self.journal.op_count >= JOURNAL_COMPACT_OPS
+
+    def compact(self, inventory_rows, waste_rows, batch_rows, loaded_partitions):
+        # Each snapshot records the last journal entry it contains, so a crash
+        # before the journal is reset never replays a change twice.
+        meta = {'journal_seq': self.journal.last_seq}
+        self.storage.save_secure_csv(INVENTORY_FILE, inventory_rows, INVENTORY_FIELDS, meta)
+        self._save_waste(waste_rows, meta, loaded_partitions)
+        self.storage.save_secure_csv(BATCH_FILE, batch_rows, BATCH_FIELDS, meta)
+        self.journal.reset()
+        logging.info("Journal compacted into snapshot files")
+
+    def import_rows(self, inventory_rows, waste_rows, batch_rows):
+        self.compact(inventory_rows, waste_rows, batch_rows, self.loaded_partition_keys())
+
+class SqliteRepository(InventoryRepository):
+    # Rows are stored as Fernet-encrypted JSON payloads. Searchable text
+    # columns hold blind indexes (see SecureStorage.blind_index); dates are
+    # kept as plain ordinals so range queries can use an index.
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS inventory (
+            id INTEGER PRIMARY KEY,
+            location TEXT NOT NULL,
+            name_key BLOB,
+            category_key BLOB,
+            expiration INTEGER,
+            payload TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_inventory_name ON inventory(location, name_key);
+        CREATE INDEX IF NOT EXISTS idx_inventory_category ON inventory(location, category_key);
+        CREATE INDEX IF NOT EXISTS idx_inventory_expiration ON inventory(location, expiration);
+
+        CREATE TABLE IF NOT EXISTS waste (
+            id INTEGER PRIMARY KEY,
+            location TEXT NOT NULL,
+            item_key BLOB,
+            reason_key BLOB,
+            waste_date INTEGER,
+            batch_id INTEGER,
+            record_id INTEGER,
+            payload TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_waste_item ON waste(location, item_key);
+        CREATE INDEX IF NOT EXISTS idx_waste_reason ON waste(location, reason_key);
+        CREATE INDEX IF NOT EXISTS idx_waste_date ON waste(location, waste_date);
+        CREATE INDEX IF NOT EXISTS idx_waste_batch ON waste(location, batch_id);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_waste_record ON waste(location, record_id);
+
+        CREATE TABLE IF NOT EXISTS batches (
+            id INTEGER PRIMARY KEY,
+            location TEXT NOT NULL,
+            batch_id INTEGER,
+            payload TEXT NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_batches_batch ON batches(location, batch_id);
+    """
+
+    def __init__(self, storage: SecureStorage, filename: str = SQLITE_FILE, location: str = 'main'):
+        self.storage = storage
+        self.filename = filename
+        self.location = location
+        is_new = not os.path.exists(filename)
+        # Writes come from the persistence worker while lookups may come from
+        # the Tk thread, so the connection is shared behind a lock.
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.RLock()
+        for table, column in (('waste', 'record_id'), ('batches', 'batch_id')):
+            columns = [info[1] for info in self.conn.execute(f"PRAGMA table_info({table})")]
+            if columns and column not in columns:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER")
+        self.conn.executescript(self.SCHEMA)
+        if is_new:
+            os.chmod(filename, 0o600)
+        # Inventory row ids in the same order as the manager's list, so
+        # positional changes map to point updates. Waste rows and batches are
+        # addressed by their own ids.
+        self.row_ids = {'inventory': []}
+        self.sort_keys = {}
+
+    def _encrypt_row(self, row: Dict) -> str:
+        return self.storage.encrypt_data(json.dumps(row))
+
+    def _decrypt_row(self, payload: str) -> Dict:
+        return json.loads(self.storage.decrypt_data(payload))
+
+    def load_items(self):
+        self.row_ids['inventory'] = []
+        inventory_rows = []
+        cursor = self.conn.execute(
+            "SELECT id, payload FROM inventory WHERE location = ? ORDER BY expiration, id", (self.location,))
+        for row_id, payload in cursor:
+            row = self._decrypt_row(payload)
+            self.row_ids['inventory'].append(row_id)
+            inventory_rows.append(row)
+            self.sort_keys[row_id] = (row['name'], InventoryItem.from_csv_row(row).expiration_key)
+        return inventory_rows, []
+
+    def load_history(self):
+        return self._select('waste', [], []), self._select('batches', [], []), []
+
+    def is_empty(self):
+        for table in ('inventory', 'waste', 'batches'):
+            if self.conn.execute(f"SELECT 1 FROM {table} WHERE location = ? LIMIT 1", (self.location,)).fetchone():
+                return False
+        return True
+
+    def _insert(self, table: str, row: Dict) -> int:
+        if table == 'inventory':
+            cursor = self.conn.execute(
+                "INSERT INTO inventory (location, name_key, category_key, expiration, payload) VALUES (?, ?, ?, ?, ?)",
+                (self.location, self.storage.blind_index(row['name']), self.storage.blind_index(row['category']),
+                 _date_ordinal(row['expiration_date']), self._encrypt_row(row)))
+            self.sort_keys[cursor.lastrowid] = (row['name'], InventoryItem.from_csv_row(row).expiration_key)
+        elif table == 'waste':
+            cursor = self.conn.execute(
+                "INSERT INTO waste (location, item_key, reason_key, waste_date, batch_id, record_id, payload) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.location, self.storage.blind_index(row['item']), self.storage.blind_index(row['reason']),
+                 _date_ordinal(row['date']), int(row['batch_id']) if row['batch_id'] else None,
+                 int(row['record_id']), self._encrypt_row(row)))
+        else:
+            cursor = self.conn.execute(
+                "INSERT INTO batches (location, batch_id, payload) VALUES (?, ?, ?)",
+                (self.location, int(row['batch_id']), self._encrypt_row(row)))
+        return cursor.lastrowid
+
+    def apply(self, changes):
+        with self.lock:
+            # The row map changes as the statements run; if the transaction
+            # rolls back it goes back to these copies, or the worker's retry
+            # would find it out of step with the table.
+            saved_row_ids, saved_sort_keys = list(self.row_ids['inventory']), dict(self.sort_keys)
+            try:
+                with self.conn:
+                    for change in changes:
+                        self._apply_change(change)
+            except BaseException:
+                self.row_ids['inventory'], self.sort_keys = saved_row_ids, saved_sort_keys
+                raise
+
+    def _apply_change(self, change: Dict):
+        table = change['table']
+        if table != 'inventory':
+            self._apply_by_id(change)
+            return
+        row_ids = self.row_ids[table]
+        if change['op'] == 'insert':
+            row_ids.insert(change['index'], self._insert(table, change['row']))
+        elif change['op'] == 'merge':
+            row_ids.extend(self._insert(table, row) for row in change['rows'])
+            row_ids.sort(key=lambda row_id: self.sort_keys[row_id][1])
+        elif change['op'] == 'delete':
+            row_id = row_ids.pop(change['index'])
+            self.conn.execute(f"DELETE FROM {table} WHERE id = ?", (row_id,))
+            self.sort_keys.pop(row_id, None)
+        elif change['op'] == 'sort':
+            # Ordering only lives in memory; mirror it so later
+            # positions still line up with the manager's list.
+            key_index = 0 if change['key'] == "Name" else 1
+            row_ids.sort(key=lambda row_id: self.sort_keys[row_id][key_index])
+
+    def _apply_by_id(self, change: Dict):
+        id_column = 'record_id' if change['table'] == 'waste' else 'batch_id'
+        if change['op'] == 'insert':
+            self._insert(change['table'], change['row'])
+        elif change['op'] == 'merge':
+            for row in change['rows']:
+                self._insert(change['table'], row)
+        elif change['op'] == 'delete':
+            self.conn.execute(f"DELETE FROM {change['table']} WHERE location = ? AND {id_column} = ?",
+                              (self.location, change[id_column]))
+
+    def import_rows(self, inventory_rows, waste_rows, batch_rows):
+        with self.lock, self.conn:
+            for table, rows in (('inventory', inventory_rows), ('waste', waste_rows), ('batches', batch_rows)):
+                self.conn.execute(f"DELETE FROM {table} WHERE location = ?", (self.location,))
+                inserted = [self._insert(table, row) for row in rows]
+                if table in self.row_ids:
+                    self.row_ids[table] = inserted
+        logging.info(f"Imported {len(inventory_rows)} items, {len(waste_rows)} waste records "
+                     f"and {len(batch_rows)} batches into {self.filename}")
+
+    def _select(self, table: str, where: List[str], params: List, order: str = "id") -> List[Dict]:
+        clauses = " AND ".join(["location = ?"] + where)
+        with self.lock:
+            cursor = self.conn.execute(f"SELECT payload FROM {table} WHERE {clauses} ORDER BY {order}",
+                                       [self.location] + params)
+            payloads = cursor.fetchall()
+        return [self._decrypt_row(payload) for (payload,) in payloads]
+
+    def find_items(self, name=None, category=None):
+        where, params = [], []
+        if name is not None:
+            where.append("name_key = ?")
+            params.append(self.storage.blind_index(name))
+        if category is not None:
+            where.append("category_key = ?")
+            params.append(self.storage.blind_index(category))
+        # The order load_items() gives the list.
+        return self._select('inventory', where, params, "expiration, id")
+
+    def items_expiring_between(self, start, end):
+        return self._select('inventory', ["expiration BETWEEN ? AND ?"], [start.toordinal(), end.toordinal()],
+                            "expiration, id")
+
+    def find_waste(self, item=None, reason=None, batch_id=None, start=None, end=None):
+        where, params = [], []
+        if item is not None:
+            where.append("item_key = ?")
+            params.append(self.storage.blind_index(item))
+        if reason is not None:
+            where.append("reason_key = ?")
+            params.append(self.storage.blind_index(reason))
+        if batch_id is not None:
+            where.append("batch_id = ?")
+            params.append(batch_id)
+        if start is not None:
+            where.append("waste_date >= ?")
+            params.append(start.toordinal())
+        if end is not None:
+            where.append("waste_date <= ?")
+            params.append(end.toordinal())
+        return self._select('waste', where, params, "record_id")
+
+    def encrypted_tables(self):
+        with self.lock:
+            return {table: self.conn.execute(f"SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM {table}").fetchone()[0]
+                    for table in ('inventory', 'waste', 'batches')}
+
+    def rekey_rows(self, table, after_id, limit):
+        # Every location's rows: they all share the one key file.
+        from cryptography.fernet import InvalidToken
+        with self.lock, self.conn:
+            rows = self.conn.execute(f"SELECT id, payload FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                                     (after_id, limit)).fetchall()
+            updates = []
+            for row_id, payload in rows:
+                try:
+                    updates.append((self.storage.rotate_token(payload.encode()).decode(), row_id))
+                except InvalidToken:
+                    logging.warning(f"Row {row_id} of {table} in {self.filename} can't be decrypted, left as it is")
+            self.conn.executemany(f"UPDATE {table} SET payload = ? WHERE id = ?", updates)
+        if not rows:
+            return None
+        return rows[-1][0], sum(len(payload) for _, payload in rows)
+
+    def check_integrity(self):
+        with self.lock:
+            return sqlite_quick_check(self.conn, self.filename)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def create_repository(storage: SecureStorage) -> InventoryRepository:
+    from dotenv import load_dotenv
+    load_dotenv()
+    backend = os.getenv("INVENTORY_BACKEND", "csv").lower()
+    if backend == "sqlite":
+        return SqliteRepository(storage, os.getenv("INVENTORY_DB", SQLITE_FILE),
+                                os.getenv("INVENTORY_LOCATION", "main"))
+    if backend != "csv":
+        logging.warning(f"Unknown INVENTORY_BACKEND '{backend}', using csv")
+    return CsvRepository(storage, load_error_policy())
+
+def crypto_workers() -> int:
+    from dotenv import load_dotenv
+    load_dotenv()
+    try:
+        return max(1, int(os.getenv("INVENTORY_CRYPTO_WORKERS", "1")))
+    except ValueError:
+        logging.warning("INVENTORY_CRYPTO_WORKERS must be a number, using 1")
+        return 1
+
+def load_error_policy() -> str:
+    on_error = os.getenv("INVENTORY_LOAD_ERRORS", "fail").lower()
+    if on_error not in LOAD_ERROR_POLICIES:
+        logging.warning(f"Unknown INVENTORY_LOAD_ERRORS '{on_error}', using fail")
+        return 'fail'
+    return on_error
+
+class PersistenceWorker:
+    # Applies queued changes to the repository on a background thread so the
+    # Tk thread never waits on encryption or disk I/O. Requests that arrive
+    # within COALESCE_DELAY of each other are written together. Status
+    # messages are queued for the UI to pick up with root.after.
+
+    COALESCE_DELAY = 0.25
+
+    def __init__(self, repository: InventoryRepository):
+        self.repository = repository
+        self.requests = queue.Queue()
+        self.status = queue.Queue()
+        self.failed = []
+        self.last_error = None
+        self.compaction_pending = False
+        self.thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+        self.thread.start()
+
+    def submit(self, changes: List[Dict], snapshot=None):
+        # snapshot is the full state as of these changes, anything with a
+        # rows() method returning the (inventory, waste, batch) rows, such as
+        # Inventory.capture_snapshot(); when given the repository is compacted
+        # to it right after the changes are written. The rows are built here,
+        # on the worker thread.
+        if snapshot is not None:
+            self.compaction_pending = True
+        if changes or snapshot is not None:
+            self.requests.put((changes, snapshot))
+
+    def flush(self, changes: List[Dict], snapshot=None):
+        # Writes everything still queued, then stops the worker. If that
+        # fails, resume() starts it again with the unwritten changes kept.
+        self.submit(changes, snapshot)
+        if self.failed:
+            # Retried even when nothing new came in.
+            self.requests.put(([], None))
+        self.requests.put(None)
+        self.thread.join()
+        if self.last_error:
+            raise RuntimeError(self.last_error)
+
+    def resume(self):
+        self.thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            time.sleep(self.COALESCE_DELAY)
+            batch = [request]
+            stopping = False
+            while True:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+            self._write(batch)
+            if stopping:
+                return
+
+    def _write(self, batch: List[Tuple[List[Dict], Optional[Tuple]]]):
+        # Only the newest snapshot is worth writing, but changes made after
+        # it must land in the journal after the compaction, not before.
+        last_snapshot = max((i for i, (_, snapshot) in enumerate(batch) if snapshot is not None), default=-1)
+        before = self.failed + [change for changes, _ in batch[:last_snapshot + 1] for change in changes]
+        after = [change for changes, _ in batch[last_snapshot + 1:] for change in changes]
+        self.status.put(('saving', len(before) + len(after)))
+        unwritten = before + after
+        try:
+            if before:
+                self.repository.apply(before)
+            self.failed = []
+            unwritten = after
+            if last_snapshot >= 0:
+                snapshot = batch[last_snapshot][1]
+                self.repository.compact(*snapshot.rows(), snapshot.loaded_partitions)
+                self.compaction_pending = False
+            if after:
+                self.repository.apply(after)
+            self.last_error = None
+            logging.info(f"Data saved successfully ({len(before) + len(after)} changes)")
+            self.status.put(('saved', None))
+        except Exception as e:
+            # Keep what didn't reach the repository so the next write retries it.
+            self.failed = unwritten
+            if self.compaction_pending and last_snapshot >= 0:
+                # The snapshot is gone; let the next save take a new one.
+                self.compaction_pending = False
+            self.last_error = str(e)
+            logging.error(f"Error saving data: {str(e)}")
+            self.status.put(('error', str(e)))
@@ -0,0 +1,461 @@
+import bisect
+from array import array
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from datetime import date
+
+from .models import format_date
+
+# Column values standing in for "none" in the integer columns.
+NO_BATCH = -1
+NO_DATE = 0
+
+class StringTable:
+    # Dictionary encoding: each distinct string is stored once and rows keep
+    # its integer code. Codes are dense, so they can index lookup arrays.
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+        self.values: List[str] = []
+
+    def encode(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __getitem__(self, code: int) -> str:
+        return self.values[code]
+
+    def __len__(self):
+        return len(self.values)
+
+class WasteRecord:
+    # Read-only view of one row in a WasteStore with the WasteItem attributes.
+    # It holds only the record id, so it stays valid when the store compacts.
+
+    __slots__ = ('store', 'record_id')
+
+    def __init__(self, store: 'WasteStore', record_id: int):
+        self.store = store
+        self.record_id = record_id
+
+    def __eq__(self, other):
+        return isinstance(other, WasteRecord) and other.store is self.store and other.record_id == self.record_id
+
+    def __hash__(self):
+        return hash(self.record_id)
+
+    @property
+    def _row(self) -> int:
+        return self.store.row_of(self.record_id)
+
+    @property
+    def item(self) -> str:
+        return self.store.item_names[self.store.items[self._row]]
+
+    @property
+    def quantity_wasted(self) -> int:
+        return self.store.quantities[self._row]
+
+    @property
+    def date_ordinal(self) -> Optional[int]:
+        ordinal = self.store.dates[self._row]
+        return None if ordinal == NO_DATE else ordinal
+
+    @property
+    def date_has_year(self) -> bool:
+        return bool(self.store.has_year[self._row])
+
+    @property
+    def date(self) -> str:
+        return self.to_csv_row()['date']
+
+    @property
+    def reason(self) -> str:
+        return self.store.reason_names[self.store.reasons[self._row]]
+
+    @property
+    def category(self) -> str:
+        return self.store.category_names[self.store.categories[self._row]]
+
+    @property
+    def notes(self) -> str:
+        return self.store.note_texts[self.store.notes[self._row]]
+
+    @property
+    def batch_id(self) -> Optional[int]:
+        batch_id = self.store.batch_ids[self._row]
+        return None if batch_id == NO_BATCH else batch_id
+
+    def to_csv_row(self) -> Dict:
+        store, row = self.store, self._row
+        batch_id = store.batch_ids[row]
+        if store.dates[row] == NO_DATE:
+            date = store.date_texts.get(self.record_id, "")
+        else:
+            date = format_date(store.dates[row], bool(store.has_year[row]))
+        return {
+            'item': store.item_names[store.items[row]],
+            'quantity_wasted': str(store.quantities[row]),
+            'date': date,
+            'reason': store.reason_names[store.reasons[row]],
+            'notes': store.note_texts[store.notes[row]],
+            'batch_id': str(batch_id) if batch_id != NO_BATCH else '',
+            'record_id': str(self.record_id)
+        }
+
+class WasteSelection:
+    # A sequence of records by id; supports len(), indexing, slicing and
+    # iteration, which is all the list views need.
+
+    def __init__(self, store: 'WasteStore', record_ids):
+        self.store = store
+        self.record_ids = record_ids
+
+    def __len__(self):
+        return len(self.record_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [WasteRecord(self.store, record_id) for record_id in self.record_ids[index]]
+        return WasteRecord(self.store, self.record_ids[index])
+
+    def __iter__(self) -> Iterator[WasteRecord]:
+        for record_id in self.record_ids:
+            yield WasteRecord(self.store, record_id)
+
+def month_number(ordinal: int) -> int:
+    # Months counted from January 1970, as analytics.period_numbers does.
+    day = date.fromordinal(ordinal)
+    return (day.year - 1970) * 12 + day.month - 1
+
+class WasteTotals:
+    # Running quantity totals of a store's live rows, so the views refreshed
+    # on every edit (the all-time chart, this month's summary) don't rescan
+    # the history. Built from the columns in one numpy pass on first use,
+    # then kept current by every add and remove.
+    #
+    # by[dimension] maps string table codes to totals over all rows;
+    # months[dimension][month number] does the same for dated rows of that
+    # month, and days maps ordinals to the total of dated rows. Dated means
+    # with a year: year-less dates can't be placed on a timeline. Zero
+    # totals and empty months are dropped.
+
+    DIMENSIONS = (('item', 'items'), ('reason', 'reasons'), ('category', 'categories'))
+
+    def __init__(self):
+        self.by = {dimension: {} for dimension, _ in self.DIMENSIONS}
+        self.months = {dimension: {} for dimension, _ in self.DIMENSIONS}
+        self.days: Dict[int, int] = {}
+
+    @classmethod
+    def build(cls, store: 'WasteStore') -> 'WasteTotals':
+        import numpy as np
+        from .analytics import period_numbers
+        totals = cls()
+        alive = np.frombuffer(store.alive, dtype=np.uint8).astype(bool)
+        quantities = np.frombuffer(store.quantities, dtype=np.int32)[alive].astype(np.int64)
+        dates = np.frombuffer(store.dates, dtype=np.int32)[alive]
+        dated = np.frombuffer(store.has_year, dtype=np.uint8)[alive].astype(bool) & (dates != NO_DATE)
+        days, inverse = np.unique(dates[dated], return_inverse=True)
+        sums = np.bincount(inverse, weights=quantities[dated], minlength=len(days))
+        totals.days = {int(day): int(total) for day, total in zip(days, sums) if total}
+        months = period_numbers(dates[dated], 'month')
+        for dimension, column in cls.DIMENSIONS:
+            codes = np.frombuffer(getattr(store, column), dtype=np.int32)[alive]
+            sums = np.bincount(codes, weights=quantities).astype(np.int64)
+            totals.by[dimension] = {int(code): int(sums[code]) for code in np.flatnonzero(sums)}
+            size = int(codes.max()) + 1 if len(codes) else 1
+            pairs, inverse = np.unique(months * size + codes[dated], return_inverse=True)
+            sums = np.bincount(inverse, weights=quantities[dated], minlength=len(pairs))
+            by_month = totals.months[dimension]
+            for pair, total in zip(pairs.tolist(), sums.tolist()):
+                if total:
+                    by_month.setdefault(pair // size, {})[pair % size] = int(total)
+        return totals
+
+    @staticmethod
+    def _bump(totals: Dict, key: int, quantity: int):
+        total = totals.get(key, 0) + quantity
+        if total:
+            totals[key] = total
+        else:
+            totals.pop(key, None)
+
+    def count(self, store: 'WasteStore', row: int, sign: int):
+        # Adds (sign 1) or takes away (sign -1) one row of store.
+        quantity = store.quantities[row] * sign
+        ordinal = store.dates[row] if store.has_year[row] else NO_DATE
+        month = month_number(ordinal) if ordinal != NO_DATE else None
+        for dimension, column in self.DIMENSIONS:
+            code = getattr(store, column)[row]
+            self._bump(self.by[dimension], code, quantity)
+            if month is not None:
+                by_month = self.months[dimension].setdefault(month, {})
+                self._bump(by_month, code, quantity)
+                if not by_month:
+                    del self.months[dimension][month]
+        if ordinal != NO_DATE:
+            self._bump(self.days, ordinal, quantity)
+
+class WasteStore:
+    # Waste records kept column by column in typed arrays, with item, reason,
+    # category and notes text dictionary-encoded. Dates that didn't parse are
+    # rare, so their text lives in a side dict keyed by record id.
+    #
+    # Rows are appended; removal only clears the alive flag until enough dead
+    # rows pile up to rewrite the columns. Ids normally arrive in increasing
+    # order, so finding a row is a bisect over record_ids; an id that arrives
+    # out of order switches the store to a dict index instead.
+
+    COMPACT_MIN_DEAD = 4096
+    COLUMNS = ('record_ids', 'quantities', 'dates', 'has_year', 'items', 'reasons', 'categories', 'notes',
+               'batch_ids', 'alive')
+
+    def __init__(self):
+        self.record_ids = array('i')
+        self.quantities = array('i')
+        self.dates = array('i')
+        self.has_year = bytearray()
+        self.items = array('i')
+        self.reasons = array('i')
+        self.categories = array('i')
+        self.notes = array('i')
+        self.batch_ids = array('i')
+        self.alive = bytearray()
+        self.item_names = StringTable()
+        self.reason_names = StringTable()
+        self.category_names = StringTable()
+        self.note_texts = StringTable()
+        self.date_texts: Dict[int, str] = {}
+        # Record ids per batch id, None holding the individually logged ones.
+        self.batch_members = defaultdict(lambda: array('i'))
+        self.live = 0
+        # Bumped on every add and remove so readers can tell the data changed.
+        self.version = 0
+        self._index: Optional[Dict[int, int]] = None
+        self._totals: Optional[WasteTotals] = None
+
+    def _columns(self):
+        return tuple(getattr(self, name) for name in self.COLUMNS)
+
+    @property
+    def totals(self) -> WasteTotals:
+        # Anything that changes row values other than through _append() and
+        # remove() sets _totals back to None; reordering rows is fine.
+        if self._totals is None:
+            self._totals = WasteTotals.build(self)
+        return self._totals
+
+    def __len__(self):
+        return self.live
+
+    def __contains__(self, record_id: int) -> bool:
+        try:
+            self.row_of(record_id)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, record_id: int) -> WasteRecord:
+        self.row_of(record_id)
+        return WasteRecord(self, record_id)
+
+    def __iter__(self) -> Iterator[int]:
+        for row, record_id in enumerate(self.record_ids):
+            if self.alive[row]:
+                yield record_id
+
+    def values(self) -> Iterator[WasteRecord]:
+        for record_id in self:
+            yield WasteRecord(self, record_id)
+
+    def row_of(self, record_id: int) -> int:
+        if self._index is not None:
+            row = self._index[record_id]
+        else:
+            row = bisect.bisect_left(self.record_ids, record_id)
+            if row == len(self.record_ids) or self.record_ids[row] != record_id:
+                raise KeyError(record_id)
+        if not self.alive[row]:
+            raise KeyError(record_id)
+        return row
+
+    def add(self, record, category: str) -> WasteRecord:
+        # record is anything with the WasteItem attributes and a record id.
+        record_id = record.record_id
+        if record_id in self:
+            raise KeyError(f"Duplicate waste record id {record_id}")
+        row = len(self.record_ids)
+        if self._index is None and row and record_id <= self.record_ids[-1]:
+            self._index = {existing: position for position, existing in enumerate(self.record_ids)}
+        if self._index is not None:
+            self._index[record_id] = row
+        self._append(record, category)
+        return WasteRecord(self, record_id)
+
+    def add_many(self, records: Iterable[Tuple[object, str]]):
+        # (record, category) pairs in any id order, such as a month read back
+        # from the archive. The rows are re-sorted by id once at the end
+        # rather than the store switching to a dict index.
+        batch_ids = set()
+        for record, category in records:
+            self._append(record, category)
+            batch_ids.add(record.batch_id)
+        self._sort_rows()
+        import numpy as np
+        for batch_id in batch_ids:
+            # In place: selections share these arrays.
+            members = self.batch_members[batch_id]
+            members[:] = array('i', np.sort(np.array(members, dtype=np.int32)).tobytes())
+
+    def _sort_rows(self):
+        import numpy as np
+        ids = np.frombuffer(self.record_ids, dtype=np.int32)
+        if (ids[1:] > ids[:-1]).all():
+            self._index = None
+            return
+        order = np.argsort(ids, kind='stable')
+        sorted_ids = ids[order]
+        if (sorted_ids[1:] == sorted_ids[:-1]).any():
+            raise KeyError("Duplicate waste record ids among the added rows")
+        # New columns rather than resizing the old ones, which the views
+        # above still pin.
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            if isinstance(column, bytearray):
+                values = bytearray(np.frombuffer(column, dtype=np.uint8)[order].tobytes())
+            else:
+                values = array(column.typecode)
+                values.frombytes(np.frombuffer(column, dtype=np.int32)[order].tobytes())
+            setattr(self, name, values)
+        self._index = None
+
+    def _append(self, record, category: str):
+        record_id = record.record_id
+        self.record_ids.append(record_id)
+        self.quantities.append(record.quantity_wasted)
+        if record.date_ordinal is None:
+            self.dates.append(NO_DATE)
+            self.has_year.append(0)
+            self.date_texts[record_id] = record.date
+        else:
+            self.dates.append(record.date_ordinal)
+            self.has_year.append(1 if record.date_has_year else 0)
+        self.items.append(self.item_names.encode(record.item))
+        self.reasons.append(self.reason_names.encode(record.reason))
+        self.categories.append(self.category_names.encode(category))
+        self.notes.append(self.note_texts.encode(record.notes))
+        self.batch_ids.append(NO_BATCH if record.batch_id is None else record.batch_id)
+        self.alive.append(1)
+        self.batch_members[record.batch_id].append(record_id)
+        self.live += 1
+        self.version += 1
+        if self._totals is not None:
+            self._totals.count(self, len(self.record_ids) - 1, 1)
+
+    def remove(self, record_id: int):
+        row = self.row_of(record_id)
+        if self._totals is not None:
+            self._totals.count(self, row, -1)
+        self.alive[row] = 0
+        self.date_texts.pop(record_id, None)
+        batch_id = self.batch_ids[row]
+        self.batch_members[None if batch_id == NO_BATCH else batch_id].remove(record_id)
+        self.live -= 1
+        self.version += 1
+        dead = len(self.record_ids) - self.live
+        if dead >= self.COMPACT_MIN_DEAD and dead > self.live:
+            self.compact()
+
+    def compact(self):
+        keep = [row for row, alive in enumerate(self.alive) if alive]
+        for column in self._columns():
+            kept = [column[row] for row in keep]
+            column[:] = bytearray(kept) if isinstance(column, bytearray) else array(column.typecode, kept)
+        if self._index is not None:
+            self._index = {record_id: row for row, record_id in enumerate(self.record_ids)}
+
+    def in_batch(self, batch_id: Optional[int]) -> WasteSelection:
+        # Records of one batch, or with None the individually logged ones.
+        # The selection shares the member array, so it stays current.
+        return WasteSelection(self, self.batch_members[batch_id])
+
+    def drop_batch(self, batch_id: int):
+        self.batch_members.pop(batch_id, None)
+
+    def dump(self, min_date: Optional[int] = None) -> Tuple[Dict, Dict[str, bytes]]:
+        # Everything needed to rebuild the store: JSON-friendly values plus
+        # the raw bytes of each column, so restore() never touches a row.
+        # Records dated before min_date are left out; undated ones never are.
+        if min_date is not None:
+            import numpy as np
+            dates = np.frombuffer(self.dates, dtype=np.int32)
+            keep = (dates >= min_date) | (np.frombuffer(self.has_year, dtype=np.uint8) == 0)
+            if not keep.all():
+                return self._dump_rows(np.flatnonzero(keep))
+        batches = [(NO_BATCH if batch_id is None else batch_id, len(members))
+                   for batch_id, members in self.batch_members.items()]
+        meta = {
+            'item_names': self.item_names.values,
+            'reason_names': self.reason_names.values,
+            'category_names': self.category_names.values,
+            'note_texts': self.note_texts.values,
+            'date_texts': list(self.date_texts.items()),
+            'batches': batches,
+            'live': self.live,
+            'indexed': self._index is not None,
+        }
+        blobs = {name: bytes(getattr(self, name)) for name in self.COLUMNS}
+        blobs['batch_members'] = b''.join(members.tobytes() for members in self.batch_members.values())
+        return meta, blobs
+
+    def _dump_rows(self, rows) -> Tuple[Dict, Dict[str, bytes]]:
+        # dump() of just the given rows, through a copy of the store.
+        import numpy as np
+        subset = WasteStore()
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            if isinstance(column, bytearray):
+                getattr(subset, name)[:] = np.frombuffer(column, dtype=np.uint8)[rows].tobytes()
+            else:
+                getattr(subset, name).frombytes(np.frombuffer(column, dtype=np.int32)[rows].tobytes())
+        kept = np.frombuffer(subset.record_ids, dtype=np.int32)
+        for batch_id, members in self.batch_members.items():
+            members = np.array(members, dtype=np.int32)
+            subset.batch_members[batch_id] = array('i', members[np.isin(members, kept)].tobytes())
+        del kept
+        subset.item_names, subset.reason_names = self.item_names, self.reason_names
+        subset.category_names, subset.note_texts = self.category_names, self.note_texts
+        subset.date_texts = self.date_texts
+        subset.live = sum(subset.alive)
+        # Only whether there is an index matters to dump().
+        subset._index = self._index
+        return subset.dump()
+
+    @classmethod
+    def restore(cls, meta: Dict, blobs: Dict[str, bytes]) -> 'WasteStore':
+        store = cls()
+        for name in cls.COLUMNS:
+            column = getattr(store, name)
+            if isinstance(column, bytearray):
+                column[:] = blobs[name]
+            else:
+                column.frombytes(blobs[name])
+        for table in ('item_names', 'reason_names', 'category_names', 'note_texts'):
+            for value in meta[table]:
+                getattr(store, table).encode(value)
+        store.date_texts = {record_id: text for record_id, text in meta['date_texts']}
+        members = array('i')
+        members.frombytes(blobs['batch_members'])
+        position = 0
+        for batch_id, count in meta['batches']:
+            store.batch_members[None if batch_id == NO_BATCH else batch_id] = members[position:position + count]
+            position += count
+        store.live = meta['live']
+        if meta['indexed']:
+            store._index = {record_id: row for row, record_id in enumerate(store.record_ids)}
+        return store
@@ -1,83 +1,23 @@
 import tkinter as tk
-from tkinter import ttk, messagebox
-from datetime import datetime
-import csv
+from tkinter import ttk, messagebox, filedialog
+from datetime import datetime, date
 import os
-import hashlib
-import base64
-from cryptography.fernet import Fernet
+import math
+import queue
+import threading
 from dotenv import load_dotenv, set_key
 import logging
-from typing import List, Dict, Optional
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from collections import defaultdict
-
-logging.basicConfig(
-    filename='inventory_system.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-
-class SecureStorage:
-    def __init__(self):
-        self.key_file = '.encryption_key'
-        self.encryption_key = self._get_or_create_key()
-        self.cipher_suite = Fernet(self.encryption_key)
-        
-    def _get_or_create_key(self) -> bytes:
-        if os.path.exists(self.key_file):
-            with open(self.key_file, 'rb') as f:
-                return f.read()
-        else:
-            key = Fernet.generate_key()
-            with open(self.key_file, 'wb') as f:
-                f.write(key)
-            os.chmod(self.key_file, 0o600) 
-            return key
-            
-    def encrypt_data(self, data: str) -> str:
-        return self.cipher_suite.encrypt(data.encode()).decode()
-        
-    def decrypt_data(self, encrypted_data: str) -> str:
-        return self.cipher_suite.decrypt(encrypted_data.encode()).decode()
-        
-    def save_secure_csv(self, filename: str, data: List[Dict], fieldnames: List[str]):
-        try:
-            temp_file = f"{filename}.tmp"
-            with open(temp_file, 'w', newline='') as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                for row in data:
-                    encrypted_row = {k: self.encrypt_data(str(v)) for k, v in row.items()}
-                    writer.writerow(encrypted_row)
-                    
-           
-            if os.path.exists(filename):
-                os.remove(filename)
-            os.rename(temp_file, filename)
-            os.chmod(filename, 0o600)  
-            
-            logging.info(f"Successfully saved secure data to {filename}")
-        except Exception as e:
-            logging.error(f"Error saving secure data: {str(e)}")
-            raise
-            
-    def load_secure_csv(self, filename: str, fieldnames: List[str]) -> List[Dict]:
-        if not os.path.exists(filename):
-            return []
-            
-        try:
-            with open(filename, 'r', newline='') as f:
-                reader = csv.DictReader(f)
-                decrypted_data = []
-                for row in reader:
-                    decrypted_row = {k: self.decrypt_data(v) for k, v in row.items()}
-                    decrypted_data.append(decrypted_row)
-                return decrypted_data
-        except Exception as e:
-            logging.error(f"Error loading secure data: {str(e)}")
-            return []
+from typing import Optional
+
+from inventory.core import Inventory, normalize_date
+from inventory.importer import import_file
+from inventory.logs import configure_logging, span
+from inventory.models import InventoryItem, WasteItem
+from inventory.pin import hash_pin, verify_pin_hash, needs_rehash
+from inventory.rekey import RekeyJob, rekey_pending
+from inventory.storage import PersistenceWorker
+
+configure_logging()
 
 class SecureLogin:
     def __init__(self):
@@ -106,10 +46,14 @@ class SecureLogin:
         if not self.stored_pin_hash:
             return True
             
-        pin_hash = hashlib.sha256(pin.encode()).hexdigest()
-        if pin_hash == self.stored_pin_hash:
+        if verify_pin_hash(pin, self.stored_pin_hash):
             self.attempts = 0
             logging.info("Successful login")
+            if needs_rehash(self.stored_pin_hash):
+                # Old SHA-256 hash or changed cost settings: the PIN is known
+                # right now, so store it again the current way.
+                self.store_pin(pin)
+                logging.info("PIN hash upgraded to the current hashing parameters")
             return True
         else:
             self.attempts += 1
@@ -127,100 +71,171 @@ class SecureLogin:
             messagebox.showerror("Error", "PIN must be at least 4 characters long!")
             return False
             
-        pin_hash = hashlib.sha256(pin.encode()).hexdigest()
-        set_key(".env", "PIN_HASH", pin_hash)
-        self.reload_pin_hash()
+        self.store_pin(pin)
         logging.info("PIN successfully updated")
         return True
 
-class InventoryItem:
-    def __init__(self, name: str, quantity: int, expiration_date: str, category: str):
-        self.name = name
-        self.quantity = quantity
-        self.expiration_date = expiration_date
-        self.category = category
-
-    @classmethod
-    def from_csv_row(cls, row: Dict) -> 'InventoryItem':
-        return cls(row['name'], int(row['quantity']), row['expiration_date'], row['category'])
-
-    def to_csv_row(self) -> Dict:
-        return {
-            'name': self.name,
-            'quantity': str(self.quantity),
-            'expiration_date': self.expiration_date,
-            'category': self.category
-        }
-
-class WasteBatch:
-    def __init__(self, batch_date, items, total_waste, notes):
-        self.batch_date = batch_date
-        self.items = items
-        self.total_waste = total_waste
-        self.notes = notes
-
-    @classmethod
-    def from_csv_row(cls, row, items):
-        return cls(row['batch_date'], items, int(row['total_waste']), row['notes'])
-
-    def to_csv_row(self):
-        return {
-            'batch_date': self.batch_date,
-            'total_waste': str(self.total_waste),
-            'notes': self.notes
-        }
-
-class WasteItem:
-    def __init__(self, item, quantity_wasted, date, reason, notes, batch_id=None):
-        self.item = item
-        self.quantity_wasted = quantity_wasted
-        self.date = date
-        self.reason = reason
-        self.notes = notes
-        self.batch_id = batch_id
-
-    @classmethod
-    def from_csv_row(cls, row):
-        batch_id = int(row['batch_id']) if row['batch_id'] else None
-        return cls(
-            row['item'],
-            int(row['quantity_wasted']),
-            row['date'],
-            row['reason'],
-            row['notes'],
-            batch_id
-        )
-
-    def to_csv_row(self):
-        return {
-            'item': self.item,
-            'quantity_wasted': str(self.quantity_wasted),
-            'date': self.date,
-            'reason': self.reason,
-            'notes': self.notes,
-            'batch_id': str(self.batch_id) if self.batch_id is not None else ''
-        }
+    def store_pin(self, pin: str):
+        pin_hash = hash_pin(pin)
+        set_key(".env", "PIN_HASH", pin_hash)
+        # load_dotenv doesn't override variables that are already set, so
+        # update this process's copy directly.
+        os.environ["PIN_HASH"] = pin_hash
+        self.reload_pin_hash()
+
+class VirtualTreeview:
+    # Keeps only the visible window of a record list in a ttk.Treeview. Each
+    # slot is a fixed row that gets its values swapped as the window moves,
+    # and only slots whose contents changed are touched on refresh.
+
+    DEFAULT_ROW_HEIGHT = 20
+
+    def __init__(self, tree: ttk.Treeview, scrollbar: ttk.Scrollbar, row_values, row_tags=None):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.row_values = row_values
+        self.row_tags = row_tags or (lambda record: ())
+        self.rows = []
+        self.offset = 0
+        self.visible_rows = 1
+        self.rendered = []
+        self.selected = None
+        # The record new_selection() last returned.
+        self.taken = None
+
+        self.scrollbar.configure(command=self.yview)
+        self.tree.bind("<Configure>", self._on_resize, add=True)
+        self.tree.bind("<<TreeviewSelect>>", self._on_select, add=True)
+        self.tree.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1), add=True)
+        self.tree.bind("<Button-4>", lambda e: self.scroll(-1), add=True)
+        self.tree.bind("<Button-5>", lambda e: self.scroll(1), add=True)
+
+    def set_rows(self, rows):
+        self.rows = rows
+        self.selected = None
+        self.taken = None
+        self.offset = max(0, min(self.offset, len(self.rows) - self.visible_rows))
+        self.render()
+
+    def selected_index(self) -> Optional[int]:
+        return self.selected
+
+    def selected_record(self):
+        return self.rows[self.selected] if self.selected is not None else None
+
+    def new_selection(self):
+        # The selected record, or None if it is the one returned last time.
+        # render() re-selects the row whenever it comes back into view, which
+        # fires <<TreeviewSelect>> again without the user picking anything.
+        record = self.selected_record()
+        if record is None or record == self.taken:
+            return None
+        self.taken = record
+        return record
+
+    def clear_selection(self):
+        self.selected = None
+        self.taken = None
+        self.tree.selection_remove(self.tree.selection())
+
+    def scroll(self, units: int):
+        self._move_to(self.offset + units)
+
+    def yview(self, *args):
+        if args[0] == 'moveto':
+            self._move_to(int(float(args[1]) * len(self.rows)))
+        elif args[0] == 'scroll':
+            step = self.visible_rows if args[2] == 'pages' else 1
+            self._move_to(self.offset + int(args[1]) * step)
+
+    def _move_to(self, offset: int):
+        offset = max(0, min(offset, len(self.rows) - self.visible_rows))
+        if offset != self.offset:
+            self.offset = offset
+            self.render()
+
+    def _on_resize(self, event):
+        children = self.tree.get_children()
+        bbox = self.tree.bbox(children[0]) if children else None
+        row_height = bbox[3] if bbox else self.DEFAULT_ROW_HEIGHT
+        header_height = bbox[1] if bbox else self.DEFAULT_ROW_HEIGHT
+        visible_rows = max(1, (event.height - header_height) // row_height + 1)
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self.offset = max(0, min(self.offset, len(self.rows) - self.visible_rows))
+            self.render()
+
+    def _on_select(self, event):
+        selection = self.tree.selection()
+        if selection:
+            self.selected = self.offset + self.tree.index(selection[0])
+
+    def render(self):
+        window = self.rows[self.offset:self.offset + self.visible_rows]
+        wanted = [(tuple(self.row_values(record)), tuple(self.row_tags(record))) for record in window]
+
+        for slot, (values, tags) in enumerate(wanted):
+            if slot >= len(self.rendered):
+                self.tree.insert("", tk.END, iid=f"slot{slot}", values=values, tags=tags)
+                self.rendered.append((values, tags))
+            elif self.rendered[slot] != (values, tags):
+                self.tree.item(f"slot{slot}", values=values, tags=tags)
+                self.rendered[slot] = (values, tags)
+        while len(self.rendered) > len(wanted):
+            self.rendered.pop()
+            self.tree.delete(f"slot{len(self.rendered)}")
+
+        selected_slot = self.selected - self.offset if self.selected is not None else None
+        if selected_slot is not None and 0 <= selected_slot < len(wanted):
+            if self.tree.selection() != (f"slot{selected_slot}",):
+                self.tree.selection_set(f"slot{selected_slot}")
+        elif self.tree.selection():
+            self.tree.selection_remove(self.tree.selection())
+
+        if self.rows:
+            self.scrollbar.set(self.offset / len(self.rows), (self.offset + len(wanted)) / len(self.rows))
+        else:
+            self.scrollbar.set(0, 1)
 
 class InventoryManager:
+    # Milliseconds without further edits before the chart is redrawn.
+    CHART_DEBOUNCE_MS = 300
+    # Filter dropdown entry that turns the filter off.
+    FILTER_ALL = "All"
+
     def __init__(self, root: tk.Tk):
         self.root = root
         self.root.title("Restaurant Inventory Management")
         self.root.geometry("1000x800")
         
-        self.storage = SecureStorage()
-        self.items = []
-        self.waste_items = []
-        self.waste_batches = []
+        self.inventory = Inventory()
         self.current_batch_items = []
         self.current_batch_total = 0
         
-        self.load_data()
+        if not self.load_data():
+            # Closing without saving keeps the unreadable files as they are.
+            self.root.destroy()
+            return
+        self.persistence = PersistenceWorker(self.inventory.repository)
         
         self.main_frame = ttk.Frame(root)
         self.main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
         
         self.notebook = ttk.Notebook(self.main_frame)
         self.notebook.pack(fill=tk.BOTH, expand=True)
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+        
+        status_frame = ttk.Frame(self.main_frame)
+        status_frame.pack(fill=tk.X, pady=(5, 0))
+        self.save_status_var = tk.StringVar(value="All changes saved")
+        ttk.Label(status_frame, textvariable=self.save_status_var, anchor=tk.W).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.rotate_key_button = ttk.Button(status_frame, text="Rotate Encryption Key", command=self.rotate_key)
+        self.rotate_key_button.pack(side=tk.RIGHT)
+        self.rekey_status_var = tk.StringVar()
+        ttk.Label(status_frame, textvariable=self.rekey_status_var, anchor=tk.E).pack(side=tk.RIGHT, padx=5)
+        self.rekey_job = None
+        self.rekey_progress = queue.Queue()
+        self.root.after(200, self.poll_save_status)
         
         self.inventory_frame = ttk.Frame(self.notebook)
         self.notebook.add(self.inventory_frame, text="Inventory")
@@ -244,11 +259,33 @@ class InventoryManager:
         chart_container = ttk.Frame(self.chart_frame)
         chart_container.pack(expand=True)
         
-        # Add refresh button for chart
-        ttk.Button(chart_container, text="Refresh Chart", command=self.update_waste_chart).pack(pady=5)
+        # Chart controls and refresh button
+        chart_controls = ttk.Frame(chart_container)
+        chart_controls.pack(pady=5)
+        ttk.Label(chart_controls, text="Breakdown:").pack(side=tk.LEFT)
+        self.chart_dimension_var = tk.StringVar(value="Reason")
+        dimension_combo = ttk.Combobox(chart_controls, textvariable=self.chart_dimension_var,
+                                       values=["Reason", "Item", "Category"], state="readonly", width=10)
+        dimension_combo.pack(side=tk.LEFT, padx=5)
+        dimension_combo.bind("<<ComboboxSelected>>", lambda e: self.update_waste_chart())
+        ttk.Label(chart_controls, text="Period:").pack(side=tk.LEFT)
+        self.chart_period_var = tk.StringVar(value="All Time")
+        period_combo = ttk.Combobox(chart_controls, textvariable=self.chart_period_var,
+                                    values=["All Time", "This Year", "This Month", "Last 30 Days"],
+                                    state="readonly", width=12)
+        period_combo.pack(side=tk.LEFT, padx=5)
+        period_combo.bind("<<ComboboxSelected>>", lambda e: self.update_waste_chart())
+        ttk.Button(chart_controls, text="Refresh Chart",
+                   command=lambda: self.update_waste_chart(force=True)).pack(side=tk.LEFT, padx=5)
+
+        self.analytics_summary_var = tk.StringVar()
+        ttk.Label(chart_container, textvariable=self.analytics_summary_var, justify=tk.LEFT).pack(pady=5)
         
-        # Initial chart creation
-        self.create_waste_chart(chart_container)
+        # The chart itself is created the first time the tab is shown
+        self.chart_container = chart_container
+        self.fig = None
+        self.chart_key = None
+        self.chart_after_id = None
         
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         
@@ -257,24 +294,47 @@ class InventoryManager:
         self.root.after_idle(self.root.attributes, '-topmost', False)
         
         self.update_item_list()
-        self.update_waste_list()
-        self.update_batch_list()
+        self.start_history_load()
         
     def validate_date(self, date_str):
-        try:
-            if len(date_str.split('/')) == 3:
-                return datetime.strptime(date_str, "%m/%d/%Y").strftime("%m/%d/%Y")
-            elif len(date_str.split('/')) == 2:
-                return datetime.strptime(date_str, "%m/%d").strftime("%m/%d")
-            else:
-                return None
-        except ValueError:
-            return None
+        return normalize_date(date_str)
             
     def on_closing(self):
         try:
-            self.save_data()
-            plt.close('all')  # Close all matplotlib figures
+            if self.history_thread.is_alive() or self.history_error is not None:
+                # Nothing can be edited before the history has loaded, so
+                # there is nothing to save; just let the reader finish.
+                self.history_thread.join()
+                if self.history_error is not None:
+                    self.inventory.close()
+                    self.root.destroy()
+                    return
+            rekeying = self.rekey_job is not None and self.rekey_job.is_running()
+            if self.rekey_job is not None:
+                # It picks up from its last checkpoint on the next start.
+                self.rekey_job.stop()
+            # Blocks until everything queued has been written.
+            try:
+                self.persistence.flush(self.inventory.take_pending(), self.inventory.capture_snapshot())
+            except Exception as e:
+                logging.error(f"Error saving data on exit: {str(e)}")
+                if not messagebox.askyesno("Save Error",
+                        f"Error saving data: {str(e)}\n\nClose anyway? Changes that were not saved will be lost."):
+                    # Stay open; the unsaved changes are retried with the next save.
+                    self.persistence.resume()
+                    if rekeying:
+                        self.start_rekey()
+                    return
+                # The files don't match what is in memory, so no snapshot.
+                self.inventory.close()
+                self.root.destroy()
+                return
+            # The files were just compacted to exactly what is in memory, so
+            # this is the moment a snapshot for the next start is valid.
+            self.inventory.save_snapshot()
+            self.inventory.close()
+            if self.chart_after_id is not None:
+                self.root.after_cancel(self.chart_after_id)
             self.root.quit()  # Quit the mainloop
             self.root.destroy()  # Destroy the window
         except Exception as e:
@@ -285,6 +345,12 @@ class InventoryManager:
         self.list_frame = ttk.LabelFrame(self.inventory_frame, text="Inventory Items")
         self.list_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5)
         
+        self.item_search_var = tk.StringVar()
+        self.item_category_filter_var = tk.StringVar(value=self.FILTER_ALL)
+        self.create_search_bar(self.list_frame, self.item_search_var, self.update_item_list,
+            [("Category:", self.item_category_filter_var,
+              lambda: sorted(self.inventory.item_columns.categories.values))])
+        
         self.tree = ttk.Treeview(self.list_frame, columns=("Name", "Quantity", "Expiration", "Category"), show="headings")
         self.tree.heading("Name", text="Name")
         self.tree.heading("Quantity", text="Quantity")
@@ -296,13 +362,16 @@ class InventoryManager:
         self.tree.column("Expiration", width=150)
         self.tree.column("Category", width=100)
         
-        scrollbar = ttk.Scrollbar(self.list_frame, orient=tk.VERTICAL, command=self.tree.yview)
-        self.tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar = ttk.Scrollbar(self.list_frame, orient=tk.VERTICAL)
+        self.item_view = VirtualTreeview(self.tree, scrollbar, self._item_values, self._item_tags)
         
         self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         
-        self.tree.bind("<<TreeviewSelect>>", self.on_item_select)
+        self.tree.tag_configure('expired', background='red')
+        self.tree.tag_configure('expiring_soon', background='yellow')
+        
+        self.tree.bind("<<TreeviewSelect>>", self.on_item_select, add=True)
         self.tree.bind("<Button-3>", self.unselect_item)  
         self.tree.bind("<Escape>", self.unselect_item)  
         
@@ -329,14 +398,30 @@ class InventoryManager:
         button_frame = ttk.Frame(self.details_frame)
         button_frame.grid(row=4, column=0, columnspan=2, pady=10)
         
-        ttk.Button(button_frame, text="Save", command=self.save_item).pack(side=tk.LEFT, padx=5)
-        ttk.Button(button_frame, text="Delete", command=self.delete_item).pack(side=tk.LEFT, padx=5)
-        
         sort_frame = ttk.Frame(self.details_frame)
         sort_frame.grid(row=5, column=0, columnspan=2, pady=5)
         
-        ttk.Button(sort_frame, text="Sort by Name", command=lambda: self.sort_items("Name")).pack(side=tk.LEFT, padx=5)
-        ttk.Button(sort_frame, text="Sort by Expiration", command=lambda: self.sort_items("Expiration")).pack(side=tk.LEFT, padx=5)
+        # Buttons that change the inventory, disabled until loading finishes.
+        self.item_edit_buttons = [
+            ttk.Button(button_frame, text="Save", command=self.save_item),
+            ttk.Button(button_frame, text="Delete", command=self.delete_item),
+            ttk.Button(button_frame, text="Import File", command=self.import_items),
+            ttk.Button(sort_frame, text="Sort by Name", command=lambda: self.sort_items("Name")),
+            ttk.Button(sort_frame, text="Sort by Expiration", command=lambda: self.sort_items("Expiration")),
+        ]
+        for button in self.item_edit_buttons:
+            button.pack(side=tk.LEFT, padx=5)
+        
+        filter_frame = ttk.Frame(self.details_frame)
+        filter_frame.grid(row=6, column=0, columnspan=2, pady=5)
+        
+        self.expiring_filter_var = tk.BooleanVar()
+        self.expiring_days_var = tk.StringVar(value="7")
+        ttk.Checkbutton(filter_frame, text="Only expiring within", variable=self.expiring_filter_var,
+            command=self.update_item_list).pack(side=tk.LEFT, padx=5)
+        ttk.Spinbox(filter_frame, from_=0, to=365, width=4, textvariable=self.expiring_days_var,
+            command=self.update_item_list).pack(side=tk.LEFT)
+        ttk.Label(filter_frame, text="days").pack(side=tk.LEFT, padx=5)
         
     def setup_drag_drop(self):
         self.tree.bind("<Button-1>", self.start_drag)
@@ -350,7 +435,7 @@ class InventoryManager:
         if hasattr(self, 'drag_data'):
             dx = event.x - self.drag_data["x"]
             dy = event.y - self.drag_data["y"]
-            self.tree.yview_scroll(int(-1*(dy/120)), "units")
+            self.item_view.scroll(int(-1*(dy/120)))
             self.drag_data["x"] = event.x
             self.drag_data["y"] = event.y
             
@@ -375,15 +460,7 @@ class InventoryManager:
                 return
                 
             item = InventoryItem(name, quantity, formatted_date, category)
-            
-            selected = self.tree.selection()
-            if selected:
-                index = self.tree.index(selected[0])
-                self.items[index] = item
-            else:
-                self.items.append(item)
-                
-            self.items.sort(key=lambda x: datetime.strptime(x.expiration_date, "%m/%d/%Y") if len(x.expiration_date.split('/')) == 3 else datetime.strptime(x.expiration_date, "%m/%d"))
+            self.inventory.add_item(item, replace_index=self.selected_item_index())
             
             self.update_item_list()
             self.save_data()
@@ -391,54 +468,102 @@ class InventoryManager:
         except ValueError:
             messagebox.showerror("Quantity must be a number")
             
+    def import_items(self):
+        path = filedialog.askopenfilename(
+            title="Import delivery sheet",
+            filetypes=[("Delivery sheets", "*.csv *.json *.jsonl"), ("All files", "*.*")])
+        if not path:
+            return
+            
+        try:
+            report = import_file(self.inventory, path)
+        except Exception as e:
+            logging.error(f"Error importing {path}: {str(e)}")
+            messagebox.showerror("Import Error", f"Could not read {path}: {str(e)}")
+            return
+            
+        self.update_item_list()
+        self.save_data(compact=True)
+        logging.info(report.summary())
+        
+        message = report.summary()
+        if report.errors:
+            shown = "\n".join(f"Line {line}: {error}" for line, error in report.errors[:10])
+            more = len(report.errors) - 10
+            message += f"\n\n{shown}" + (f"\n...and {more} more" if more > 0 else "")
+        messagebox.showinfo("Import", message)
+            
     def delete_item(self):
-        selected = self.tree.selection()
-        if selected:
-            index = self.tree.index(selected[0])
-            del self.items[index]
+        index = self.selected_item_index()
+        if index is not None:
+            self.inventory.delete_item(index)
             self.update_item_list()
             self.save_data()
             
     def on_item_select(self, event):
-        selected = self.tree.selection()
-        if selected:
-            index = self.tree.index(selected[0])
-            item = self.items[index]
+        # Only a different record refills the form, so edits in progress
+        # survive scrolling.
+        item = self.item_view.new_selection()
+        if item is not None:
             self.name_var.set(item.name)
             self.quantity_var.set(str(item.quantity))
             self.expiration_var.set(item.expiration_date)
             self.category_var.set(item.category)
             
-    def update_item_list(self):
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-            
-        for item in self.items:
-            expiration_date = datetime.strptime(item.expiration_date, "%m/%d/%Y") if len(item.expiration_date.split('/')) == 3 else datetime.strptime(item.expiration_date, "%m/%d")
-            days_until_expiration = (expiration_date - datetime.now()).days
+    def selected_item_index(self) -> Optional[int]:
+        # The view may be showing a filtered subset, so map back through the record.
+        item = self.item_view.selected_record()
+        return self.inventory.items.index(item) if item is not None else None
+        
+    def create_search_bar(self, parent, search_var, update, filters):
+        # A search box plus one dropdown per (label, variable, values) filter;
+        # the list is refreshed on every keystroke and selection. Dropdown
+        # values are collected when the dropdown opens.
+        search_frame = ttk.Frame(parent)
+        search_frame.pack(side=tk.TOP, fill=tk.X, pady=(0, 5))
+        ttk.Label(search_frame, text="Search:").pack(side=tk.LEFT)
+        ttk.Entry(search_frame, textvariable=search_var).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        search_var.trace_add('write', lambda *args: update())
+        for label, variable, values in filters:
+            ttk.Label(search_frame, text=label).pack(side=tk.LEFT)
+            combo = ttk.Combobox(search_frame, textvariable=variable, state="readonly", width=12)
+            combo.configure(postcommand=lambda combo=combo, values=values: combo.configure(values=[self.FILTER_ALL] + values()))
+            combo.pack(side=tk.LEFT, padx=5)
+            combo.bind("<<ComboboxSelected>>", lambda e: update())
             
-            if expiration_date < datetime.now():
-                tag = 'expired'
-            elif days_until_expiration <= 7:
-                tag = 'expiring_soon'
-            else:
-                tag = ''
-                
-            self.tree.insert("", tk.END, values=(
-                item.name,
-                item.quantity,
-                item.expiration_date,
-                item.category
-            ), tags=(tag,))
+    def filter_value(self, variable) -> Optional[str]:
+        value = variable.get()
+        return None if value == self.FILTER_ALL else value
         
-        self.tree.tag_configure('expired', background='red')
-        self.tree.tag_configure('expiring_soon', background='yellow')
+    def update_item_list(self):
+        with span('update_item_list') as timing:
+            self.today_ordinal = date.today().toordinal()
+            items = None
+            if self.expiring_filter_var.get():
+                try:
+                    days = int(self.expiring_days_var.get())
+                except ValueError:
+                    days = 7
+                items = self.inventory.items_expiring_between(self.today_ordinal, self.today_ordinal + days)
+            rows = self.inventory.search_items(
+                self.item_search_var.get(), self.filter_value(self.item_category_filter_var), items)
+            self.item_view.set_rows(rows)
+            timing['rows'] = len(rows)
+        
+    def _item_values(self, item):
+        return (item.name, item.quantity, item.expiration_date, item.category)
+        
+    def _item_tags(self, item):
+        # An item expires at the start of its day, so it is already expired
+        # today and "soon" covers the next 8 days.
+        if item.expiration_ordinal <= self.today_ordinal:
+            return ('expired',)
+        elif item.expiration_ordinal <= self.today_ordinal + 8:
+            return ('expiring_soon',)
+        return ()
         
     def sort_items(self, column):
-        if column == "Name":
-            self.items.sort(key=lambda x: x.name)
-        elif column == "Expiration":
-            self.items.sort(key=lambda x: datetime.strptime(x.expiration_date, "%m/%d/%Y") if len(x.expiration_date.split('/')) == 3 else datetime.strptime(x.expiration_date, "%m/%d"))
+        self.inventory.sort_items(column)
         self.update_item_list()
         
     def create_waste_tracker(self):
@@ -461,6 +586,14 @@ class InventoryManager:
         self.waste_list_frame = ttk.LabelFrame(parent, text="Waste Items")
         self.waste_list_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5)
         
+        self.waste_search_var = tk.StringVar()
+        self.waste_reason_filter_var = tk.StringVar(value=self.FILTER_ALL)
+        self.waste_category_filter_var = tk.StringVar(value=self.FILTER_ALL)
+        self.create_search_bar(self.waste_list_frame, self.waste_search_var, self.update_waste_list, [
+            ("Reason:", self.waste_reason_filter_var, lambda: sorted(self.inventory.waste_records.reason_names.values)),
+            ("Category:", self.waste_category_filter_var, lambda: sorted(self.inventory.waste_records.category_names.values)),
+        ])
+        
         self.waste_tree = ttk.Treeview(self.waste_list_frame, columns=("Item", "Quantity Wasted", "Date", "Reason", "Notes", "Batch"), show="headings")
         self.waste_tree.heading("Item", text="Item")
         self.waste_tree.heading("Quantity Wasted", text="Quantity Wasted")
@@ -476,13 +609,14 @@ class InventoryManager:
         self.waste_tree.column("Notes", width=200)
         self.waste_tree.column("Batch", width=100)
         
-        scrollbar = ttk.Scrollbar(self.waste_list_frame, orient=tk.VERTICAL, command=self.waste_tree.yview)
-        self.waste_tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar = ttk.Scrollbar(self.waste_list_frame, orient=tk.VERTICAL)
+        self.waste_view = VirtualTreeview(self.waste_tree, scrollbar,
+            lambda item: (item.item, item.quantity_wasted, item.date, item.reason, item.notes, ""))
         
         self.waste_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         
-        self.waste_tree.bind("<<TreeviewSelect>>", self.on_waste_select)
+        self.waste_tree.bind("<<TreeviewSelect>>", self.on_waste_select, add=True)
         self.waste_tree.bind("<Button-3>", self.unselect_waste)  
         self.waste_tree.bind("<Escape>", self.unselect_waste)    
         
@@ -529,13 +663,20 @@ class InventoryManager:
         self.batch_tree.column("Items", width=200)
         self.batch_tree.column("Notes", width=200)
         
-        scrollbar = ttk.Scrollbar(self.batch_list_frame, orient=tk.VERTICAL, command=self.batch_tree.yview)
-        self.batch_tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar = ttk.Scrollbar(self.batch_list_frame, orient=tk.VERTICAL)
+        self.batch_view = VirtualTreeview(self.batch_tree, scrollbar, lambda batch: (
+            batch.batch_date,
+            batch.total_waste,
+            # Batches from archived months have their entries on disk.
+            ", ".join([f"{item.item} ({item.quantity_wasted})" for item in batch.items])
+                or ("(archived)" if batch.total_waste else ""),
+            batch.notes
+        ))
         
         self.batch_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         
-        self.batch_tree.bind("<<TreeviewSelect>>", self.on_batch_select)
+        self.batch_tree.bind("<<TreeviewSelect>>", self.on_batch_select, add=True)
         self.batch_tree.bind("<Button-3>", self.unselect_batch)
         self.batch_tree.bind("<Escape>", self.unselect_batch)
         
@@ -606,31 +747,10 @@ class InventoryManager:
             messagebox.showerror("Error", "Invalid date format, Use MM/DD or MM/DD/YYYY")
             return
             
-        batch = WasteBatch(
-            formatted_date,
-            self.current_batch_items.copy(),
-            self.current_batch_total,
-            self.batch_notes_var.get()
-        )
-        batch_id = len(self.waste_batches)
-        items_to_remove = []
-        for batch_item in self.current_batch_items:
-            batch_item.batch_id = batch_id
-            
-            for waste_item in self.waste_items:
-                if (waste_item.item == batch_item.item and 
-                    waste_item.quantity_wasted == batch_item.quantity_wasted and 
-                    waste_item.date == batch_item.date):
-                    items_to_remove.append(waste_item)
-        
-        for item in items_to_remove:
-            if item in self.waste_items:
-                self.waste_items.remove(item)
-            
-        self.waste_batches.append(batch)
+        self.inventory.add_batch(formatted_date, self.current_batch_items, self.batch_notes_var.get())
         self.update_batch_list()
         self.update_waste_list()
-        self.update_waste_chart() 
+        self.schedule_chart_update()
         self.save_data()
         
         self.current_batch_items = []
@@ -640,23 +760,18 @@ class InventoryManager:
         self.batch_notes_var.set("")
         
     def delete_batch(self):
-        selected = self.batch_tree.selection()
-        if not selected:
+        batch = self.batch_view.selected_record()
+        if batch is None:
             messagebox.showwarning("Warning", "Please select a batch to delete")
             return
             
         try:
-            index = self.batch_tree.index(selected[0])
-            if index >= len(self.waste_batches):
+            if batch.batch_id not in self.inventory.waste_batches:
                 messagebox.showerror("Error", "Invalid batch selection")
                 return
                 
-            batch = self.waste_batches[index]
-            del self.waste_batches[index]
+            self.inventory.delete_batch(batch.batch_id)
             
-            for i, remaining_batch in enumerate(self.waste_batches):
-                for item in remaining_batch.items:
-                    item.batch_id = i
             if self.current_batch_items and self.batch_date_var.get() == batch.batch_date:
                 self.current_batch_items = []
                 self.current_batch_total = 0
@@ -666,10 +781,10 @@ class InventoryManager:
             
             self.update_batch_list()
             self.update_waste_list()
-            self.update_waste_chart()  
+            self.schedule_chart_update()
             self.save_data()
             
-            logging.info(f"Successfully deleted batch {index}")
+            logging.info(f"Successfully deleted batch {batch.batch_id}")
             messagebox.showinfo("Success", "Batch deleted successfully")
             
         except Exception as e:
@@ -677,25 +792,16 @@ class InventoryManager:
             messagebox.showerror("Error", f"Failed to delete batch: {str(e)}")
         
     def on_batch_select(self, event):
-        selected = self.batch_tree.selection()
-        if selected:
-            index = self.batch_tree.index(selected[0])
-            batch = self.waste_batches[index]
+        batch = self.batch_view.new_selection()
+        if batch is not None:
             self.batch_date_var.set(batch.batch_date)
             self.batch_notes_var.set(batch.notes)
             
     def update_batch_list(self):
-        for item in self.batch_tree.get_children():
-            self.batch_tree.delete(item)
-            
-        for batch in self.waste_batches:
-            items_text = ", ".join([f"{item.item} ({item.quantity_wasted})" for item in batch.items])
-            self.batch_tree.insert("", tk.END, values=(
-                batch.batch_date,
-                batch.total_waste,
-                items_text,
-                batch.notes
-            ))
+        with span('update_batch_list') as timing:
+            rows = list(self.inventory.waste_batches.values())
+            self.batch_view.set_rows(rows)
+            timing['rows'] = len(rows)
             
     def add_waste(self):
         try:
@@ -714,30 +820,26 @@ class InventoryManager:
                 messagebox.showerror("Invalid date format, Use MM/DD or MM/DD/YYYY")
                 return
                 
-            waste_item = WasteItem(item, quantity_wasted, formatted_date, reason, notes)
-            self.waste_items.append(waste_item)
+            self.inventory.add_waste(WasteItem(item, quantity_wasted, formatted_date, reason, notes))
             
             self.update_waste_list()
-            self.update_waste_chart()  
+            self.schedule_chart_update()
             self.save_data()
             
         except ValueError:
             messagebox.showerror("Quantity must be a number")
             
     def delete_waste(self):
-        selected = self.waste_tree.selection()
-        if selected:
-            index = self.waste_tree.index(selected[0])
-            del self.waste_items[index]
+        item = self.waste_view.selected_record()
+        if item is not None:
+            self.inventory.delete_waste(item.record_id)
             self.update_waste_list()
-            self.update_waste_chart()  
+            self.schedule_chart_update()
             self.save_data()
             
     def on_waste_select(self, event):
-        selected = self.waste_tree.selection()
-        if selected:
-            index = self.waste_tree.index(selected[0])
-            item = self.waste_items[index]
+        item = self.waste_view.new_selection()
+        if item is not None:
             self.waste_item_var.set(item.item)
             self.waste_quantity_var.set(str(item.quantity_wasted))
             self.waste_date_var.set(item.date)
@@ -745,115 +847,335 @@ class InventoryManager:
             self.waste_notes_var.set(item.notes)
             
     def update_waste_list(self):
-        for item in self.waste_tree.get_children():
-            self.waste_tree.delete(item)
-            
-        individual_items = [item for item in self.waste_items if item.batch_id is None]
-        for item in individual_items:
-            self.waste_tree.insert("", tk.END, values=(
-                item.item,
-                item.quantity_wasted,
-                item.date,
-                item.reason,
-                item.notes,
-                ""  
-            ))
+        with span('update_waste_list') as timing:
+            rows = self.inventory.search_waste(
+                self.waste_search_var.get(), self.filter_value(self.waste_reason_filter_var),
+                self.filter_value(self.waste_category_filter_var))
+            self.waste_view.set_rows(rows)
+            timing['rows'] = len(rows)
             
     def create_waste_chart(self, container):
-        self.fig, self.ax = plt.subplots(figsize=(6, 3))  # Smaller size
+        # matplotlib, and numpy with it, is only imported once the Analytics
+        # tab is first opened.
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        self.fig = Figure(figsize=(10, 3.5))
+        self.ax, self.trend_ax = self.fig.subplots(1, 2)
         self.canvas = FigureCanvasTkAgg(self.fig, master=container)
         self.canvas.get_tk_widget().pack(expand=True)
-        self.update_waste_chart()
-        
-    def update_waste_chart(self):
-        self.ax.clear()
-        reason_counts = defaultdict(int)
-        
-        for item in self.waste_items:
-            reason_counts[item.reason] += item.quantity_wasted
+        # What the chart currently shows, so redraws can be skipped or done
+        # by moving the existing wedges, bars and line.
+        self.chart_key = None
+        self.pie_artists = None
+        self.trend_artists = None
 
-        for batch in self.waste_batches:
-            for item in batch.items:
-                reason_counts[item.reason] += item.quantity_wasted
-        
-        if not reason_counts:
+    def analytics_visible(self) -> bool:
+        return self.notebook.select() == str(self.analytics_frame)
+
+    def on_tab_changed(self, event):
+        if self.analytics_visible():
+            if self.fig is None:
+                self.create_waste_chart(self.chart_container)
+            self.update_waste_chart()
+
+    def schedule_chart_update(self):
+        # A batch save or a run of quick edits redraws once, after the last
+        # one, and a hidden chart waits until its tab is shown.
+        if self.chart_after_id is not None:
+            self.root.after_cancel(self.chart_after_id)
+            self.chart_after_id = None
+        if self.analytics_visible():
+            self.chart_after_id = self.root.after(self.CHART_DEBOUNCE_MS, self.update_waste_chart)
+
+    def chart_range(self):
+        # (start, end) ordinals for the selected period, None meaning open.
+        from inventory.analytics import period_bounds
+        today = date.today()
+        period = self.chart_period_var.get()
+        if period == "This Year":
+            return date(today.year, 1, 1).toordinal(), today.toordinal()
+        elif period == "This Month":
+            return period_bounds('month', today.toordinal())[0], today.toordinal()
+        elif period == "Last 30 Days":
+            return today.toordinal() - 29, today.toordinal()
+        return None, None
+
+    def update_waste_chart(self, force=False):
+        if self.chart_after_id is not None:
+            self.root.after_cancel(self.chart_after_id)
+            self.chart_after_id = None
+        if self.fig is None:
+            return
+        start, end = self.chart_range()
+        dimension = self.chart_dimension_var.get()
+        # The store version changes with every add and delete, so an equal
+        # key means the chart on screen is already up to date.
+        key = (self.inventory.waste_records.version, dimension, start, end)
+        if key == self.chart_key and not force:
+            return
+        self.chart_key = key
+        with span('update_waste_chart', dimension=dimension.lower()) as timing:
+            timing['records'] = len(self.inventory.waste_records)
+            self.draw_waste_chart(dimension, start, end)
+
+    def draw_waste_chart(self, dimension, start, end):
+        analytics = self.inventory.analytics
+        totals = analytics.totals(dimension.lower(), start, end)
+        # Beyond a handful of slices the pie stops being readable.
+        labels = list(totals.keys())[:6]
+        quantities = list(totals.values())[:6]
+        if len(totals) > 6:
+            labels.append("Other")
+            quantities.append(sum(list(totals.values())[6:]))
+        rebuilt = self.draw_pie(dimension, labels, quantities)
+
+        # Short ranges are shown per day, longer ones per week.
+        period, window = ('day', 7) if start is not None and end - start < 62 else ('week', 4)
+        starts, sums = analytics.trend(period, start, end)
+        rebuilt = self.draw_trend(period, window, starts, sums) or rebuilt
+
+        if rebuilt:
+            self.fig.tight_layout()
+        self.canvas.draw_idle()
+        self.update_analytics_summary(analytics)
+
+    def draw_pie(self, dimension, labels, quantities) -> bool:
+        # Returns True if the axes had to be rebuilt rather than updated.
+        if self.pie_artists is not None and self.pie_artists[0] == (dimension, labels):
+            # Same slices as before: turn the wedges and move their labels
+            # the way pie() would have placed them.
+            _, patches, texts, autotexts = self.pie_artists
+            total = sum(quantities)
+            theta1 = 0.0
+            for patch, text, autotext, quantity in zip(patches, texts, autotexts, quantities):
+                theta2 = theta1 + 360.0 * quantity / total
+                patch.set_theta1(theta1)
+                patch.set_theta2(theta2)
+                middle = math.radians((theta1 + theta2) / 2)
+                text.set_position((1.1 * math.cos(middle), 1.1 * math.sin(middle)))
+                text.set_horizontalalignment('left' if math.cos(middle) > 0 else 'right')
+                autotext.set_position((0.6 * math.cos(middle), 0.6 * math.sin(middle)))
+                autotext.set_text(f"{100.0 * quantity / total:.1f}%")
+                theta1 = theta2
+            return False
+
+        self.ax.clear()
+        if not labels:
+            self.pie_artists = None
             self.ax.text(0.5, 0.5, 'No waste data available', 
                         horizontalalignment='center', verticalalignment='center')
             self.ax.axis('off')
         else:
-            reasons = list(reason_counts.keys())
-            quantities = list(reason_counts.values())
-            
-            patches, texts, autotexts = self.ax.pie(quantities, labels=reasons, autopct='%1.1f%%',
-                                                   colors=['#ff9999', '#66b3ff', '#99ff99', '#ffcc99'])
+            patches, texts, autotexts = self.ax.pie(quantities, labels=labels, autopct='%1.1f%%',
+                                                   colors=['#ff9999', '#66b3ff', '#99ff99', '#ffcc99',
+                                                           '#c2c2f0', '#ffb3e6', '#d9d9d9'])
+            self.pie_artists = ((dimension, labels), patches, texts, autotexts)
             
-            self.ax.set_title('Waste Distribution by Reason')
+            self.ax.set_title(f'Waste Distribution by {dimension}')
             
             self.ax.axis('equal')
-        
-        self.canvas.draw()
-    def save_data(self):
+        return True
+
+    def draw_trend(self, period, window, starts, sums) -> bool:
+        from inventory.analytics import rolling_average
+        averages = rolling_average(sums, window)
+        layout = (period, int(starts[0]) if len(starts) else None, len(starts))
+        if self.trend_artists is not None and self.trend_artists[0] == layout and len(starts):
+            # Same periods as before: only the heights change.
+            _, bars, line = self.trend_artists
+            for bar, total in zip(bars, sums):
+                bar.set_height(total)
+            line.set_ydata(averages)
+            self.trend_ax.relim()
+            self.trend_ax.autoscale_view()
+            return False
+
+        self.trend_ax.clear()
+        if len(sums):
+            days = [date.fromordinal(int(first)) for first in starts]
+            bars = self.trend_ax.bar(days, sums, width=1 if period == 'day' else 5, color='#66b3ff', label='Wasted')
+            line, = self.trend_ax.plot(days, averages, color='#cc3333', label=f'{window}-{period} average')
+            self.trend_artists = (layout, bars, line)
+            self.trend_ax.legend(fontsize='small')
+            self.trend_ax.tick_params(axis='x', labelrotation=30, labelsize='small')
+        else:
+            self.trend_artists = None
+            self.trend_ax.text(0.5, 0.5, 'No dated waste records',
+                               horizontalalignment='center', verticalalignment='center')
+        self.trend_ax.set_title(f'Waste per {period.capitalize()}')
+        return True
+
+    def update_analytics_summary(self, analytics):
+        from inventory.analytics import period_bounds
+        today = date.today().toordinal()
+        lines = []
+        current, previous = analytics.compare('month', today)
+        change = f"{(current - previous) / previous:+.0%}" if previous else "no data"
+        lines.append(f"This month so far: {current} wasted (same days last month: {previous}, {change})")
+        top_items = analytics.top('item', 3, period_bounds('month', today)[0], today)
+        if top_items:
+            lines.append("Top items this month: " + ", ".join(f"{item} ({total})" for item, total in top_items))
+        self.analytics_summary_var.set("\n".join(lines))
+    def save_data(self, compact=False):
+        # The write itself happens on the persistence worker; results come
+        # back through poll_save_status.
+        with span('save_data') as timing:
+            snapshot = None
+            if compact or (not self.persistence.compaction_pending and self.inventory.repository.needs_compaction()):
+                snapshot = self.inventory.capture_snapshot()
+            changes = self.inventory.take_pending()
+            self.persistence.submit(changes, snapshot)
+            timing.update(changes=len(changes), compact=snapshot is not None)
+        
+    def poll_save_status(self):
+        while True:
+            try:
+                state, detail = self.persistence.status.get_nowait()
+            except queue.Empty:
+                break
+            if state == 'saving':
+                self.save_status_var.set(f"Saving {detail} changes...")
+            elif state == 'saved':
+                self.save_status_var.set(f"All changes saved at {datetime.now().strftime('%H:%M:%S')}")
+            else:
+                self.save_status_var.set("Save failed, will retry with the next change")
+                messagebox.showerror("Save Error", f"Error saving data: {detail}")
+        self.root.after(200, self.poll_save_status)
+            
+    def load_data(self) -> bool:
+        # Only the inventory list is read before the window opens; the waste
+        # history follows on a background thread.
         try:
-            self.storage.save_secure_csv(
-                'inventory.csv',
-                [item.to_csv_row() for item in self.items],
-                ['name', 'quantity', 'expiration_date', 'category']
-            )
-
-            self.storage.save_secure_csv(
-                'waste.csv',
-                [item.to_csv_row() for item in self.waste_items],
-                ['item', 'quantity_wasted', 'date', 'reason', 'notes', 'batch_id']
-            )
-
-            self.storage.save_secure_csv(
-                'waste_batches.csv',
-                [batch.to_csv_row() for batch in self.waste_batches],
-                ['batch_date', 'total_waste', 'notes']
-            )
-
-            logging.info("Data saved successfully")
+            with span('load_data') as timing:
+                self.inventory.load_items()
+                timing['rows'] = len(self.inventory.items)
         except Exception as e:
-            logging.error(f"Error saving data: {str(e)}")
-            messagebox.showerror("Save Error", f"Error saving data: {str(e)}")
+            self.show_load_error(e)
+            return False
+        return True
+        
+    def show_load_error(self, e: Exception):
+        logging.error(f"Error loading data: {str(e)}")
+        messagebox.showerror("Load Error",
+            f"Error loading data: {str(e)}\n\nNothing has been changed on disk. Set INVENTORY_LOAD_ERRORS=quarantine "
+            "in .env to start with the readable data and set the rest aside.")
             
-    def load_data(self):
+    def start_history_load(self):
+        # Until the history is in, the waste and analytics tabs and every
+        # button that edits the inventory stay disabled, so the loader thread
+        # has the inventory to itself apart from reads of the item list.
+        for frame in (self.waste_frame, self.analytics_frame):
+            self.notebook.tab(frame, state='disabled')
+        for button in self.item_edit_buttons:
+            button.state(['disabled'])
+        self.save_status_var.set("Loading waste history...")
+        self.history_error = None
+        self.integrity_problems = []
+        self.history_thread = threading.Thread(target=self.load_history, name="history-load", daemon=True)
+        self.history_thread.start()
+        self.root.after(50, self.poll_history_load)
+        
+    def load_history(self):
         try:
-           
-            inventory_data = self.storage.load_secure_csv('inventory.csv', 
-                ['name', 'quantity', 'expiration_date', 'category'])
-            self.items = [InventoryItem.from_csv_row(row) for row in inventory_data]
-
+            self.inventory.load_history()
+            self.inventory.index_names()
+            # The chart's running totals, built here rather than on the Tk
+            # thread at the first redraw.
+            self.inventory.waste_records.totals
+            # Catches damage in months still on disk and the journal too,
+            # not just in what was loaded.
+            self.integrity_problems = self.inventory.check_integrity()
+        except Exception as e:
+            self.history_error = e
             
-            waste_data = self.storage.load_secure_csv('waste.csv',
-                ['item', 'quantity_wasted', 'date', 'reason', 'notes', 'batch_id'])
-            self.waste_items = [WasteItem.from_csv_row(row) for row in waste_data]
-
+    def poll_history_load(self):
+        if self.history_thread.is_alive():
+            self.root.after(50, self.poll_history_load)
+            return
+        if self.history_error is not None:
+            # Closing without saving keeps the unreadable files as they are.
+            self.show_load_error(self.history_error)
+            self.inventory.close()
+            self.root.destroy()
+            return
             
-            batch_data = self.storage.load_secure_csv('waste_batches.csv',
-                ['batch_date', 'total_waste', 'notes'])
-            for row in batch_data:
-                batch_id = int(row['batch_date'].split('_')[1]) if '_' in row['batch_date'] else None
-                batch_items = [item for item in self.waste_items if item.batch_id == batch_id]
-                batch = WasteBatch.from_csv_row(row, batch_items)
-                self.waste_batches.append(batch)
-
-            logging.info("Data loaded successfully")
+        for frame in (self.waste_frame, self.analytics_frame):
+            self.notebook.tab(frame, state='normal')
+        for button in self.item_edit_buttons:
+            button.state(['!disabled'])
+        self.save_status_var.set("All changes saved")
+        self.update_waste_list()
+        self.update_batch_list()
+        
+        if self.inventory.load_errors:
+            shown = "\n".join(str(error) for error in self.inventory.load_errors[:10])
+            messagebox.showwarning("Load Warning",
+                f"{len(self.inventory.load_errors)} unreadable chunks or rows were left out:\n\n{shown}")
+        if self.integrity_problems:
+            shown = "\n".join(str(problem) for problem in self.integrity_problems[:10])
+            messagebox.showwarning("Integrity Warning",
+                f"{len(self.integrity_problems)} damaged parts were found in the data files:\n\n{shown}\n\n"
+                "Restore them from a backup, or set INVENTORY_LOAD_ERRORS=quarantine in .env to set them aside.")
+        if rekey_pending():
+            self.start_rekey()
+            
+    def rotate_key(self):
+        if self.history_thread.is_alive():
+            messagebox.showinfo("Rotate Key", "Please wait until the waste history has loaded.")
+            return
+        if self.rekey_job is not None and self.rekey_job.is_running():
+            messagebox.showinfo("Rotate Key", "The data is still being re-encrypted with the current key.")
+            return
+        if not messagebox.askyesno("Rotate Key",
+                                   "Create a new encryption key and re-encrypt all data with it in the background?"):
+            return
+        try:
+            self.inventory.storage.rotate_key()
         except Exception as e:
-            logging.error(f"Error loading data: {str(e)}")
-            self.items = []
-            self.waste_items = []
-            self.waste_batches = []
+            logging.error(f"Error rotating the key: {str(e)}")
+            messagebox.showerror("Rotate Key", f"Error rotating the key: {str(e)}")
+            return
+        self.start_rekey()
+        
+    def start_rekey(self):
+        # The job reports from its own thread; poll_rekey shows the latest.
+        self.rekey_job = RekeyJob(self.inventory.storage, self.inventory.repository,
+                                  lambda done, total, name: self.rekey_progress.put((done, total)))
+        self.rekey_status_var.set("Re-encrypting data...")
+        self.rotate_key_button.state(['disabled'])
+        self.rekey_job.start()
+        self.root.after(500, self.poll_rekey)
+        
+    def poll_rekey(self):
+        progress = None
+        while True:
+            try:
+                progress = self.rekey_progress.get_nowait()
+            except queue.Empty:
+                break
+        if self.rekey_job.is_running():
+            if progress is not None:
+                done, total = progress
+                self.rekey_status_var.set(f"Re-encrypting data: {done * 100 // max(total, 1)}%")
+            self.root.after(500, self.poll_rekey)
+            return
+        self.rotate_key_button.state(['!disabled'])
+        if self.rekey_job.error is not None:
+            self.rekey_status_var.set("Re-encryption failed")
+            messagebox.showerror("Rotate Key",
+                f"Error re-encrypting data: {self.rekey_job.error}\n\nIt will be retried on the next start.")
+        elif self.rekey_job.finished:
+            self.rekey_status_var.set(f"Data re-encrypted with key version {self.inventory.storage.key_version}")
             
     def unselect_item(self, event=None):
-        self.tree.selection_remove(self.tree.selection())
+        self.item_view.clear_selection()
         self.name_var.set("")
         self.quantity_var.set("")
         self.expiration_var.set("")
         self.category_var.set("")
         
     def unselect_waste(self, event=None):
-        self.waste_tree.selection_remove(self.waste_tree.selection())
+        self.waste_view.clear_selection()
         self.waste_item_var.set("")
         self.waste_quantity_var.set("")
         self.waste_date_var.set("")
@@ -861,7 +1183,7 @@ class InventoryManager:
         self.waste_notes_var.set("")
         
     def unselect_batch(self, event=None):
-        self.batch_tree.selection_remove(self.batch_tree.selection())
+        self.batch_view.clear_selection()
         self.batch_date_var.set("")
         self.batch_notes_var.set("")
 
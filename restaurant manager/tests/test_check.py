@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+
+from conftest import APP_DIR
+from inventory.storage import INVENTORY_FIELDS, INVENTORY_FILE, SecureStorage
+
+
+def directory_state(path):
+    state = {}
+    for folder, _, names in os.walk(path):
+        for name in names:
+            filename = os.path.join(folder, name)
+            with open(filename, 'rb') as f:
+                state[os.path.relpath(filename, path)] = (f.read(), os.stat(filename).st_mtime_ns)
+    return state
+
+
+def run_check(path):
+    env = dict(os.environ, PYTHONPATH=APP_DIR)
+    return subprocess.run([sys.executable, '-m', 'inventory', '--data-dir', str(path), 'check'],
+                          env=env, capture_output=True, text=True)
+
+
+def test_check_leaves_empty_directory_empty(tmp_path):
+    result = run_check(tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert directory_state(tmp_path) == {}
+
+
+def test_check_creates_no_sqlite_database(tmp_path):
+    (tmp_path / '.env').write_text("INVENTORY_BACKEND=sqlite\n")
+    before = directory_state(tmp_path)
+    result = run_check(tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert directory_state(tmp_path) == before
+
+
+def test_check_leaves_data_unchanged(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    storage = SecureStorage()
+    rows = [{'name': f"Item {i}", 'quantity': str(i), 'expiration_date': '01/01/2027', 'category': 'Produce'}
+            for i in range(10)]
+    storage.save_secure_csv(INVENTORY_FILE, rows, INVENTORY_FIELDS)
+    storage.close()
+    before = directory_state(tmp_path)
+
+    result = run_check(tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert directory_state(tmp_path) == before
+
+    # A damaged chunk is reported, still without touching anything.
+    lines = (tmp_path / INVENTORY_FILE).read_text().splitlines(True)
+    lines[1] = lines[1][:20] + ('A' if lines[1][20] != 'A' else 'B') + lines[1][21:]
+    (tmp_path / INVENTORY_FILE).write_text(''.join(lines))
+    before = directory_state(tmp_path)
+    result = run_check(tmp_path)
+    assert result.returncode == 1
+    assert "checksum mismatch" in result.stdout
+    assert directory_state(tmp_path) == before
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+
+from conftest import APP_DIR
+from inventory.storage import INVENTORY_FIELDS, INVENTORY_FILE, SecureStorage
+
+
+def run_cli(path, *args):
+    env = dict(os.environ, PYTHONPATH=APP_DIR)
+    return subprocess.run([sys.executable, '-m', 'inventory', '--data-dir', str(path), *args],
+                          env=env, capture_output=True, text=True)
+
+
+def write_items():
+    storage = SecureStorage()
+    rows = [{'name': f"Item {i}", 'quantity': str(i), 'expiration_date': '01/01/2027', 'category': 'Produce'}
+            for i in range(10)]
+    storage.save_secure_csv(INVENTORY_FILE, rows, INVENTORY_FIELDS)
+    storage.close()
+
+
+def test_unreadable_data_exits_with_one_line(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_items()
+    # Encrypted under a key that is no longer in the key file.
+    (tmp_path / '.encryption_key').unlink()
+    SecureStorage().close()
+
+    result = run_cli(tmp_path, 'export', 'inventory')
+    assert result.returncode == 1
+    assert "Traceback" not in result.stderr
+    assert len(result.stderr.strip().splitlines()) == 1
+    assert "--on-error" in result.stderr
+
+    result = run_cli(tmp_path, '--on-error', 'skip', 'export', 'inventory')
+    assert result.returncode == 0, result.stderr
+    assert "left out" in result.stderr
+
+
+def test_damaged_key_file_exits_with_one_line(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_items()
+    (tmp_path / '.encryption_key').write_bytes(b"index abc\n1\n")
+
+    result = run_cli(tmp_path, 'export', 'inventory')
+    assert result.returncode == 1
+    assert "Traceback" not in result.stderr
+    assert "encryption key file" in result.stderr
@@ -0,0 +1,28 @@
+from datetime import date
+
+import pytest
+
+from inventory.core import normalize_date
+from inventory.models import parse_date
+
+
+@pytest.mark.parametrize('text', ['01/05/24', '1/5/7', '01/05/024', '01/05/20245', '13/01/2024',
+                                  '02/30/2024', '00/10/2024', '001/05/2024', '01/05/', '1//2024', '١/٥/٢٠٢٤'])
+def test_rejects_what_strptime_rejects(text):
+    assert parse_date(text) is None
+    assert normalize_date(text) is None
+
+
+def test_two_digit_year_is_not_year_24():
+    assert normalize_date('01/05/24') is None
+    assert normalize_date('01/05/2024') == '01/05/2024'
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('01/05/2024', (date(2024, 1, 5).toordinal(), True)),
+    ('1/5/2024', (date(2024, 1, 5).toordinal(), True)),
+    ('02/29/2024', (date(2024, 2, 29).toordinal(), True)),
+    ('12/31', (date(1900, 12, 31).toordinal(), False)),
+])
+def test_accepts_full_dates(text, expected):
+    assert parse_date(text) == expected
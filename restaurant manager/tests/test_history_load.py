@@ -0,0 +1,49 @@
+from datetime import date
+
+from inventory.core import Inventory
+from inventory.models import InventoryItem, WasteItem
+from inventory.storage import SecureStorage
+
+
+def make_data():
+    today = date.today()
+    inventory = Inventory()
+    inventory.import_items([InventoryItem(f"Item {i}", i + 1, "01/01/2030", "Produce") for i in range(20)])
+    inventory.import_waste([WasteItem(f"Item {i}", 1, f"{today.month:02d}/{i % 28 + 1:02d}/{today.year}",
+                                      "Expired", "") for i in range(50)])
+    inventory.save(compact=True)
+    inventory.save_snapshot()
+    inventory.close()
+
+
+def test_segments_are_not_read_when_the_snapshot_matches(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_data()
+
+    storage = SecureStorage()
+    read = []
+    iter_secure_csv = storage.iter_secure_csv
+
+    def recording(filename, *args):
+        # Only counts once a row is taken, as building the generator reads
+        # nothing.
+        read.append(filename)
+        yield from iter_secure_csv(filename, *args)
+
+    monkeypatch.setattr(storage, 'iter_secure_csv', recording)
+    inventory = Inventory(storage)
+    inventory.load()
+    assert not any(filename.startswith('waste') for filename in read)
+    assert len(inventory.waste_records) == 50
+    inventory.close()
+
+
+def test_segments_load_in_record_id_order(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_data()
+    (tmp_path / 'inventory.snapshot').unlink()
+    inventory = Inventory()
+    inventory.load()
+    ids = [record.record_id for record in inventory.waste_records.values()]
+    assert ids == sorted(ids) and len(ids) == 50
+    inventory.close()
@@ -0,0 +1,57 @@
+import atexit
+import json
+import logging
+
+import pytest
+
+from inventory import logs
+
+
+@pytest.fixture
+def read_log(tmp_path, monkeypatch):
+    # A pipeline of its own, taken down again so other tests keep theirs.
+    # read_log() stops the listener, which writes what is still queued, and
+    # returns the JSON entries.
+    monkeypatch.setattr(logs, '_listener', None)
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    filename = tmp_path / 'test.log'
+    listener = logs.configure_logging(str(filename))
+    stopped = []
+
+    def read():
+        if not stopped:
+            listener.stop()
+            stopped.append(True)
+        with open(filename) as f:
+            return [json.loads(line) for line in f]
+
+    yield read
+    read()
+    atexit.unregister(listener.stop)
+    for handler in listener.handlers:
+        handler.close()
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_exception_reaches_the_json_line(read_log):
+    try:
+        raise ValueError("bad row")
+    except ValueError:
+        logging.exception("Error loading %s", "inventory.csv")
+
+    entry, = read_log()
+    assert entry['level'] == 'ERROR'
+    assert entry['message'] == "Error loading inventory.csv"
+    assert entry['exception'].startswith("Traceback")
+    assert "ValueError: bad row" in entry['exception']
+
+
+def test_span_fields_and_no_exception_key(read_log):
+    with logs.span('update_item_list', rows=3):
+        pass
+
+    entry, = read_log()
+    assert entry['span'] == 'update_item_list' and entry['rows'] == 3
+    assert 'exception' not in entry
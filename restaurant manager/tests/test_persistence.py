@@ -0,0 +1,164 @@
+import os
+from datetime import date, timedelta
+
+import pytest
+
+from inventory.core import Inventory
+from inventory.models import InventoryItem, WasteItem
+from inventory.storage import PersistenceWorker, waste_partition
+
+
+def make_inventory():
+    inventory = Inventory()
+    inventory.import_items([InventoryItem(f"Item {i}", i + 1, "01/01/2030", "Produce") for i in range(10)])
+    inventory.import_waste([WasteItem(f"Item {i % 10}", 1, "03/04/2030", "Expired", "") for i in range(40)])
+    inventory.add_batch("03/05/2030", [WasteItem("Item 1", 2, "", "Spoiled", "")], "batch")
+    inventory.save(compact=True)
+    return inventory
+
+
+def test_captured_snapshot_keeps_the_state_it_was_taken_at(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    inventory = make_inventory()
+    expected = inventory.snapshot_rows()
+    snapshot = inventory.capture_snapshot()
+
+    # Later edits, including enough deletes to compact the waste columns.
+    inventory.delete_item(0)
+    inventory.add_item(InventoryItem("New", 1, "02/02/2030", "Dairy"))
+    for record_id in list(inventory.waste_records)[:30]:
+        inventory.delete_waste(record_id)
+    inventory.add_waste(WasteItem("New", 3, "03/06/2030", "Dropped", ""))
+    inventory.delete_batch(next(iter(inventory.waste_batches)))
+
+    assert snapshot.rows() == expected
+    inventory.close()
+
+
+def test_failed_flush_keeps_the_changes_for_resume(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    inventory = make_inventory()
+    worker = PersistenceWorker(inventory.repository)
+    monkeypatch.setattr(PersistenceWorker, 'COALESCE_DELAY', 0)
+    apply = inventory.repository.apply
+
+    def failing(changes):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(inventory.repository, 'apply', failing)
+    inventory.add_item(InventoryItem("New", 1, "02/02/2030", "Dairy"))
+    with pytest.raises(RuntimeError):
+        worker.flush(inventory.take_pending(), inventory.capture_snapshot())
+    assert not worker.compaction_pending
+
+    monkeypatch.setattr(inventory.repository, 'apply', apply)
+    worker.resume()
+    worker.flush([])
+    expected = inventory.snapshot_rows()
+    inventory.close()
+
+    reloaded = Inventory()
+    reloaded.load()
+    assert reloaded.snapshot_rows() == expected
+    reloaded.close()
+
+
+def fail_on_call(monkeypatch, target, name, call):
+    # Makes target.name raise OSError on its call-th call, once.
+    original = getattr(target, name)
+    calls = []
+
+    def failing(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == call:
+            raise OSError("disk full")
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(target, name, failing)
+
+
+def test_journal_append_failing_after_its_writes_is_undone(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(PersistenceWorker, 'COALESCE_DELAY', 0)
+    inventory = make_inventory()
+    worker = PersistenceWorker(inventory.repository)
+
+    # Every entry is written before fsync fails, as with a full disk.
+    fail_on_call(monkeypatch, os, 'fsync', 1)
+    inventory.add_item(InventoryItem("New 1", 1, "02/02/2030", "Dairy"))
+    inventory.delete_item(0)
+    inventory.add_item(InventoryItem("New 2", 1, "02/03/2030", "Dairy"))
+    with pytest.raises(RuntimeError):
+        worker.flush(inventory.take_pending())
+    worker.resume()
+    worker.flush([])
+    assert inventory.repository.journal.op_count == 3
+    expected = inventory.snapshot_rows()
+    inventory.close()
+
+    reloaded = Inventory()
+    reloaded.load()
+    assert reloaded.snapshot_rows() == expected
+    reloaded.close()
+
+
+def test_sqlite_row_map_survives_a_rolled_back_save(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('INVENTORY_BACKEND', 'sqlite')
+    monkeypatch.setattr(PersistenceWorker, 'COALESCE_DELAY', 0)
+    inventory = make_inventory()
+    repository = inventory.repository
+    worker = PersistenceWorker(repository)
+
+    # The second insert fails, after the first reached the transaction.
+    fail_on_call(monkeypatch, repository, '_insert', 2)
+    inventory.add_item(InventoryItem("New 1", 1, "02/02/2030", "Dairy"))
+    inventory.add_item(InventoryItem("New 2", 1, "02/03/2030", "Dairy"))
+    with pytest.raises(RuntimeError):
+        worker.flush(inventory.take_pending())
+    worker.resume()
+    worker.flush([])
+    assert len(repository.row_ids['inventory']) == len(inventory.items) == len(repository.find_items())
+
+    # Positional changes still hit the right rows.
+    inventory.delete_item(0)
+    inventory.sort_items("Name")
+    inventory.delete_item(3)
+    repository.apply(inventory.take_pending())
+    expected = inventory.snapshot_rows()[0]
+    inventory.close()
+
+    reloaded = Inventory()
+    reloaded.load()
+    assert sorted(map(str, reloaded.snapshot_rows()[0])) == sorted(map(str, expected))
+    reloaded.close()
+
+
+def test_month_loaded_after_the_snapshot_survives_its_compaction(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    today = date.today()
+    old = (today - timedelta(days=400)).strftime("%m/%d/%Y")
+    inventory = Inventory()
+    inventory.import_waste([WasteItem("Item", 1, old, "Expired", "") for _ in range(5)]
+                           + [WasteItem("Item", 1, today.strftime("%m/%d/%Y"), "Expired", "") for _ in range(5)])
+    inventory.save(compact=True)
+    inventory.close()
+
+    inventory = Inventory()
+    inventory.load()
+    old_month = waste_partition(old)
+    assert old_month in inventory.repository.archived_partitions()
+    snapshot = inventory.capture_snapshot()
+    # The Tk thread loads the old month before the worker compacts.
+    inventory.add_waste(WasteItem("Item", 1, old, "Dropped", ""))
+    inventory.repository.compact(*snapshot.rows(), snapshot.loaded_partitions)
+    assert os.path.exists(os.path.join('waste', f"{old_month}.csv"))
+    # Then a crash, with the new record only in the journal.
+    inventory.repository.apply(inventory.take_pending())
+    inventory.close()
+
+    reloaded = Inventory()
+    reloaded.load()
+    reloaded.ensure_waste_loaded()
+    assert len(reloaded.waste_records) == 11
+    reloaded.close()
@@ -0,0 +1,62 @@
+import os
+import random
+import subprocess
+import sys
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import APP_DIR
+from inventory.core import Inventory
+from inventory.models import InventoryItem, WasteItem
+
+
+def make_data(path, backend):
+    os.chdir(path)
+    os.environ['INVENTORY_BACKEND'] = backend
+    rng = random.Random(3)
+    today = date.today()
+    inventory = Inventory()
+    inventory.import_items([InventoryItem(rng.choice("abc"), rng.randint(1, 3),
+                                          (today + timedelta(days=rng.randint(-3, 20))).strftime("%m/%d/%Y"),
+                                          rng.choice(["Produce", "Dairy"])) for _ in range(60)])
+    inventory.add_item(InventoryItem("a", 1, "", "Produce"))
+    inventory.import_waste([WasteItem(rng.choice("abc"), rng.randint(1, 5),
+                                      (today - timedelta(days=rng.randint(0, 90))).strftime("%m/%d/%Y"),
+                                      rng.choice(["Expired", "Dropped"]), "") for _ in range(200)])
+    inventory.save(compact=True)
+    inventory.close()
+
+
+def run_cli(path, backend, *args):
+    env = dict(os.environ, PYTHONPATH=APP_DIR, INVENTORY_BACKEND=backend)
+    result = subprocess.run([sys.executable, '-m', 'inventory', '--data-dir', str(path), *args],
+                            env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+@pytest.mark.parametrize('args', [
+    ('items', '--name', 'a'),
+    ('items', '--category', 'Dairy'),
+    ('items', '--name', 'b', '--category', 'Produce'),
+    ('items', '--expiring-within', '7'),
+    ('items', '--expiring-within', '10', '--name', 'c'),
+    ('waste', '--item', 'a'),
+    ('waste', '--reason', 'Dropped', '--from', (date.today() - timedelta(days=30)).strftime("%m/%d/%Y")),
+    ('waste', '--item', 'b', '--to', (date.today() - timedelta(days=10)).strftime("%m/%d/%Y")),
+])
+def test_sqlite_index_queries_match_the_loaded_inventory(tmp_path, monkeypatch, args):
+    monkeypatch.setenv('INVENTORY_BACKEND', 'csv')
+    for backend in ('csv', 'sqlite'):
+        (tmp_path / backend).mkdir()
+        make_data(tmp_path / backend, backend)
+    monkeypatch.chdir(tmp_path)
+    expected = run_cli(tmp_path / 'csv', 'csv', *args)
+    assert expected.count('\n') > 1
+    actual = run_cli(tmp_path / 'sqlite', 'sqlite', *args)
+    if args[0] == 'items' and '--expiring-within' not in args:
+        # Each backend lists items in its own load order, which only agrees
+        # up to ties in the expiration date.
+        expected, actual = sorted(expected.splitlines()), sorted(actual.splitlines())
+    assert actual == expected
@@ -0,0 +1,75 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import APP_DIR
+from inventory.core import Inventory
+from inventory.models import WasteItem
+from inventory.rekey import RekeyJob
+from inventory.storage import SecureStorage, block_checksum, create_repository, frame_token
+
+
+def write_quarantine(filename, entries):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w') as f:
+        for data in entries:
+            f.write(json.dumps({'line': 2, 'error': "test", 'data': data}) + "\n")
+
+
+def read_quarantine(filename):
+    with open(filename) as f:
+        return [json.loads(line)['data'] for line in f]
+
+
+def run_rotate_key(path, *flags):
+    env = dict(os.environ, PYTHONPATH=APP_DIR)
+    return subprocess.run([sys.executable, '-m', 'inventory', '--data-dir', str(path), 'rotate-key', *flags],
+                          env=env, capture_output=True, text=True)
+
+
+def test_orphaned_and_framed_quarantine_entries_are_rotated(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    storage = SecureStorage()
+    token = storage.encrypt_data("1,2,3")
+    # A segment compacted away after its bad chunks were set aside, with a
+    # plain token, a line whose checksum was damaged and a truncation note.
+    orphan = os.path.join('waste', '2025-01.csv.quarantine')
+    write_quarantine(orphan, [token, f"{block_checksum('x')} {token}", ''])
+    old_version = storage.key_version
+    storage.rotate_key()
+    repository = create_repository(storage)
+    job = RekeyJob(storage, repository)
+    assert job.run() and job.unreadable == 0
+    repository.close()
+    storage.retire_keys()
+
+    plain, framed, empty = read_quarantine(orphan)
+    assert storage.decrypt_data(plain) == "1,2,3"
+    assert framed == frame_token(framed.partition(' ')[2])
+    assert storage.decrypt_data(framed.partition(' ')[2]) == "1,2,3"
+    assert empty == ''
+    assert old_version not in storage.keys
+    storage.close()
+
+
+def test_retire_refuses_while_tokens_are_unreadable(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    inventory = Inventory()
+    inventory.import_waste([WasteItem("Item", 1, "01/02/2030", "Expired", "")])
+    inventory.save(compact=True)
+    inventory.close()
+    write_quarantine('inventory.csv.quarantine', ["gAAAAAnot-a-token"])
+
+    result = run_rotate_key(tmp_path, '--retire')
+    assert result.returncode != 0
+    assert "--force" in result.stderr
+    storage = SecureStorage()
+    assert len(storage.keys) == 2
+    storage.close()
+
+    result = run_rotate_key(tmp_path, '--retire', '--force')
+    assert result.returncode == 0, result.stderr
+    storage = SecureStorage()
+    assert len(storage.keys) == 1
+    storage.close()